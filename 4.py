@@ -1,18 +1,21 @@
 import fastapi
 import uvicorn
-from fastapi import WebSocket, WebSocketDisconnect, Response
+from fastapi import WebSocket, WebSocketDisconnect, Response, Request
 from fastapi.responses import HTMLResponse
 from fastapi.staticfiles import StaticFiles
 import requests
-import edge_tts
 import asyncio
 import base64
 import os
-import time
 import json
-import uuid
 from pathlib import Path
 import threading
+from contextlib import asynccontextmanager
+from audio_store import AudioStore, MemoryAudioStore
+from static_assets import StaticAssets
+from ws_manager import ConnectionManager
+from tts_backends import create_tts_backend, tts_metrics
+from phrase_bank import get_phrase_bank
 
 # --- Configuration ---
 MODEL_NAME = "gemma3:4b"
@@ -33,6 +36,17 @@ SYSTEM_CONTEXT = f"""당신은 {PERSONA_NAME}입니다. 친절하고, 관찰력
 TTS_VOICE = "ko-KR-JiMinNeural"
 AUDIO_DIR = Path("static_audio")
 AUDIO_DIR.mkdir(parents=True, exist_ok=True)
+audio_store = AudioStore(AUDIO_DIR, max_age_seconds=600, max_total_bytes=200 * 1024 * 1024) # 인덱스 기반 오디오 정리
+AUDIO_IN_MEMORY = os.getenv("AUDIO_IN_MEMORY", "0") == "1" # SD 카드 기기용: TTS 오디오를 RAM에 보관 (넘치면 AUDIO_DIR로 spill)
+memory_audio_store = MemoryAudioStore(max_bytes=64 * 1024 * 1024, spill=audio_store) if AUDIO_IN_MEMORY else None
+tts_backend = create_tts_backend(TTS_VOICE) # TTS 엔진 선택: TTS_BACKEND=edge|espeak|piper|stub (오프라인/CI용 로컬 엔진)
+# 고정 발화 (시간 초과/오류 안내): 시작 시 phrase bank로 미리 합성해 두고 즉시 재생
+NO_RESPONSE_MESSAGE = "(Aura가 응답하지 않았습니다.)"
+TIMEOUT_MESSAGE = "(응답 시간이 초과되었습니다... 잠시 후 다시 시도해 주세요.)"
+INTERNAL_ERROR_MESSAGE = "(응답 처리 중 내부 오류 발생.)"
+FIXED_PHRASES = [NO_RESPONSE_MESSAGE, TIMEOUT_MESSAGE, INTERNAL_ERROR_MESSAGE]
+phrase_bank = get_phrase_bank(tts_backend, TTS_VOICE)
+tts_backend = phrase_bank.wrap(tts_backend)
 
 # --- Frontend Code (Embedded - 한국어 UI) ---
 
@@ -263,16 +277,20 @@ document.addEventListener('DOMContentLoaded', () => {
         const wsProtocol = window.location.protocol === 'https:' ? 'wss:' : 'ws:';
         const wsUrl = `${wsProtocol}//${window.location.host}/ws`;
         setStatusMessage("서버 연결 시도 중..."); connectDisconnectButton.disabled = true;
-        socket = new WebSocket(wsUrl);
+        socket = new WebSocket(wsUrl); socket.binaryType = 'arraybuffer'; // TTS 오디오 청크는 바이너리 프레임
 
         socket.onopen = () => {
             console.log("WebSocket connection established."); isConnected = true; connectDisconnectButton.disabled = false;
             addMessage("System", "Aura와 연결되었습니다. 웹캠을 시작합니다..."); updateUIState(); startWebcam();
         };
         socket.onmessage = (event) => {
+            if (event.data instanceof ArrayBuffer) { appendAudioChunk(event.data); return; } // 스트리밍 TTS 청크
             try {
                 const data = JSON.parse(event.data);
                 if (data.type === "response") { addMessage("Aura", data.ai_text); if (data.audio_url) playTTS(data.audio_url); }
+                else if (data.type === "audio_start") startAudioStream(data.mime);
+                else if (data.type === "audio_end") endAudioStream();
+                else if (data.type === "audio_url") playTTS(data.audio_url); // 스트리밍 실패 시 파일 재생
                 else if (data.type === "error") { addMessage("System", `서버 오류: ${data.message}`); setStatusMessage(`서버 오류: ${data.message}`); }
             } catch (error) { console.error("WebSocket message handling error:", error); addMessage("System", "서버 메시지 처리 오류."); }
         };
@@ -332,7 +350,7 @@ document.addEventListener('DOMContentLoaded', () => {
              else { addMessage("System", "웹캠 시작 실패. 텍스트만 전송합니다."); }
         } else { captureFrame(); frameToSend = latestFrameDataBase64; }
 
-        const payload = { image: frameToSend, text: text };
+        const payload = { image: frameToSend, text: text, stream_audio: canStreamAudio };
         try { socket.send(JSON.stringify(payload)); /* console.log(`Sent data...`); */ } // 로그 간소화
         catch (e) { console.error("WebSocket send error:", e); addMessage("System", "데이터 전송 오류."); }
     }
@@ -364,6 +382,42 @@ document.addEventListener('DOMContentLoaded', () => {
     }
     function playTTS(audioUrl) { if (ttsAudio && audioUrl) { ttsAudio.src = audioUrl; ttsAudio.play().catch(e => { console.error("Audio playback error:", e); addMessage("System", "오디오 자동 재생 실패."); }); } }
 
+    // --- 스트리밍 TTS (MediaSource) ---
+    // 서버가 audio_start -> 바이너리 mp3 청크 -> audio_end 순으로 전송, 첫 청크부터 재생 시작
+    const canStreamAudio = !!(window.MediaSource && MediaSource.isTypeSupported('audio/mpeg'));
+    let audioStream = null;
+
+    function startAudioStream(mime) {
+        if (!ttsAudio || !canStreamAudio) return;
+        const mediaSource = new MediaSource();
+        const stream = { mediaSource: mediaSource, sourceBuffer: null, queue: [], ended: false };
+        audioStream = stream;
+        ttsAudio.src = URL.createObjectURL(mediaSource);
+        mediaSource.addEventListener('sourceopen', () => {
+            URL.revokeObjectURL(ttsAudio.src);
+            stream.sourceBuffer = mediaSource.addSourceBuffer(mime || 'audio/mpeg');
+            stream.sourceBuffer.addEventListener('updateend', () => flushAudioStream(stream));
+            flushAudioStream(stream);
+        }, { once: true });
+        ttsAudio.play().catch(e => { console.error("Audio playback error:", e); addMessage("System", "오디오 자동 재생 실패."); });
+    }
+    function appendAudioChunk(chunk) {
+        if (!audioStream) return;
+        audioStream.queue.push(chunk); flushAudioStream(audioStream);
+    }
+    function flushAudioStream(stream) {
+        const sourceBuffer = stream.sourceBuffer;
+        if (!sourceBuffer || sourceBuffer.updating) return;
+        try {
+            if (stream.queue.length > 0) { sourceBuffer.appendBuffer(stream.queue.shift()); return; }
+            if (stream.ended && stream.mediaSource.readyState === 'open') stream.mediaSource.endOfStream();
+        } catch (e) { console.error("Audio stream append error:", e); }
+    }
+    function endAudioStream() {
+        if (!audioStream) return;
+        audioStream.ended = true; flushAudioStream(audioStream); audioStream = null;
+    }
+
     // --- STT (Web Speech API) ---
     const SpeechRecognition = window.SpeechRecognition || window.webkitSpeechRecognition;
     let recognition = null; let isRecognizing = false;
@@ -418,27 +472,40 @@ document.addEventListener('DOMContentLoaded', () => {
 # *** JavaScript 수정 부분 끝 ***
 
 # --- FastAPI App Setup (변경 없음) ---
-app = fastapi.FastAPI()
+@asynccontextmanager
+async def lifespan(app: fastapi.FastAPI):
+    audio_store.start_janitor() # 주기적 오디오 정리 작업 (요청마다 디렉터리 스캔하지 않음)
+    phrase_task = asyncio.create_task(phrase_bank.ensure(tts_backend, FIXED_PHRASES)) # 없는 고정 발화만 백그라운드 합성 (기동을 막지 않음, 그동안은 일반 TTS)
+    yield
+    phrase_task.cancel()
+    await audio_store.stop_janitor()
+
+app = fastapi.FastAPI(lifespan=lifespan)
 
 # --- Helper Functions (Temperature=0.85 유지) ---
 async def generate_tts(text: str) -> str | None: # (변경 없음)
     try:
-        output_filename = f"aura_tts_{uuid.uuid4()}.mp3"; output_path = AUDIO_DIR / output_filename
-        communicate = edge_tts.Communicate(text, TTS_VOICE); await communicate.save(str(output_path))
-        audio_url = f"/static/audio/{output_filename}"; asyncio.create_task(cleanup_old_audio_files(max_age_seconds=600))
-        return audio_url
+        if memory_audio_store is not None: # RAM 저장 모드: 파일 쓰기 없이 메모리 LRU에 보관
+            audio = await tts_backend.synthesize(text)
+            return await memory_audio_store.put(audio, suffix=tts_backend.suffix) if audio else None
+        output_path = audio_store.new_path(suffix=tts_backend.suffix)
+        audio = await tts_backend.synthesize(text)
+        if not audio: return None
+        await asyncio.to_thread(output_path.write_bytes, audio)
+        return audio_store.add(output_path, size=len(audio))
     except Exception as e: print(f"Error generating TTS: {e}"); return None
 
-async def cleanup_old_audio_files(max_age_seconds: int): # (변경 없음)
+async def stream_tts(text: str, websocket: WebSocket) -> bool:
+    """TTS 오디오 청크를 생성 즉시 WebSocket 바이너리 프레임으로 전달 (파일 저장 없음)"""
+    started = False
     try:
-        now = time.time(); removed_count = 0
-        for filename in os.listdir(AUDIO_DIR):
-            if filename.endswith(".mp3"):
-                file_path = AUDIO_DIR / filename
-                try:
-                    if now - file_path.stat().st_mtime > max_age_seconds: os.remove(file_path); removed_count += 1
-                except OSError: pass
-    except Exception: pass
+        async for data in tts_backend.stream(text):
+            if not started: await manager.send_json({"type": "audio_start", "mime": tts_backend.media_type}, websocket); started = True
+            if not await manager.send_bytes(data, websocket): break
+        return started
+    except Exception as e: print(f"TTS 스트리밍 오류: {e}"); return started
+    finally:
+        if started: await manager.send_json({"type": "audio_end"}, websocket)
 
 async def call_ollama_gemma3(image_base64: str | None, text: str, history: list) -> str: # (Temperature=0.85 유지)
     full_prompt = SYSTEM_CONTEXT
@@ -471,33 +538,46 @@ async def call_ollama_gemma3(image_base64: str | None, text: str, history: list)
         if ai_response.startswith("model\n"): ai_response = ai_response[len("model\n"):].strip()
         print(f"Ollama 응답: {ai_response}")
         history.append({"role": "user", "content": user_content}); history.append({"role": "model", "content": ai_response})
-        return ai_response if ai_response else "(Aura가 응답하지 않았습니다.)"
-    except requests.exceptions.Timeout: print("Ollama API 시간 초과."); return "(응답 시간이 초과되었습니다... 잠시 후 다시 시도해 주세요.)"
+        return ai_response if ai_response else NO_RESPONSE_MESSAGE
+    except requests.exceptions.Timeout: print("Ollama API 시간 초과."); return TIMEOUT_MESSAGE
     except requests.exceptions.RequestException as e: print(f"Ollama API 요청 오류: {e}"); return f"(Ollama 서버 통신 오류: {e})"
-    except Exception as e: print(f"Ollama 응답 처리 오류: {e}"); return "(응답 처리 중 내부 오류 발생.)"
-
-# --- WebSocket Connection Manager (변경 없음) ---
-class ConnectionManager:
-    def __init__(self): self.active_connections: list[WebSocket] = []; self.history: dict[WebSocket, list] = {}
-    async def connect(self, websocket: WebSocket): await websocket.accept(); self.active_connections.append(websocket); self.history[websocket] = []; print(f"클라이언트 연결됨: {websocket.client}")
-    def disconnect(self, websocket: WebSocket):
-        if websocket in self.active_connections: self.active_connections.remove(websocket)
-        if websocket in self.history: del self.history[websocket]
-        print(f"클라이언트 연결 해제됨: {websocket.client}")
-    async def send_json(self, message: dict, websocket: WebSocket):
-        if websocket in self.active_connections:
-             try: await websocket.send_json(message)
-             except Exception as e: print(f"전송 실패: {e}"); self.disconnect(websocket)
-
-manager = ConnectionManager()
+    except Exception as e: print(f"Ollama 응답 처리 오류: {e}"); return INTERNAL_ERROR_MESSAGE
+
+# --- WebSocket Connection Manager ---
+# 연결별 송신 큐 + writer 태스크: 느린 클라이언트가 추론 루프를 막지 않음 (초과 시 1013으로 종료)
+# 하트비트: uvicorn 프로토콜 ping (WS_PING_INTERVAL / WS_PING_TIMEOUT), 무응답·유휴 연결은 상태와 진행 중 작업까지 즉시 회수
+WS_PING_INTERVAL = float(os.getenv("WS_PING_INTERVAL", "20")); WS_PING_TIMEOUT = float(os.getenv("WS_PING_TIMEOUT", "20"))
+manager = ConnectionManager(max_messages=int(os.getenv("WS_QUEUE_MAX_MESSAGES", "512")), max_bytes=int(os.getenv("WS_QUEUE_MAX_BYTES", str(8 * 1024 * 1024))),
+                            idle_timeout=float(os.getenv("WS_IDLE_TIMEOUT", "900")), send_timeout=float(os.getenv("WS_SEND_TIMEOUT", "30")),
+                            drop_notice={"type": "error", "message": "처리 중 메시지가 너무 많아 이전 메시지 하나를 건너뛰었습니다."})
+
+# 인라인 자산: 시작 시 1회 해시 + gzip/brotli 압축, 지문 URL은 immutable 캐시
+static_assets = StaticAssets()
+static_assets.add("style.css", CSS_CONTENT, "text/css; charset=utf-8")
+static_assets.add("main.js", JAVASCRIPT_CONTENT, "application/javascript; charset=utf-8")
+static_assets.add_page("index.html", HTML_CONTENT, {"/static/css/style.css": "style.css", "/static/js/main.js": "main.js"})
 
 # --- API Endpoints (변경 없음) ---
 @app.get("/static/css/style.css", response_class=Response)
-async def get_css(): return Response(content=CSS_CONTENT, media_type="text/css")
+async def get_css(request: Request): return static_assets.response("style.css", request.headers)
 @app.get("/static/js/main.js", response_class=Response)
-async def get_js(): return Response(content=JAVASCRIPT_CONTENT, media_type="application/javascript")
+async def get_js(request: Request): return static_assets.response("main.js", request.headers)
+@app.get("/static/assets/{filename}", response_class=Response)
+async def get_asset(filename: str, request: Request): return static_assets.fingerprinted_response(filename, request.headers)
 @app.get("/", response_class=HTMLResponse)
-async def get_root(): return HTMLResponse(content=HTML_CONTENT)
+async def get_root(request: Request): return static_assets.response("index.html", request.headers)
+@app.get("/audio/{name}")
+async def get_memory_audio(name: str, request: Request): # RAM 저장 오디오 (ETag / Range / Cache-Control)
+    if memory_audio_store is None: return Response(status_code=404)
+    return await memory_audio_store.response(name, request.headers)
+@app.get("/metrics/tts")
+async def get_tts_metrics(): return {"backend": tts_backend.name, "latency": tts_metrics(), "phrase_bank": phrase_bank.metrics()}
+@app.get("/metrics/connections")
+async def get_connection_metrics(): return manager.metrics()
+@app.get("/metrics/static")
+async def get_static_metrics(): return static_assets.metrics()
+@app.get("/metrics/audio")
+async def get_audio_metrics(): return memory_audio_store.metrics() if memory_audio_store else audio_store.metrics()
 app.mount("/static/audio", StaticFiles(directory=AUDIO_DIR), name="static_audio")
 
 @app.websocket("/ws")
@@ -505,17 +585,23 @@ async def websocket_endpoint(websocket: WebSocket): # (변경 없음)
     await manager.connect(websocket)
     try:
         while True:
-            data = await websocket.receive_json(); image_base64 = data.get("image"); user_text = data.get("text", "")
+            data = await manager.receive_json(websocket); image_base64 = data.get("image"); user_text = data.get("text", "")
             current_history = manager.history.get(websocket, [])
-            ai_response_text = await call_ollama_gemma3(image_base64, user_text, current_history)
-            audio_url = await generate_tts(ai_response_text)
-            response_payload = {"type": "response", "ai_text": ai_response_text, "audio_url": audio_url}
-            await manager.send_json(response_payload, websocket)
+            ai_response_text = await manager.run(websocket, call_ollama_gemma3(image_base64, user_text, current_history)) # 연결이 끊기면 즉시 취소
+            if data.get("stream_audio") and tts_backend.streamable: # 텍스트 먼저 전송 후 오디오 청크 스트리밍
+                await manager.send_json({"type": "response", "ai_text": ai_response_text, "audio_url": None}, websocket)
+                if not await manager.run(websocket, stream_tts(ai_response_text, websocket)): # 첫 청크 전에 실패: 예전처럼 파일 URL로 전달
+                    audio_url = await manager.run(websocket, generate_tts(ai_response_text))
+                    if audio_url: await manager.send_json({"type": "audio_url", "audio_url": audio_url}, websocket)
+            else:
+                audio_url = await manager.run(websocket, generate_tts(ai_response_text))
+                response_payload = {"type": "response", "ai_text": ai_response_text, "audio_url": audio_url}
+                await manager.send_json(response_payload, websocket)
     except WebSocketDisconnect: manager.disconnect(websocket); print(f"클라이언트 연결 정상 종료.")
     except Exception as e:
         print(f"WebSocket 오류 ({websocket.client}): {e}")
         error_payload = {"type": "error", "message": f"서버 처리 오류."}
-        await manager.send_json(error_payload, websocket); manager.disconnect(websocket)
+        await manager.send_json(error_payload, websocket); await manager.aclose(websocket)
 
 # --- Uvicorn 실행 (변경 없음) ---
 if __name__ == "__main__":
@@ -523,5 +609,5 @@ if __name__ == "__main__":
     print(f"TTS Voice: {TTS_VOICE}, Ollama Temp: 0.85")
     print(f"오디오 파일 저장 경로: {AUDIO_DIR.resolve()}")
     print("http://localhost:8000 에서 애플리케이션에 접속하세요")
-    uvicorn.run(app, host="0.0.0.0", port=8000)
+    uvicorn.run(app, host="0.0.0.0", port=8000, ws_ping_interval=WS_PING_INTERVAL, ws_ping_timeout=WS_PING_TIMEOUT)
     # 개발 시: uvicorn main:app --reload
@@ -3,11 +3,10 @@
 
 import fastapi
 import uvicorn
-from fastapi import Response, Request, HTTPException, Body, Depends
+from fastapi import Response, Request, HTTPException, Body, Depends, WebSocket, WebSocketDisconnect
 from fastapi.responses import HTMLResponse
 from fastapi.staticfiles import StaticFiles # Still needed for audio files
 import httpx
-import edge_tts
 import asyncio
 import base64
 import os
@@ -16,12 +15,26 @@ import json
 import uuid
 from pathlib import Path
 import re
-from duckduckgo_search import AsyncDDGS
+import heapq
 from contextlib import asynccontextmanager
 import io
 import logging
 from dotenv import load_dotenv
-from typing import Dict, Any, Optional, List, Generator
+from audio_store import AudioStore, MemoryAudioStore
+from static_assets import StaticAssets
+from tts_backends import create_tts_backend, tts_metrics
+from phrase_bank import get_phrase_bank
+from memory_log import MemoryLog
+from sqlite_store import SQLiteStateStore
+from state_locks import StripedLocks
+from memory_index import create_memory_index
+from sse_queue import SSEQueue
+from message_bus import create_message_bus
+from ws_manager import ConnectionManager, pack_frame, unpack_frame
+from search_backends import create_search_backend
+from search_cache import SearchCache, normalize_query
+from page_enricher import PageEnricher
+from typing import Dict, Any, Optional, Generator, Callable
 from pydantic import BaseModel, Field
 from sse_starlette.sse import EventSourceResponse
 
@@ -40,6 +53,8 @@ TTS_VOICE = "en-US-JennyNeural"
 OLLAMA_HOST = os.getenv("OLLAMA_HOST", "http://localhost:11434")
 OLLAMA_API_URL = f"{OLLAMA_HOST}/api/generate"
 PERSONA_NAME = "Aura"
+MAX_HISTORY = 20 # Max conversation turns (user + assistant)
+MAX_MEMORY_ENTRIES = 2000 # Max memory items per user (retrieval is index-based, not a full scan)
 
 # --- Directory & File Setup ---
 try:
@@ -53,10 +68,63 @@ except Exception as e:
     logging.error(f"CRITICAL: Failed to setup directories: {e}", exc_info=True)
 
 # --- In-Memory State Management ---
-client_states: Dict[str, Dict[str, Any]] = {}
-client_state_lock = asyncio.Lock()
-sse_queues: Dict[str, asyncio.Queue] = {}
+client_states: Dict[str, Dict[str, Any]] = {} # Loaded clients only; each one is read from its shard on first use
+client_last_seen: Dict[str, float] = {} # client_id -> time.monotonic() of the last state access
+STATE_IDLE_SECONDS = int(os.getenv("STATE_IDLE_SECONDS", "1800")) # Idle clients are persisted and evicted from memory
+client_locks = StripedLocks(int(os.getenv("STATE_LOCK_STRIPES", "64"))) # Per-client (striped) locks; clients no longer serialize on one global lock
+# Append-only JSONL log of history/memory mutations in front of per-client shard files (aura_memory.shards/)
+# Debounced writer: one write + fsync per MEMORY_FLUSH_INTERVAL seconds or per MEMORY_FLUSH_BATCH records, never two at once
+memory_log = MemoryLog(MEMORY_FILE, max_history=MAX_HISTORY, max_memory=MAX_MEMORY_ENTRIES,
+                       flush_interval=float(os.getenv("MEMORY_FLUSH_INTERVAL", "0.05")), flush_batch=int(os.getenv("MEMORY_FLUSH_BATCH", "256")))
+# STATE_BACKEND=sqlite keeps history/memory in a WAL-mode SQLite file instead of the heap
+STATE_BACKEND = os.getenv("STATE_BACKEND", "memory").lower()
+state_db = SQLiteStateStore(Path(os.getenv("STATE_DB", str(SCRIPT_DIR / "aura_state.db"))), max_history=MAX_HISTORY, max_memory=MAX_MEMORY_ENTRIES) if STATE_BACKEND == "sqlite" else None
+# WEB_CONCURRENCY > 1: N uvicorn workers share sessions through STATE_BACKEND=sqlite, and SSE pushes reach the worker
+# holding the client's /stream over MESSAGE_BUS=unix (host-local hub); MESSAGE_BUS=local is in-process (single worker)
+WORKERS = int(os.getenv("WEB_CONCURRENCY", "1"))
+if WORKERS > 1 and state_db is None: raise RuntimeError("WEB_CONCURRENCY > 1 needs STATE_BACKEND=sqlite (the memory log has a single writer)")
+bus = create_message_bus(SCRIPT_DIR, "unix" if WORKERS > 1 else "local")
+WORKER_ID = str(os.getpid())
+MEMORY_CHANNEL = "memory" # Memory writes: other workers drop their retrieval index for the client
+# Each turn gets the top-k memories for the user text: MEMORY_INDEX=vector (embeddings, MEMORY_EMBEDDER=hashing|ollama) | bm25 (keyword index)
+memory_index = create_memory_index(OLLAMA_HOST, MAX_MEMORY_ENTRIES)
+sse_queues: Dict[str, SSEQueue] = {} # Bounded: "system" coalesces, audio is shed first, "response" is capped (then disconnect)
+SSE_QUEUE_LIMITS = {"max_events": int(os.getenv("SSE_QUEUE_MAX_EVENTS", "256")), "max_bytes": int(os.getenv("SSE_QUEUE_MAX_BYTES", str(4 * 1024 * 1024))),
+                    "max_kept": int(os.getenv("SSE_QUEUE_MAX_RESPONSES", "32"))}
+sse_stats = {"disconnected_behind": 0}
+# /ws/{client_id}: one socket per client carries requests (binary image frames) and pushes; /process + /stream stay as the fallback
+WS_PING_INTERVAL = float(os.getenv("WS_PING_INTERVAL", "20")); WS_PING_TIMEOUT = float(os.getenv("WS_PING_TIMEOUT", "20"))
+ws_connections = ConnectionManager(max_messages=int(os.getenv("WS_QUEUE_MAX_MESSAGES", "512")), max_bytes=int(os.getenv("WS_QUEUE_MAX_BYTES", str(8 * 1024 * 1024))),
+                                   idle_timeout=float(os.getenv("WS_IDLE_TIMEOUT", "900")), send_timeout=float(os.getenv("WS_SEND_TIMEOUT", "30")), binary_frames=True,
+                                   drop_notice={"event": "error", "data": {"message": "Too many messages while busy; an earlier message was dropped."}})
+ws_stats = {"turns": 0, "image_frames": 0, "image_bytes": 0, "bad_frames": 0}
+ws_relays: Dict[str, list] = {} # client_id -> bus handlers of its open sockets (newest last); a live socket owns sse:{client_id}
+# [SEARCH:] results cached by normalized query / region / count; empty results and provider errors for a shorter TTL
+SEARCH_REGION = os.getenv("SEARCH_REGION", "us-en")
+search_backend = create_search_backend(SCRIPT_DIR) # SEARCH_BACKEND=ddg|local (SQLite FTS5 corpus for offline sites / benchmarks)
+# SEARCH_ENRICH=1: fetch result pages (hard deadline) and attach the query-relevant passages to each result
+page_enricher = PageEnricher(deadline=float(os.getenv("SEARCH_ENRICH_DEADLINE", "3.0")), token_budget=int(os.getenv("SEARCH_ENRICH_TOKENS", "600"))) if os.getenv("SEARCH_ENRICH", "0") == "1" else None
+# Same-turn tool loop: max [SEARCH:] executions per user turn before the model must answer with what it has
+MAX_TOOL_ITERATIONS = int(os.getenv("MAX_TOOL_ITERATIONS", "2"))
+tool_stats = {"turns": 0, "searches": 0, "repeat_queries": 0, "budget_exhausted": 0}
+search_cache = SearchCache(max_entries=int(os.getenv("SEARCH_CACHE_SIZE", "512")), ttl=float(os.getenv("SEARCH_CACHE_TTL", "900")),
+                           negative_ttl=float(os.getenv("SEARCH_CACHE_NEGATIVE_TTL", "120")))
 sse_queue_lock = asyncio.Lock()
+sse_streams: Dict[str, int] = {} # client_id -> open /stream connections (queues without one are orphaned)
+SSE_QUEUE_IDLE_SECONDS = int(os.getenv("SSE_QUEUE_IDLE_SECONDS", "300")) # Orphaned queues are dropped after this much client inactivity
+reaper_stats = {"runs": 0, "states_unloaded": 0, "queues_dropped": 0, "messages_dropped": 0, "bytes_reclaimed": 0}
+# Indexed audio store: one periodic janitor evicts by age / total bytes (no per-request directory scans)
+audio_store = AudioStore(AUDIO_DIR, max_age_seconds=int(os.getenv("AUDIO_MAX_AGE_SECONDS", "600")), max_total_bytes=int(os.getenv("AUDIO_MAX_BYTES", str(200 * 1024 * 1024))))
+# Optional RAM-backed store for SD-card devices: clips live in a byte-capped LRU and overflow spills to AUDIO_DIR.
+AUDIO_IN_MEMORY = os.getenv("AUDIO_IN_MEMORY", "0") == "1"
+memory_audio_store = MemoryAudioStore(max_bytes=int(os.getenv("AUDIO_MEMORY_BYTES", str(64 * 1024 * 1024))), spill=audio_store) if AUDIO_IN_MEMORY else None
+tts_backend = create_tts_backend(TTS_VOICE) # TTS_BACKEND=edge|espeak|piper|stub (air-gapped sites / CI benchmarks)
+# Fixed utterances are pre-rendered into a memory-mapped phrase bank at startup and played without a TTS round trip.
+GENERIC_ERROR_MESSAGE = "(Error)"
+OLLAMA_ERROR_MESSAGE = "(Ollama communication error)"
+FIXED_PHRASES = [GENERIC_ERROR_MESSAGE, OLLAMA_ERROR_MESSAGE]
+phrase_bank = get_phrase_bank(tts_backend, TTS_VOICE, SCRIPT_DIR / "phrase_bank")
+tts_backend = phrase_bank.wrap(tts_backend)
 
 # --- System Prompt ---
 SYSTEM_CONTEXT_DESCRIPTION = f"""You are {PERSONA_NAME}, an AI companion interacting via a web browser. You perceive via images provided by the user (webcam, screen share, upload). You have persistent memory, can search the web, and learn from interactions. Your primary language is English. **You CANNOT control the user's computer.** You are an OBSERVER and GUIDE. **Core Directives:** 1. **Analyze Visuals:** Identify source; Describe details vividly. 2. **Converse & Guide:** Respond naturally; Provide step-by-step guidance, DO NOT imply control. 3. **Memory & Learning:** Use memory; Make connections; Reflect on limitations; Suggest `[MEMORIZE: ...]`. 4. **Web Search:** Suggest `[SEARCH: ...]`. 5. **Acknowledge Limits:** Explain inability to control PC. 6. **Persona:** Friendly, observant, curious, helpful guide, aware of limits, eager to learn. 7. **Output:** Visual Description -> Response/Guidance -> Optional ONE `[SEARCH:]` or `[MEMORIZE:]`. """
@@ -270,7 +338,7 @@ document.addEventListener('DOMContentLoaded', () => {
             if(startSttButton) startSttButton.style.display = isRecognizing ? 'none' : 'flex';
 
             // Overall Status Message
-            if (!isSseConnected && eventSource && eventSource.readyState === EventSource.CONNECTING) setStatusMessage("Connecting event stream...");
+            if (!isSseConnected && ((eventSource && eventSource.readyState === EventSource.CONNECTING) || (socket && socket.readyState === WebSocket.CONNECTING))) setStatusMessage("Connecting event stream...");
             else if (!isSseConnected) setStatusMessage("Disconnected. Retrying stream..."); // Or just Disconnected?
             else if (currentSource) setStatusMessage(`Ready - ${currentSource.charAt(0).toUpperCase() + currentSource.slice(1)} active.`);
             else setStatusMessage("Ready - Select input source.");
@@ -308,6 +376,19 @@ document.addEventListener('DOMContentLoaded', () => {
             eventSource.addEventListener("system", (event) => {
                 try { const data = JSON.parse(event.data); logging.debug("SSE 'system' received:", data); addMessage("System", data.message); } catch(e) { logging.error("Error parsing SSE 'system' data:", e); }
             });
+            // Streamed TTS: audio_start -> base64 mp3 audio_chunk events -> audio_end
+            eventSource.addEventListener("audio_start", (event) => {
+                try { const data = JSON.parse(event.data); startAudioStream(data.stream_id, data.mime); } catch(e) { logging.error("Error parsing SSE 'audio_start' data:", e); }
+            });
+            eventSource.addEventListener("audio_chunk", (event) => {
+                try { const data = JSON.parse(event.data); appendAudioChunk(data.stream_id, data.data); } catch(e) { logging.error("Error parsing SSE 'audio_chunk' data:", e); }
+            });
+            eventSource.addEventListener("audio_end", (event) => {
+                try { const data = JSON.parse(event.data); endAudioStream(data.stream_id); } catch(e) { logging.error("Error parsing SSE 'audio_end' data:", e); }
+            });
+            eventSource.addEventListener("audio_url", (event) => { // Streaming failed before any audio: play the whole clip
+                try { const data = JSON.parse(event.data); playTTS(data.audio_url); } catch(e) { logging.error("Error parsing SSE 'audio_url' data:", e); }
+            });
             eventSource.addEventListener("error", (event) => { // Server explicitly sent error event
                 try {
                     if (event.data) { const data = JSON.parse(event.data); logging.error("SSE 'error' event received:", data); addMessage("system warning", `Server Error: ${data.message || 'Unknown error'}`); }
@@ -353,6 +434,63 @@ document.addEventListener('DOMContentLoaded', () => {
          isSseConnected = false; setStatusMessage("Disconnected."); addMessage("System", "Event stream disconnected."); updateUIState();
     }
 
+    // --- WebSocket (primary transport; SSE + POST /process is the fallback for proxies that block upgrades) ---
+    // Binary frames: 4-byte big-endian header length, JSON header, raw payload (user image in, TTS audio out)
+    let socket = null;
+    let useSseFallback = !window.WebSocket;
+    function packFrame(header, payload) {
+        const head = new TextEncoder().encode(JSON.stringify(header));
+        const frame = new Uint8Array(4 + head.length + payload.byteLength);
+        new DataView(frame.buffer).setUint32(0, head.length); frame.set(head, 4); frame.set(new Uint8Array(payload), 4 + head.length);
+        return frame.buffer;
+    }
+    function unpackFrame(buffer) {
+        const size = new DataView(buffer).getUint32(0);
+        return [JSON.parse(new TextDecoder().decode(new Uint8Array(buffer, 4, size))), new Uint8Array(buffer, 4 + size)];
+    }
+    function handleServerEvent(event, data) { // Same events (and handlers) as the SSE stream
+        if (event === 'response') { addMessage("Aura", data.ai_text); if (data.audio_url) playTTS(data.audio_url); }
+        else if (event === 'system') addMessage("System", data.message);
+        else if (event === 'audio_start') startAudioStream(data.stream_id, data.mime);
+        else if (event === 'audio_chunk') appendAudioChunk(data.stream_id, data.data);
+        else if (event === 'audio_end') endAudioStream(data.stream_id);
+        else if (event === 'audio_url') playTTS(data.audio_url);
+        else if (event === 'error') addMessage("system warning", `Server Error: ${data.message || 'Unknown error'}`);
+        else logging.debug(`WebSocket '${event}' received:`, data);
+    }
+    function connectWebSocket() {
+        if (useSseFallback) { connectSSE(); return; }
+        if (socket && (socket.readyState === WebSocket.CONNECTING || socket.readyState === WebSocket.OPEN)) { logging.warn("WebSocket already open or connecting."); return; }
+        const wsUrl = `${location.protocol === 'https:' ? 'wss' : 'ws'}://${location.host}/ws/${getClientId()}`;
+        logging.info(`Connecting WebSocket: ${wsUrl}`);
+        isSseConnected = false; setStatusMessage("Connecting to event stream..."); updateUIState();
+        let opened = false;
+        try { socket = new WebSocket(wsUrl); }
+        catch (error) { logging.error("Error creating WebSocket:", error); socket = null; useSseFallback = true; connectSSE(); return; }
+        socket.binaryType = 'arraybuffer';
+        socket.onopen = () => { opened = true; isSseConnected = true; logging.info("WebSocket connected."); addMessage("System", "Connected to Aura (WebSocket)."); updateUIState(); };
+        socket.onmessage = (event) => {
+            try {
+                if (typeof event.data === 'string') { const message = JSON.parse(event.data); handleServerEvent(message.event, message.data); }
+                else { const [header, payload] = unpackFrame(event.data); if (header.event === 'audio_chunk') appendAudioBytes(header.stream_id, payload); }
+            } catch (e) { logging.error("Error handling WebSocket message:", e); }
+        };
+        socket.onclose = (event) => {
+            socket = null; isSseConnected = false;
+            if (!opened) { logging.warn("WebSocket unavailable; falling back to SSE + HTTP POST."); useSseFallback = true; connectSSE(); return; }
+            logging.warn(`WebSocket closed (${event.code}).`); addMessage("system warning", "Connection lost. Attempting to reconnect..."); updateUIState();
+            setTimeout(connectWebSocket, 5000);
+        };
+    }
+    function disconnectWebSocket() { if (socket) { logging.info("Closing WebSocket."); socket.onclose = null; socket.close(1000); socket = null; } }
+    async function sendOverWebSocket(payload) {
+        const header = { text: payload.text, image_source: payload.image_source, stream_audio: payload.stream_audio };
+        if (!payload.image) { socket.send(JSON.stringify(header)); return; }
+        const image = await (await fetch(payload.image)).arrayBuffer(); // data: URL -> raw bytes (no base64 on the wire)
+        header.mime = payload.image.slice(5, payload.image.indexOf(';'));
+        socket.send(packFrame(header, image));
+    }
+
 
     // --- Input Source Management ---
     async function setActiveSource(sourceType) {
@@ -459,6 +597,7 @@ document.addEventListener('DOMContentLoaded', () => {
      async function sendDataToServer(payload) {
          setStatusMessage("Sending data..."); if(sendButton) sendButton.disabled = true; if(textInput) textInput.disabled = true;
          try {
+             if (socket && socket.readyState === WebSocket.OPEN) { await sendOverWebSocket(payload); logging.info("WebSocket send successful."); setStatusMessage("Processing request..."); return; }
              const response = await fetch("/process", { method: "POST", headers: { "Content-Type": "application/json" }, body: JSON.stringify(payload) });
              if (!response.ok) { let errorMsg = `HTTP ${response.status}`; try { const errData = await response.json(); errorMsg += `: ${errData.detail || response.statusText}`; } catch {} throw new Error(errorMsg); }
              const result = await response.json();
@@ -472,6 +611,46 @@ document.addEventListener('DOMContentLoaded', () => {
     function addMessage(cssClass, text) { if(!chatbox) return; const el = document.createElement('div'); const cl = cssClass.split(' '); cl.forEach(c => el.classList.add(c.trim())); el.classList.add('message'); el.textContent = text; chatbox.appendChild(el); chatbox.scrollTop = chatbox.scrollHeight; }
     function playTTS(audioUrl) { if (ttsAudio && audioUrl) { ttsAudio.src = audioUrl; ttsAudio.play().catch(e => { logging.error("Audio error:", e); addMessage("system warning", e.name === 'NotAllowedError' ? "Audio autoplay blocked." : "Audio playback error."); }); } }
 
+    // --- Streamed TTS (MediaSource) ---
+    const canStreamAudio = !!(window.MediaSource && MediaSource.isTypeSupported('audio/mpeg'));
+    let audioStream = null;
+    function startAudioStream(streamId, mime) {
+        if (!ttsAudio || !canStreamAudio) return;
+        const mediaSource = new MediaSource();
+        const stream = { id: streamId, mediaSource: mediaSource, sourceBuffer: null, queue: [], ended: false };
+        audioStream = stream;
+        ttsAudio.src = URL.createObjectURL(mediaSource);
+        mediaSource.addEventListener('sourceopen', () => {
+            URL.revokeObjectURL(ttsAudio.src);
+            stream.sourceBuffer = mediaSource.addSourceBuffer(mime || 'audio/mpeg');
+            stream.sourceBuffer.addEventListener('updateend', () => flushAudioStream(stream));
+            flushAudioStream(stream);
+        }, { once: true });
+        ttsAudio.play().catch(e => { logging.error("Audio error:", e); addMessage("system warning", e.name === 'NotAllowedError' ? "Audio autoplay blocked." : "Audio playback error."); });
+    }
+    function appendAudioChunk(streamId, chunkB64) {
+        if (!audioStream || audioStream.id !== streamId) return;
+        const binary = atob(chunkB64); const bytes = new Uint8Array(binary.length);
+        for (let i = 0; i < binary.length; i++) bytes[i] = binary.charCodeAt(i);
+        appendAudioBytes(streamId, bytes);
+    }
+    function appendAudioBytes(streamId, bytes) { // WebSocket binary frames arrive already decoded
+        if (!audioStream || audioStream.id !== streamId) return;
+        audioStream.queue.push(bytes); flushAudioStream(audioStream);
+    }
+    function flushAudioStream(stream) {
+        const sourceBuffer = stream.sourceBuffer;
+        if (!sourceBuffer || sourceBuffer.updating) return;
+        try {
+            if (stream.queue.length > 0) { sourceBuffer.appendBuffer(stream.queue.shift()); return; }
+            if (stream.ended && stream.mediaSource.readyState === 'open') stream.mediaSource.endOfStream();
+        } catch (e) { logging.error("Audio stream append error:", e); }
+    }
+    function endAudioStream(streamId) {
+        if (!audioStream || audioStream.id !== streamId) return;
+        audioStream.ended = true; flushAudioStream(audioStream); audioStream = null;
+    }
+
     // --- STT ---
      const SpeechRecognition = window.SpeechRecognition || window.webkitSpeechRecognition; let recognition = null;
      if (SpeechRecognition) {
@@ -491,7 +670,7 @@ document.addEventListener('DOMContentLoaded', () => {
          if (text) addMessage("User", text);
          textInput.value = ""; const frameDataUrl = captureFrame();
          if (currentSource && !frameDataUrl && currentSource !== 'upload') { addMessage("system warning", `(Frame capture failed for ${currentSource})`); }
-         const payload = { client_id: getClientId(), text: text, image: frameDataUrl, image_source: currentSource || 'none' };
+         const payload = { client_id: getClientId(), text: text, image: frameDataUrl, image_source: currentSource || 'none', stream_audio: canStreamAudio };
          await sendDataToServer(payload); textInput.focus();
      }
 
@@ -507,12 +686,12 @@ document.addEventListener('DOMContentLoaded', () => {
 
     // --- Init ---
      getClientId(); // Ensure client ID exists
-     connectSSE(); // Connect to SSE stream automatically
+     connectWebSocket(); // WebSocket first; falls back to the SSE stream if the upgrade fails
      updateUIState(); // Initial UI setup
      addMessage("System", "Connecting to Aura... Select input source when ready.");
-     window.addEventListener('beforeunload', () => { disconnectSSE(); }); // Disconnect SSE on close
+     window.addEventListener('beforeunload', () => { disconnectWebSocket(); disconnectSSE(); }); // Disconnect on close
 
-     logging.info("Aura frontend initialized (SSE Mode).");
+     logging.info("Aura frontend initialized (WebSocket / SSE Mode).");
 });
 // --- End of JAVASCRIPT_CONTENT ---
 """
@@ -523,164 +702,234 @@ async def lifespan(app: fastapi.FastAPI):
     logging.info("Application initializing...")
     app.state.http_client = httpx.AsyncClient(timeout=90.0)
     app.state.ddgs_client = httpx.AsyncClient(timeout=15.0)
-    await load_memory_from_json()
+    await bus.start(); bus.subscribe(MEMORY_CHANNEL, _on_memory_changed)
+    await load_memory()
+    await search_backend.start(); await memory_index.start() # Probes the embedder once
+    app.state.idle_reaper = asyncio.create_task(_idle_reaper())
+    audio_store.start_janitor()
+    app.state.phrase_bank_task = asyncio.create_task(phrase_bank.ensure(tts_backend, FIXED_PHRASES)) # Startup does not wait on synthesis
     logging.info("Application initialized.")
     yield
     logging.info("Application shutting down...")
     await asyncio.gather(app.state.http_client.aclose(), app.state.ddgs_client.aclose())
-    await save_memory_to_json()
+    await audio_store.stop_janitor()
+    app.state.idle_reaper.cancel(); app.state.phrase_bank_task.cancel()
+    await bus.close()
+    await memory_log.close() # Flush + compact into the client shards
+    if state_db is not None: await state_db.close()
+    await memory_index.aclose(); await search_backend.aclose()
+    if page_enricher is not None: await page_enricher.aclose()
     logging.info("Application shutdown complete.")
 
 app = fastapi.FastAPI(lifespan=lifespan)
 
 
-# --- JSON Memory Functions (Corrected Syntax) ---
-async def load_memory_from_json():
-    global client_states
-    async with client_state_lock: # Corrected line
-        if MEMORY_FILE.exists():
-            try:
-                with open(MEMORY_FILE, 'r', encoding='utf-8') as f:
-                    content = f.read()
-                    if not content: client_states = {}; logging.warning(f"Memory file {MEMORY_FILE} empty.")
-                    else: client_states = json.loads(content)
-                logging.info(f"Memory/States loaded from {MEMORY_FILE}")
-            except json.JSONDecodeError as e: logging.error(f"JSON decode error loading {MEMORY_FILE}: {e}. Starting fresh.", exc_info=True); client_states = {}
-            except IOError as e: logging.error(f"IO error loading {MEMORY_FILE}: {e}. Starting fresh.", exc_info=True); client_states = {}
-            except Exception as e: logging.error(f"Unexpected error loading state from {MEMORY_FILE}: {e}. Starting fresh.", exc_info=True); client_states = {}
-        else:
-            logging.warning("Memory file not found. Starting fresh."); client_states = {}
-
-async def save_memory_to_json():
-    async with client_state_lock: current_state_copy = client_states.copy()
-    try: await asyncio.to_thread(_save_memory_sync_internal, current_state_copy)
-    except Exception as e: logging.error(f"Error saving state: {e}", exc_info=True)
-
-def _save_memory_sync_internal(state_to_save: dict):
-     try:
-         with open(MEMORY_FILE, 'w', encoding='utf-8') as f:
-             data_to_save = {}
-             for client_id, state in list(state_to_save.items()):
-                 if isinstance(state, dict): data_to_save[client_id] = { "history": state.get("history", []), "memory": state.get("memory", []) }
-                 else: logging.warning(f"Skipping invalid state for {client_id} during save.")
-             json.dump(data_to_save, f, ensure_ascii=False, indent=4)
-         logging.debug(f"State saved to {MEMORY_FILE}")
-     except Exception as e: logging.error(f"ERROR (Sync Save Thread): Failed saving state: {e}", exc_info=True)
+# --- Memory Persistence (per-client shards + append-only log) ---
+async def load_memory():
+    if state_db is not None:
+        if await asyncio.to_thread(state_db.start) and bus.is_hub and memory_log.has_data(): # First SQLite start: migrate shards + log (one worker)
+            await state_db.import_states(await asyncio.to_thread(memory_log.recover))
+        return
+    memory_log.start(lambda: client_states) # Opens in the background: startup does not read any client's state
+
+async def _client_state(client_id: str) -> dict:
+    """Returns the client's state, loading it on first use (creating/repairing). Caller holds client_locks.hold(client_id)."""
+    state = client_states.get(client_id)
+    if state is None: state = client_states[client_id] = await memory_log.load_client(client_id) if state_db is None else {}
+    client_last_seen[client_id] = time.monotonic()
+    state.setdefault("history", []); state.setdefault("memory", [])
+    if not isinstance(state.get('history'), list): state['history'] = []
+    if not isinstance(state.get('memory'), list): state['memory'] = []
+    return state
 
 async def _ensure_client_state(client_id: str):
-     async with client_state_lock: # Corrected line
-        state = client_states.setdefault(client_id, { "history": [], "memory": [], "pending_search_results": None })
-        state.setdefault("history", []); state.setdefault("memory", []); state.setdefault("pending_search_results", None)
-        if not isinstance(state.get('history'), list): state['history'] = []
-        if not isinstance(state.get('memory'), list): state['memory'] = []
+    async with client_locks.hold(client_id): await _client_state(client_id)
+
+async def unload_client_state(client_id: str, idle_since: Optional[float] = None) -> int:
+    """Persists and evicts a loaded client's state; it is read back from its shard on next use.
+    With idle_since, clients touched after that time (time.monotonic()) are kept.
+    Returns the approximate bytes freed (0 if nothing was unloaded)."""
+    async with client_locks.hold(client_id):
+        state = client_states.get(client_id)
+        if state is None: client_last_seen.pop(client_id, None); return 0
+        if idle_since is not None and client_last_seen.get(client_id, 0.0) >= idle_since: return 0
+        if state_db is None and not await memory_log.unload(client_id, state): return 0
+        del client_states[client_id]; client_last_seen.pop(client_id, None)
+    memory_index.forget(client_id)
+    return _approx_bytes(state)
 
 async def add_memory_entry(client_id: str, memory_type: str, content: str, key: str | None = None):
-    await _ensure_client_state(client_id)
-    async with client_state_lock: # Corrected line
-        new_entry = { "type": memory_type, "content": content, "key": key, "timestamp": time.strftime("%Y-%m-%d %H:%M:%S") }
+    new_entry = { "type": memory_type, "content": content, "key": key, "timestamp": time.strftime("%Y-%m-%d %H:%M:%S") }
+    if state_db is not None:
+        await state_db.add_memory(client_id, new_entry)
+        logging.info(f"Memory added for {client_id}: [{memory_type}] {content[:50]}...")
+        await memory_index.add(client_id, new_entry)
+        if bus.shared: await bus.publish(MEMORY_CHANNEL, {"client_id": client_id, "origin": WORKER_ID})
+        return
+    async with client_locks.hold(client_id):
+        await _client_state(client_id)
         mem_list = client_states.get(client_id, {}).get("memory", [])
         if isinstance(mem_list, list):
             mem_list.append(new_entry)
-            max_mem_entries = 50
-            if len(mem_list) > max_mem_entries: client_states[client_id]["memory"] = mem_list[-max_mem_entries:]
+            if len(mem_list) > MAX_MEMORY_ENTRIES: client_states[client_id]["memory"] = mem_list[-MAX_MEMORY_ENTRIES:]
+            memory_log.append("memory", client_id, entry=new_entry) # O(entry) append, fsync batched by the log writer
             logging.info(f"Memory added for {client_id}: [{memory_type}] {content[:50]}...")
-        else: logging.error(f"Memory for {client_id} not a list.")
-    asyncio.create_task(save_memory_to_json())
+        else: logging.error(f"Memory for {client_id} not a list."); return
+    await memory_index.add(client_id, new_entry) # Index outside the lock (embedding is a network round trip)
+
+async def _on_memory_changed(channel: str, message: dict):
+    if message.get("origin") != WORKER_ID: memory_index.forget(message["client_id"]) # Rebuilt from the shared store on next search
+
+def _history_turns(*turns: dict) -> list[dict]:
+    return [{"role": str(turn['role']).lower(), "content": turn['content']} for turn in turns if turn and isinstance(turn, dict) and 'role' in turn and 'content' in turn]
 
 async def update_client_history(client_id: str, user_turn: dict, ai_turn: dict):
-     await _ensure_client_state(client_id)
-     async with client_state_lock: # Corrected line
+     if state_db is not None: await state_db.add_turns(client_id, _history_turns(user_turn, ai_turn)); return
+     async with client_locks.hold(client_id):
+        await _client_state(client_id)
         state = client_states.setdefault(client_id, {})
         history = state.setdefault("history", [])
         if isinstance(history, list):
-            if user_turn and isinstance(user_turn, dict) and 'role' in user_turn and 'content' in user_turn: history.append({"role": str(user_turn['role']).lower(), "content": user_turn['content']})
-            if ai_turn and isinstance(ai_turn, dict) and 'role' in ai_turn and 'content' in ai_turn: history.append({"role": str(ai_turn['role']).lower(), "content": ai_turn['content']})
-            max_hist_len = 20
-            if len(history) > max_hist_len: state["history"] = history[-max_hist_len:]
+            turns = _history_turns(user_turn, ai_turn)
+            history.extend(turns)
+            if turns: memory_log.append("history", client_id, turns=turns)
+            if len(history) > MAX_HISTORY: state["history"] = history[-MAX_HISTORY:]
         else: logging.error(f"History for {client_id} not a list.")
-     # asyncio.create_task(save_memory_to_json())
 
 async def get_client_history(client_id: str) -> list[dict]:
-    await _ensure_client_state(client_id)
-    async with client_state_lock: # Corrected line
+    if state_db is not None: return await state_db.get_history(client_id)
+    async with client_locks.hold(client_id):
+        await _client_state(client_id)
         return client_states.get(client_id, {}).get("history", [])
 
-async def get_recent_memories(client_id: str, limit: int = 7) -> list[dict]:
-    await _ensure_client_state(client_id)
-    async with client_state_lock: # Corrected line
-        all_memory = client_states.get(client_id, {}).get("memory", [])
-        if not isinstance(all_memory, list): logging.warning(f"Memory for {client_id} not list."); return []
-        try:
-            valid_memory = [m for m in all_memory if isinstance(m, dict) and 'timestamp' in m]
-            sorted_memories = sorted(valid_memory, key=lambda x: x.get('timestamp', ''), reverse=True)
-        except Exception as e: logging.warning(f"Sort memory error {client_id}: {e}."); sorted_memories = valid_memory
-        return sorted_memories[:limit]
-
-
-async def get_pending_search_results(client_id: str) -> Optional[List[Dict]]:
-     await _ensure_client_state(client_id)
-     async with client_state_lock: # Corrected line
-         state = client_states.get(client_id, {})
-         results = state.get("pending_search_results")
-         if state: state["pending_search_results"] = None # Clear after retrieving
-         return results
+def _recent_memories(client_id: str, all_memory: list, limit: int) -> list[dict]:
+    if not isinstance(all_memory, list): logging.warning(f"Memory for {client_id} not list."); return []
+    try:
+        valid_memory = [m for m in all_memory if isinstance(m, dict) and 'timestamp' in m]
+        sorted_memories = heapq.nlargest(limit, valid_memory, key=lambda x: x.get('timestamp', '')) # O(n log k), memory lists can be long
+    except Exception as e: logging.warning(f"Sort memory error {client_id}: {e}."); sorted_memories = valid_memory
+    return sorted_memories[:limit]
 
-async def set_pending_search_results(client_id: str, results: List[Dict]):
-     await _ensure_client_state(client_id)
-     async with client_state_lock: # Corrected line
-         client_states.setdefault(client_id, {})["pending_search_results"] = results
-         logging.debug(f"Stored pending search results for {client_id}")
+async def get_recent_memories(client_id: str, limit: int = 7) -> list[dict]:
+    if state_db is not None: return await state_db.get_recent_memories(client_id, limit) # Indexed (client_id, timestamp) scan
+    async with client_locks.hold(client_id):
+        return _recent_memories(client_id, (await _client_state(client_id))["memory"], limit)
+
+async def load_turn_context(client_id: str, query: str = "", memory_limit: int = 5) -> tuple[list[dict], list[dict]]:
+    """History and memories for one turn, both from one snapshot: one critical section
+    (or one SQLite read transaction), and memory_index ranks the memory list read there rather than re-reading it.
+    Memories are the top-k for `query` from memory_index; recency is the fallback (no query / no match)."""
+    async with client_locks.hold(client_id):
+        state = await _client_state(client_id)
+        if state_db is None: history, all_memory = list(state["history"]), list(state["memory"])
+    if state_db is not None: history, all_memory = await state_db.get_turn_context(client_id)
+    memories = await memory_index.search(client_id, query, memory_limit, all_memory)
+    return history, memories if memories is not None else _recent_memories(client_id, all_memory, memory_limit)
 
 
 # --- SSE Queue Management ---
 # ... (Unchanged) ...
 async def add_sse_queue(client_id: str):
     async with sse_queue_lock:
-        if client_id not in sse_queues: sse_queues[client_id] = asyncio.Queue(); logging.info(f"SSE queue created: {client_id}")
-async def remove_sse_queue(client_id: str):
+        if client_id not in sse_queues or sse_queues[client_id].closed: sse_queues[client_id] = SSEQueue(**SSE_QUEUE_LIMITS); logging.info(f"SSE queue created: {client_id}")
+        if not ws_relays.get(client_id): bus.subscribe(f"sse:{client_id}", _deliver_sse) # A /process POST must not take the channel from an open socket
+async def remove_sse_queue(client_id: str, queue: Optional[SSEQueue] = None):
     async with sse_queue_lock:
-        if client_id in sse_queues: del sse_queues[client_id]; logging.info(f"SSE queue removed: {client_id}")
+        if client_id in sse_queues and not sse_streams.get(client_id) and (queue is None or sse_queues[client_id] is queue):
+            del sse_queues[client_id]; bus.unsubscribe(f"sse:{client_id}", _deliver_sse); logging.info(f"SSE queue removed: {client_id}")
 async def push_sse_message(client_id: str, message: Dict):
-    queue: Optional[asyncio.Queue] = None
+    """Publishes to the client's channel: delivered by whichever worker holds its SSE queue."""
+    if not await bus.publish(f"sse:{client_id}", message): logging.warning(f"Push to non-existent queue: {client_id}")
+async def _deliver_sse(channel: str, message: Dict):
+    client_id = channel[len("sse:"):]; queue: Optional[SSEQueue] = None
     async with sse_queue_lock: queue = sse_queues.get(client_id)
     if queue:
-        try: await queue.put(message); logging.debug(f"Pushed SSE for {client_id}: {message.get('event')}")
-        except Exception as e: logging.error(f"Push to queue failed {client_id}: {e}")
-    else: logging.warning(f"Push to non-existent queue: {client_id}")
-
-# --- Helper Functions (TTS, Cleanup, Web Search, Command Extraction) ---
+        if queue.put(message): logging.debug(f"Pushed SSE for {client_id}: {message.get('event')}")
+        else: # Hopelessly behind: the queue released its backlog; drop it so the reconnect starts fresh
+            logging.warning(f"SSE client {client_id} too far behind ({queue.close_reason}), disconnecting.")
+            async with sse_queue_lock:
+                if sse_queues.get(client_id) is queue: del sse_queues[client_id]; bus.unsubscribe(channel, _deliver_sse); sse_stats["disconnected_behind"] += 1
+
+# --- Idle Reaper ---
+def _approx_bytes(obj: Any) -> int:
+    return len(json.dumps(obj, ensure_ascii=False, default=str).encode("utf-8"))
+
+async def reap_idle_clients() -> Dict[str, int]:
+    """Drops orphaned SSE queues (no open stream, client idle for SSE_QUEUE_IDLE_SECONDS) and unloads
+    client state idle for STATE_IDLE_SECONDS. Returns what this pass reclaimed."""
+    now = time.monotonic(); queue_cutoff = now - SSE_QUEUE_IDLE_SECONDS; state_cutoff = now - STATE_IDLE_SECONDS
+    reclaimed = {"queues_dropped": 0, "messages_dropped": 0, "states_unloaded": 0, "bytes_reclaimed": 0}
+    async with sse_queue_lock:
+        for client_id in [cid for cid in sse_queues if not sse_streams.get(cid) and client_last_seen.get(cid, 0.0) < queue_cutoff]:
+            queue = sse_queues.pop(client_id); bus.unsubscribe(f"sse:{client_id}", _deliver_sse)
+            reclaimed["messages_dropped"] += queue.qsize(); reclaimed["bytes_reclaimed"] += queue.pending_bytes
+            reclaimed["queues_dropped"] += 1; queue.close("idle")
+    for client_id in [cid for cid, seen in list(client_last_seen.items()) if seen < state_cutoff and cid not in sse_queues]:
+        try: freed = await unload_client_state(client_id, idle_since=state_cutoff)
+        except Exception as e: logging.error(f"Unload of {client_id} failed: {e}", exc_info=True); continue
+        if freed: reclaimed["states_unloaded"] += 1; reclaimed["bytes_reclaimed"] += freed
+    for key, value in reclaimed.items(): reaper_stats[key] += value
+    reaper_stats["runs"] += 1
+    return reclaimed
+
+async def _idle_reaper(interval: float = 60.0):
+    while True:
+        await asyncio.sleep(interval)
+        try: reclaimed = await reap_idle_clients()
+        except Exception as e: logging.error(f"Idle reaper failed: {e}", exc_info=True); continue
+        if reclaimed["queues_dropped"] or reclaimed["states_unloaded"]:
+            logging.info(f"Reaped {reclaimed['queues_dropped']} orphaned queues ({reclaimed['messages_dropped']} messages) and {reclaimed['states_unloaded']} idle client states, ~{reclaimed['bytes_reclaimed']} bytes; {len(client_states)} clients loaded.")
+
+# --- Helper Functions (TTS, Web Search, Command Extraction) ---
 # ... (Unchanged) ...
 async def generate_tts(text: str) -> str | None:
     text_for_tts = re.sub(r"\[(SEARCH|MEMORIZE):.*?\]", "", text).strip()
     if not text_for_tts: return None
     try:
-        output_filename=f"aura_tts_{uuid.uuid4()}.mp3"; output_path = AUDIO_DIR / output_filename
-        communicate = edge_tts.Communicate(text_for_tts, TTS_VOICE)
-        await communicate.save(str(output_path))
-        audio_url = f"/static/audio/{output_filename}"; asyncio.create_task(cleanup_old_audio_files(max_age_seconds=600)); return audio_url
+        if memory_audio_store is not None: # RAM-backed mode: no file write, clip served from /audio/{name}
+            audio = await tts_backend.synthesize(text_for_tts)
+            return await memory_audio_store.put(audio, suffix=tts_backend.suffix) if audio else None
+        output_path = audio_store.new_path(suffix=tts_backend.suffix)
+        audio = await tts_backend.synthesize(text_for_tts)
+        if not audio: return None
+        await asyncio.to_thread(output_path.write_bytes, audio)
+        return audio_store.add(output_path, size=len(audio))
     except Exception as e: logging.error(f"TTS Error: {e}", exc_info=True); return None
-async def cleanup_old_audio_files(max_age_seconds: int):
-     try:
-        now = time.time(); removed_count = 0
-        if not AUDIO_DIR.exists(): return
-        for filename in os.listdir(AUDIO_DIR):
-            if filename.endswith(".mp3"):
-                file_path = AUDIO_DIR / filename
-                try:
-                    if os.path.isfile(file_path):
-                        if now - file_path.stat().st_mtime > max_age_seconds: os.remove(file_path); removed_count += 1
-                except OSError as e: logging.warning(f"Error removing audio {file_path}: {e}")
-        if removed_count > 0: logging.debug(f"Cleaned {removed_count} audio files.")
-     except Exception as e: logging.error(f"Audio cleanup error: {e}", exc_info=True)
-async def perform_web_search(query: str, http_client: httpx.AsyncClient, num_results: int = 3) -> list[dict]:
+async def stream_tts_sse(client_id: str, text: str) -> bool:
+    """Relays TTS audio chunks over SSE as they are synthesized (no mp3 file, no second HTTP fetch)."""
+    text_for_tts = re.sub(r"\[(SEARCH|MEMORIZE):.*?\]", "", text).strip()
+    if not text_for_tts: return False
+    stream_id = uuid.uuid4().hex; started = False
+    try:
+        async for data in tts_backend.stream(text_for_tts):
+            if not started:
+                await push_sse_message(client_id, {"event": "audio_start", "stream_id": stream_id, "data": json.dumps({"stream_id": stream_id, "mime": tts_backend.media_type})}); started = True
+            chunk_b64 = base64.b64encode(data).decode("ascii")
+            await push_sse_message(client_id, {"event": "audio_chunk", "stream_id": stream_id, "data": json.dumps({"stream_id": stream_id, "data": chunk_b64})})
+        return started
+    except Exception as e: logging.error(f"TTS stream error: {e}", exc_info=True); return started
+    finally:
+        if started: await push_sse_message(client_id, {"event": "audio_end", "stream_id": stream_id, "data": json.dumps({"stream_id": stream_id})})
+async def push_response_with_audio(client_id: str, response_payload: dict, stream_audio: bool):
+    """Text goes out immediately; audio follows as SSE chunks, or as a saved-file URL for clients without MediaSource."""
+    if stream_audio and tts_backend.streamable: # WAV backends fall back to a clip URL
+        await push_sse_message(client_id, {"event": "response", "data": json.dumps(response_payload)})
+        if not await stream_tts_sse(client_id, response_payload["ai_text"]): # Failed before the first chunk: send the clip URL as before
+            audio_url = await generate_tts(response_payload["ai_text"])
+            if audio_url: await push_sse_message(client_id, {"event": "audio_url", "data": json.dumps({"audio_url": audio_url})})
+    else:
+        response_payload["audio_url"] = await generate_tts(response_payload["ai_text"])
+        await push_sse_message(client_id, {"event": "response", "data": json.dumps(response_payload)})
+async def _search_and_enrich(query: str, http_client: httpx.AsyncClient, num_results: int, region: str) -> list[dict]:
+    results = await search_backend.search(query, num_results, region, http_client)
+    if page_enricher is not None and results: results = await page_enricher.enrich(query, results) # The cache stores enriched results
+    return results
+
+async def perform_web_search(query: str, http_client: httpx.AsyncClient, num_results: int = 3, region: str = SEARCH_REGION) -> list[dict]:
     logging.info(f"Performing web search: {query}")
-    results = []
     try:
-        async with AsyncDDGS(client=http_client) as ddgs: search_results = await ddgs.text(query, region="us-en", max_results=num_results)
-        if not search_results: logging.warning("No search results."); return []
-        for i, r in enumerate(search_results):
-            if r.get('body'): results.append({ "title": r.get('title','NT'), "snippet": r.get('body','NS'), "url": r.get('href','#') })
-            if len(results) >= num_results: break
+        results = await search_cache.get_or_fetch(query, region, num_results, lambda: _search_and_enrich(query, http_client, num_results, region))
+        if not results: logging.warning("No search results."); return []
         logging.info(f"Search completed: {len(results)} results.")
         return results
     except Exception as e: logging.error(f"Web search error: {e}", exc_info=True); return []
@@ -696,18 +945,19 @@ def extract_commands(text: str) -> tuple[str, str | None, str | None]:
 async def call_ollama_granite_vision_browser(
     http_client: httpx.AsyncClient, user_id: str, image_base64: str | None,
     image_source: str, text: str, history: list[dict],
-    web_search_results: list[dict] | None = None
+    web_search_results: list[dict] | None = None, memories: list[dict] | None = None, allow_search: bool = True
 ) -> tuple[str, str | None, str | None]: # text, search, memorize
     prompt_parts = []; prompt_parts.append("<|start_of_role|>system<|end_of_role|>\n" + SYSTEM_CONTEXT_DESCRIPTION)
     source_text = f"Image from user's {image_source}" if image_source != 'none' else "None (Text chat only)"
     prompt_parts.append(f"<|start_of_role|>system<|end_of_role|>\n**Current Visual Input Source:** {source_text}.")
-    recent_mems = await get_recent_memories(user_id, limit=5) # Use corrected helper
+    recent_mems = memories if memories is not None else await get_recent_memories(user_id, limit=5) # Use corrected helper
     if recent_mems:
         memory_context = "**Relevant Memories:**\n" + "\n".join([f"- [{m.get('type','N/A').upper()} @ {m.get('timestamp','N/A')}]: {m.get('content','')}" for m in reversed(recent_mems)])
         prompt_parts.append("<|start_of_role|>system<|end_of_role|>\n" + memory_context)
-    if web_search_results:
-        search_context = "**Web Search Results:**\n" + ("\n".join([f"{i+1}. {r.get('title','')}: {r.get('snippet','')}" for i,r in enumerate(web_search_results)]) if web_search_results else "- (No results)") + "\n**Use these results.**"
+    if web_search_results is not None: # [] = searched, nothing found: say so, or the model re-issues the query
+        search_context = "**Web Search Results:**\n" + ("\n".join([f"{i+1}. {r.get('title','')}: {r.get('snippet','')}" + (f"\n   {r['content']}" if r.get('content') else "") for i,r in enumerate(web_search_results)]) if web_search_results else "- (No results)") + "\n**Use these results.**"
         prompt_parts.append("<|start_of_role|>system<|end_of_role|>\n" + search_context)
+    if not allow_search: prompt_parts.append("<|start_of_role|>system<|end_of_role|>\n**Search budget used up for this turn: answer now without `[SEARCH:]`.**")
     for turn in history:
         role = turn.get('role', 'user').lower(); content = turn.get('content', '')
         content_str = str(content) if content is not None else ""
@@ -717,11 +967,11 @@ async def call_ollama_granite_vision_browser(
     prompt_parts.append(f"<|start_of_role|>user<|end_of_role|>\n{user_content}")
     prompt_parts.append("<|start_of_role|>assistant<|end_of_role|>")
     full_prompt = "\n".join(prompt_parts)
-    payload = { "model": MODEL_NAME, "prompt": full_prompt, "stream": False, "options": { "num_predict": 350, "temperature": 0.2, "stop": ["<|end_of_role|>", "[SEARCH:", "[MEMORIZE:"] } }
+    payload = { "model": MODEL_NAME, "prompt": full_prompt, "stream": False, "options": { "num_predict": 350, "temperature": 0.2, "stop": ["<|end_of_role|>", "[MEMORIZE:"] } }
     if image_base64:
         try: img_data = image_base64.split(",", 1)[1]; payload["images"] = [img_data]; logging.debug(f"Image data ({image_source}) included.")
         except Exception as e: logging.warning(f"Image processing error ({image_source}): {e}. Text only.")
-    ai_response_text = "(Error)"; search_query_out = None; memory_content_out = None
+    ai_response_text = GENERIC_ERROR_MESSAGE; search_query_out = None; memory_content_out = None
     try:
         logging.info(f"Sending to Ollama (Model: {MODEL_NAME}, Source: {image_source}, Text: '{user_content[:30]}...', Image: {'Y' if image_base64 else 'N'})")
         start_time = time.time(); response = await http_client.post(OLLAMA_API_URL, json=payload); response.raise_for_status()
@@ -737,7 +987,7 @@ async def call_ollama_granite_vision_browser(
         if memory_content_out:
              logging.info(f"Intent: Memorize '{memory_content_out}'")
         # <<< END FIX >>>
-    except Exception as e: import traceback; logging.error(f"Ollama call failed: {e}"); traceback.print_exc(); ai_response_text = "(Ollama communication error)"
+    except Exception as e: import traceback; logging.error(f"Ollama call failed: {e}"); traceback.print_exc(); ai_response_text = OLLAMA_ERROR_MESSAGE
     return ai_response_text, search_query_out, memory_content_out
 
 
@@ -747,31 +997,88 @@ async def lifespan(app: fastapi.FastAPI):
     logging.info("Application initializing...")
     app.state.http_client = httpx.AsyncClient(timeout=90.0)
     app.state.ddgs_client = httpx.AsyncClient(timeout=15.0)
-    await load_memory_from_json()
+    await bus.start(); bus.subscribe(MEMORY_CHANNEL, _on_memory_changed)
+    await load_memory()
+    await search_backend.start(); await memory_index.start() # Probes the embedder once
+    app.state.idle_reaper = asyncio.create_task(_idle_reaper())
+    audio_store.start_janitor()
+    app.state.phrase_bank_task = asyncio.create_task(phrase_bank.ensure(tts_backend, FIXED_PHRASES)) # Startup does not wait on synthesis
     logging.info("Application initialized.")
     yield
     logging.info("Application shutting down...")
     await asyncio.gather(app.state.http_client.aclose(), app.state.ddgs_client.aclose())
-    await save_memory_to_json()
+    await audio_store.stop_janitor()
+    app.state.idle_reaper.cancel(); app.state.phrase_bank_task.cancel()
+    await bus.close()
+    await memory_log.close() # Flush + compact into the client shards
+    if state_db is not None: await state_db.close()
+    await memory_index.aclose(); await search_backend.aclose()
+    if page_enricher is not None: await page_enricher.aclose()
     logging.info("Application shutdown complete.")
 
 app = fastapi.FastAPI(lifespan=lifespan)
 
+# Inline assets: hashed + gzip/brotli-compressed once at startup; fingerprinted URLs are cached as immutable
+static_assets = StaticAssets()
+static_assets.add("style.css", CSS_CONTENT, "text/css; charset=utf-8")
+static_assets.add("main.js", JAVASCRIPT_CONTENT, "application/javascript; charset=utf-8")
+static_assets.add_page("index.html", HTML_CONTENT, {"/static/css/style.css": "style.css", "/static/js/main.js": "main.js"})
+
 # --- API Endpoints ---
 @app.get("/", response_class=HTMLResponse)
-async def get_root_html():
+async def get_root_html(request: Request):
     # logging.debug("Serving root HTML.")
-    return HTMLResponse(content=HTML_CONTENT)
+    return static_assets.response("index.html", request.headers)
 
 @app.get("/static/css/style.css", response_class=Response)
-async def get_inline_css():
+async def get_inline_css(request: Request):
      # logging.debug("Serving inline CSS.")
-     return Response(content=CSS_CONTENT, media_type="text/css")
+     return static_assets.response("style.css", request.headers)
 
 @app.get("/static/js/main.js", response_class=Response)
-async def get_inline_js():
+async def get_inline_js(request: Request):
     # logging.debug("Serving inline JavaScript.")
-    return Response(content=JAVASCRIPT_CONTENT, media_type="application/javascript")
+    return static_assets.response("main.js", request.headers)
+
+@app.get("/static/assets/{filename}", response_class=Response)
+async def get_static_asset(filename: str, request: Request):
+    return static_assets.fingerprinted_response(filename, request.headers)
+
+@app.get("/audio/{name}")
+async def get_memory_audio(name: str, request: Request):
+    if memory_audio_store is None: raise HTTPException(status_code=404)
+    return await memory_audio_store.response(name, request.headers)
+
+@app.get("/metrics/tts")
+async def get_tts_metrics():
+    return {"backend": tts_backend.name, "latency": tts_metrics(), "phrase_bank": phrase_bank.metrics()}
+
+@app.get("/metrics/clients")
+async def get_client_metrics():
+    deepest = sorted(sse_queues.items(), key=lambda item: item[1].qsize(), reverse=True)[:10]
+    return {"worker": WORKER_ID, "bus": bus.metrics(), "loaded_clients": len(client_states), "sse_queues": len(sse_queues), "sse_streams": sum(sse_streams.values()),
+            "queued_messages": sum(q.qsize() for q in sse_queues.values()), "queued_bytes": sum(q.pending_bytes for q in sse_queues.values()),
+            "deepest_queues": {cid: q.metrics() for cid, q in deepest}, "sse": sse_stats, "ws": {**ws_stats, **ws_connections.metrics()}, "reaper": reaper_stats}
+
+@app.get("/metrics/search")
+async def get_search_metrics():
+    return {**search_cache.stats(), "backend": search_backend.metrics(), "enrich": page_enricher.metrics() if page_enricher else None, "tool_loop": {**tool_stats, "max_iterations": MAX_TOOL_ITERATIONS}}
+
+@app.get("/metrics/locks")
+async def get_lock_metrics():
+    return client_locks.metrics()
+
+@app.get("/metrics/memory")
+async def get_memory_metrics():
+    return {**(state_db.metrics() if state_db is not None else memory_log.metrics()), "loaded_clients": len(client_states), "index": memory_index.metrics()}
+
+@app.get("/metrics/static")
+async def get_static_metrics():
+    return static_assets.metrics()
+
+@app.get("/metrics/audio")
+async def get_audio_metrics():
+    return memory_audio_store.metrics() if memory_audio_store else audio_store.metrics()
 
 # Mount ONLY the audio directory using StaticFiles
 if AUDIO_DIR.exists():
@@ -786,37 +1093,44 @@ class ProcessRequest(BaseModel):
     text: Optional[str] = None
     image: Optional[str] = None
     image_source: str = "none"
+    stream_audio: bool = False # Client can play MediaSource audio chunks
 
 # --- Background Task ---
+async def run_tool_loop(client_id: str, http_client: httpx.AsyncClient, ddgs_client: httpx.AsyncClient, image_base64: str | None, image_source: str,
+                        text: str, history: list[dict], memories: list[dict]) -> tuple[str, str | None, str | None]:
+    """Runs [SEARCH:] intents inside the same turn: search, then continue generation with the results (at most MAX_TOOL_ITERATIONS searches)."""
+    tool_stats["turns"] += 1; searched = set(); search_results = None; allow_search = MAX_TOOL_ITERATIONS > 0
+    while True:
+        ai_response_text, search_query, memory_content = await call_ollama_granite_vision_browser(http_client, client_id, image_base64, image_source, text, history, search_results, memories=memories, allow_search=allow_search)
+        if not search_query: break
+        if not allow_search: tool_stats["budget_exhausted"] += 1; logging.warning(f"Tool budget exhausted for {client_id}; dropping search '{search_query}'"); break
+        query_key = normalize_query(search_query)
+        if query_key in searched: tool_stats["repeat_queries"] += 1; logging.info(f"Repeat search '{search_query}' for {client_id}; answering with current results"); allow_search = False; continue
+        searched.add(query_key); tool_stats["searches"] += 1; allow_search = len(searched) < MAX_TOOL_ITERATIONS
+        logging.info(f"BG Search for {client_id} (step {len(searched)}/{MAX_TOOL_ITERATIONS}): {search_query}")
+        await push_sse_message(client_id, {"event": "system", "data": json.dumps({"message": f"(Searching web for '{search_query}'...)"})})
+        search_results = await perform_web_search(search_query, ddgs_client)
+    return ai_response_text, None, memory_content
+
 # ... (process_ai_interaction - unchanged) ...
 async def process_ai_interaction(req_data: ProcessRequest, http_client: httpx.AsyncClient, ddgs_client: httpx.AsyncClient):
     client_id = req_data.client_id; user_text = req_data.text; image_base64 = req_data.image; image_source = req_data.image_source
     logging.info(f"BG Task started for {client_id}")
     try:
-        await _ensure_client_state(client_id)
-        current_history = await get_client_history(client_id); pending_search_results = await get_pending_search_results(client_id)
-        ai_response_text, search_query, memory_content = await call_ollama_granite_vision_browser(http_client, client_id, image_base64, image_source, user_text or "", current_history, pending_search_results)
+        current_history, recent_memories = await load_turn_context(client_id, user_text or "") # One consistent snapshot per turn
+        ai_response_text, search_query, memory_content = await run_tool_loop(client_id, http_client, ddgs_client, image_base64, image_source, user_text or "", current_history, recent_memories)
         user_turn_content = user_text if user_text else f"({image_source} observation)"; user_turn_hist = {"role": "user", "content": user_turn_content}; ai_turn_hist = {"role": "assistant", "content": ai_response_text}
         response_payload = { "type": "response", "ai_text": ai_response_text, "audio_url": None }
         final_ai_response_sent = False
-        if search_query:
-            logging.info(f"BG Search for {client_id}: {search_query}")
-            await push_sse_message(client_id, {"event": "system", "data": json.dumps({"message": f"(Searching web for '{search_query}'...)"})})
-            search_results = await perform_web_search(search_query, ddgs_client)
-            await set_pending_search_results(client_id, search_results)
-            ai_turn_hist = {"role": "assistant", "content": f"(Initiated search: '{search_query}')"}
-            await push_sse_message(client_id, {"event": "system", "data": json.dumps({"message": f"Search done. Ready for next input."})})
-        elif memory_content:
+        if memory_content:
             logging.info(f"BG Storing memory for {client_id}: {memory_content}")
             mem_type = 'observation' if image_source != 'none' and not user_text else 'fact'
             if "learn" in memory_content or "didn't know" in memory_content: mem_type = 'learning_point'
             await add_memory_entry(client_id, mem_type, memory_content)
-            audio_url = await generate_tts(ai_response_text); response_payload["audio_url"] = audio_url
-            await push_sse_message(client_id, {"event": "response", "data": json.dumps(response_payload)})
+            await push_response_with_audio(client_id, response_payload, req_data.stream_audio)
             final_ai_response_sent = True
         else: # No command
-            audio_url = await generate_tts(ai_response_text); response_payload["audio_url"] = audio_url
-            await push_sse_message(client_id, {"event": "response", "data": json.dumps(response_payload)})
+            await push_response_with_audio(client_id, response_payload, req_data.stream_audio)
             final_ai_response_sent = True
         if final_ai_response_sent: await update_client_history(client_id, user_turn_hist, ai_turn_hist)
     except Exception as e:
@@ -833,7 +1147,8 @@ async def process_request_endpoint(
 ):
     client_id = payload.client_id; http_client = request.app.state.http_client; ddgs_client = request.app.state.ddgs_client
     logging.info(f"Received /process from {client_id}, Text: {bool(payload.text)}, Img: {bool(payload.image)}, Src: {payload.image_source}")
-    await _ensure_client_state(client_id); await add_sse_queue(client_id)
+    await _ensure_client_state(client_id)
+    if not bus.shared: await add_sse_queue(client_id) # Buffer until /stream attaches; with N workers the stream's worker owns the queue
     background_tasks.add_task(process_ai_interaction, payload, http_client, ddgs_client)
     return fastapi.responses.JSONResponse({"status": "processing", "message": "Request received."}, background=background_tasks)
 
@@ -844,18 +1159,29 @@ async def stream_endpoint(request: Request, client_id: str):
     logging.info(f"SSE connection request from client_id: {client_id}")
     await add_sse_queue(client_id)
     async def event_generator() -> Generator[str, None, None]:
-        queue: Optional[asyncio.Queue] = None; client_info = f"{client_id} ({request.client.host if request.client else 'unknown'})"
+        queue: Optional[SSEQueue] = None; client_info = f"{client_id} ({request.client.host if request.client else 'unknown'})"
         try:
-            async with sse_queue_lock: queue = sse_queues.get(client_id)
+            async with sse_queue_lock:
+                queue = sse_queues.get(client_id)
+                if queue: sse_streams[client_id] = sse_streams.get(client_id, 0) + 1; client_last_seen[client_id] = time.monotonic()
             if not queue: raise ValueError("Queue not found")
             yield f"event: connected\ndata: {json.dumps({'message':'SSE connected'})}\n\n"; logging.info(f"SSE stream opened for {client_info}")
             while True:
-                message = await queue.get(); event_type = message.get("event", "message"); data_str = message.get("data", "{}")
-                sse_msg = f"event: {event_type}\ndata: {data_str}\n\n"; yield sse_msg; logging.debug(f"SSE sent to {client_info}: {sse_msg.strip()}"); queue.task_done()
+                message = await queue.get()
+                if message is None: # Closed (too far behind / reaped): end the stream, EventSource reconnects
+                    yield f"event: system\ndata: {json.dumps({'message': '(Connection reset: client fell too far behind)'})}\n\n"; break
+                event_type = message.get("event", "message"); data_str = message.get("data", "{}")
+                sse_msg = f"event: {event_type}\ndata: {data_str}\n\n"; yield sse_msg; logging.debug(f"SSE sent to {client_info}: {event_type}")
         except asyncio.CancelledError: logging.info(f"SSE generator cancelled for {client_info}.")
         except ValueError as e: logging.error(f"SSE Setup Error for {client_info}: {e}"); yield f"event: error\ndata: {json.dumps({'message': str(e)})}\n\n"
         except Exception as e: logging.error(f"Error in SSE generator for {client_info}: {e}", exc_info=True); yield f"event: error\ndata: {json.dumps({'message':'SSE stream error'})}\n\n"
-        finally: logging.info(f"SSE stream closing for {client_info}."); await remove_sse_queue(client_id) # Cleanup queue
+        finally:
+            logging.info(f"SSE stream closing for {client_info}.")
+            if queue:
+                async with sse_queue_lock:
+                    if sse_streams.get(client_id, 0) <= 1: sse_streams.pop(client_id, None)
+                    else: sse_streams[client_id] -= 1
+            await remove_sse_queue(client_id, queue) # Cleanup queue once its last stream is gone
     # Use headers to prevent caching for SSE
     headers = {
         "Cache-Control": "no-cache",
@@ -865,9 +1191,67 @@ async def stream_endpoint(request: Request, client_id: str):
     return EventSourceResponse(event_generator(), media_type="text/event-stream", ping=15, headers=headers)
 
 
+# --- WebSocket Endpoint (same pipeline as /process + /stream over one connection) ---
+def _ws_request(client_id: str, frame: Any) -> ProcessRequest:
+    """Text frame: {"text", "image_source", "stream_audio"}. Binary frame: pack_frame(same header + "mime", raw image bytes).
+    Built without Pydantic validation: the fields are coerced here and the image is never a JSON string."""
+    image = None
+    if isinstance(frame, (bytes, bytearray)):
+        header, raw = unpack_frame(bytes(frame))
+        if raw:
+            ws_stats["image_frames"] += 1; ws_stats["image_bytes"] += len(raw)
+            image = f"data:{header.get('mime') or 'image/jpeg'};base64,{base64.b64encode(raw).decode('ascii')}" # Ollama takes base64
+    elif isinstance(frame, dict): header = frame
+    else: raise ValueError("expected a JSON object or a binary frame")
+    text = header.get("text")
+    construct = getattr(ProcessRequest, "model_construct", None) or ProcessRequest.construct # Pydantic v2 / v1
+    return construct(client_id=client_id, text=str(text) if text else None, image=image, image_source=str(header.get("image_source") or "none"),
+                     stream_audio=bool(header.get("stream_audio")))
+
+def _ws_relay(websocket: WebSocket) -> Callable:
+    """Bus handler for sse:{client_id} while the client is on a WebSocket: events become frames on its send queue."""
+    async def relay(channel: str, message: Dict):
+        event = message.get("event", "message")
+        if event == "audio_chunk": # Raw audio in a binary frame (the bus itself carries base64 JSON)
+            chunk = json.loads(message["data"])
+            await ws_connections.send_bytes(pack_frame({"event": event, "stream_id": chunk["stream_id"]}, base64.b64decode(chunk["data"])), websocket)
+        else: await ws_connections.send_text(f'{{"event":{json.dumps(event)},"data":{message.get("data") or "{}"}}}', websocket) # data is already JSON
+    return relay
+
+@app.websocket("/ws/{client_id}")
+async def websocket_endpoint(websocket: WebSocket, client_id: str):
+    http_client = websocket.app.state.http_client; ddgs_client = websocket.app.state.ddgs_client
+    channel = f"sse:{client_id}"; relay = _ws_relay(websocket)
+    await ws_connections.connect(websocket)
+    try:
+        await _ensure_client_state(client_id)
+        async with sse_queue_lock: ws_relays.setdefault(client_id, []).append(relay); bus.subscribe(channel, relay) # Pushes now go to the newest socket
+        await ws_connections.send_json({"event": "connected", "data": {"message": "WebSocket connected"}}, websocket)
+        while True:
+            frame = await ws_connections.receive_json(websocket)
+            try: req = _ws_request(client_id, frame)
+            except (ValueError, TypeError) as e:
+                ws_stats["bad_frames"] += 1; logging.warning(f"Bad WebSocket frame from {client_id}: {e}")
+                await ws_connections.send_json({"event": "error", "data": {"message": f"Bad frame: {e}"}}, websocket); continue
+            logging.info(f"Received WebSocket turn from {client_id}, Text: {bool(req.text)}, Img: {bool(req.image)}, Src: {req.image_source}")
+            ws_stats["turns"] += 1
+            await ws_connections.run(websocket, process_ai_interaction(req, http_client, ddgs_client)) # Cancelled if the peer goes away
+    except WebSocketDisconnect: logging.info(f"WebSocket closed for {client_id}")
+    except Exception as e: logging.error(f"WebSocket error for {client_id}: {e}", exc_info=True)
+    finally:
+        await ws_connections.aclose(websocket)
+        async with sse_queue_lock:
+            relays = ws_relays.get(client_id, [])
+            if relay in relays: relays.remove(relay)
+            if not relays: ws_relays.pop(client_id, None)
+            if bus.unsubscribe(channel, relay): # Hand the channel back: an older socket of this client, else an open SSE queue
+                if relays: bus.subscribe(channel, relays[-1])
+                elif client_id in sse_queues: bus.subscribe(channel, _deliver_sse)
+
+
 # --- Uvicorn Execution ---
 if __name__ == "__main__":
-    print("--- Aura AI Visual Assistant Server (SINGLE FILE / SSE + HTTP / English) ---")
+    print("--- Aura AI Visual Assistant Server (SINGLE FILE / WebSocket, SSE + HTTP fallback / English) ---")
     print(f"--- MODEL: {MODEL_NAME} ---")
     print(f"Memory: {MEMORY_FILE.resolve()}")
     print(f"Audio: {AUDIO_DIR.resolve()}")
@@ -875,4 +1259,5 @@ if __name__ == "__main__":
     print(f"Access at: http://localhost:8000")
     print("-------------------------------------")
     module_name = Path(__file__).stem
-    uvicorn.run(f"{module_name}:app", host="0.0.0.0", port=8000, log_level="info", reload=False)
+    uvicorn.run(f"{module_name}:app", host="0.0.0.0", port=8000, log_level="info", reload=False, workers=WORKERS,
+                ws_ping_interval=WS_PING_INTERVAL, ws_ping_timeout=WS_PING_TIMEOUT)
@@ -5,7 +5,9 @@ import json
 import re
 import io
 import asyncio
-from edge_tts import Communicate
+from tts_backends import create_tts_backend
+from phrase_bank import get_phrase_bank
+from streamlit_audio import AudioJobs, get_session_audio, render_history
 import logging
 import time
 from PIL import Image  # PIL(Pillow) 사용
@@ -18,6 +20,17 @@ logging.basicConfig(level=logging.INFO)
 OLLAMA_HOST = 'http://localhost:11434'
 # 음성 설정
 VOICE = "ko-KR-HyunsuNeural"
+# TTS 엔진 (TTS_BACKEND=edge|espeak|piper|stub, 오프라인 환경은 로컬 엔진 사용)
+TTS_BACKEND = create_tts_backend(VOICE)
+# 고정 발화 (명령 응답/오류 안내): phrase bank에 미리 합성해 두고 mmap에서 바로 재생
+FIXED_PHRASES = [
+    "얼굴 분석 완료.",
+    "앞으로 이동합니다.",
+    "얼굴을 분석합니다.",
+    "죄송해요, 무슨 말씀인지 잘 모르겠어요.",
+]
+PHRASE_BANK = get_phrase_bank(TTS_BACKEND, VOICE)
+TTS_BACKEND = PHRASE_BANK.wrap(TTS_BACKEND)
 
 # 프롬프트 템플릿 (명령어 인식 추가)
 PROMPT_TEMPLATE = """
@@ -39,14 +52,9 @@ Otherwise, just respond conversationally to the input as text. Do *not* include
 """
 
 async def tts(text, voice=VOICE):
-    """Edge TTS를 사용하여 텍스트를 음성으로 변환"""
+    """설정된 TTS 백엔드로 텍스트를 음성으로 변환"""
     try:
-        communicate = Communicate(text, voice)
-        audio_data = io.BytesIO()
-        async for chunk in communicate.stream():
-            if chunk["type"] == "audio":
-                audio_data.write(chunk["data"])
-        audio_data.seek(0)
+        audio_data = io.BytesIO(await TTS_BACKEND.synthesize(text, voice))
         return audio_data
 
     except Exception as e:
@@ -89,6 +97,11 @@ def parse_ollama_response(response_text):
         return {"response": response_text.strip()}  # JSON 파싱 실패 시
 
 
+@st.cache_resource(show_spinner=False)
+def start_phrase_bank():
+    """고정 발화 bank 합성은 프로세스당 한 번, 별도 스레드에서 (실패한 문구는 bank가 기록해 재시도 간격을 둠)"""
+    return PHRASE_BANK.ensure_in_background(TTS_BACKEND, FIXED_PHRASES)
+
 async def main():
     st.title("AI 대화 챗봇 (이미지 + 음성 인식)")
 
@@ -100,12 +113,13 @@ async def main():
         st.session_state.context = []
 
 
-    # 대화 기록 표시
-    for message in st.session_state.messages:
-        with st.chat_message(message["role"]):
-            st.markdown(message["content"])
-            if "audio" in message:
-                st.audio(message["audio"])
+    # 오디오 보관함 (최근 클립만 메모리, 나머지는 디스크 캐시)
+    session_audio = get_session_audio()
+    start_phrase_bank() # 프로세스당 1회, 백그라운드 합성 (재실행마다 페이지를 막지 않음)
+    audio_jobs = AudioJobs(session_audio, TTS_BACKEND.suffix) # 텍스트 먼저 표시, TTS는 백그라운드 합성 후 첨부
+
+    # 대화 기록 표시 (최근 메시지만 오디오 위젯 렌더링)
+    render_history(st.session_state.messages, session_audio)
 
     # 이미지 업로드
     uploaded_file = st.file_uploader("이미지를 업로드하세요", type=["jpg", "jpeg", "png"])
@@ -119,7 +133,7 @@ async def main():
 
         # 즉시 이미지 분석 (필요하다면)
         with st.spinner("이미지 분석 중..."):
-            ollama_response = query_ollama(PROMPT_TEMPLATE.format(user_input="Analyze this face."), image_data=img_base64) # image_data 추가
+            ollama_response = await asyncio.to_thread(query_ollama, PROMPT_TEMPLATE.format(user_input="Analyze this face."), image_data=img_base64) # image_data 추가
             if "error" in ollama_response:
                 st.error(f"이미지 분석 오류: {ollama_response['error']}")
             else:
@@ -127,10 +141,7 @@ async def main():
                 if "command" in parsed_response and parsed_response["command"] == "analyze_face":
                     st.session_state.messages.append({"role": "assistant", "content": "얼굴 분석 완료."})
                     st.session_state.context = ollama_response.get('context', [])  # 문맥 업데이트
-                    audio_data = await tts("얼굴 분석 완료.")
-                    if audio_data:
-                        st.audio(audio_data)
-                        st.session_state.messages[-1]["audio"] = audio_data #메시지에 추가.
+                    audio_jobs.start(st.session_state.messages[-1], tts("얼굴 분석 완료.")) # 합성 완료 시 메시지에 추가.
 
 
     # 사용자 입력
@@ -143,7 +154,7 @@ async def main():
 
         # Ollama에 쿼리 (텍스트)
         with st.spinner("답변 생성 중..."):
-            ollama_response = query_ollama(PROMPT_TEMPLATE.format(user_input=user_input), st.session_state.context, image_data=img_base64 if uploaded_file else None)
+            ollama_response = await asyncio.to_thread(query_ollama, PROMPT_TEMPLATE.format(user_input=user_input), st.session_state.context, image_data=img_base64 if uploaded_file else None)
             if "error" in ollama_response:
                 st.error(ollama_response["error"])
                 assistant_response_content = "죄송해요, 무슨 말씀인지 잘 모르겠어요."
@@ -171,23 +182,13 @@ async def main():
                 assistant_response_content = parsed_response["response"]
                 st.markdown(assistant_response_content)
 
-            # TTS 실행 (비동기)
-            with st.spinner("음성 생성 중..."):
-                audio_data = await tts(assistant_response_content)
-                if audio_data:
-                    st.audio(audio_data)
-                    # 오디오 데이터와 함께 메시지 저장
-                    st.session_state.messages.append({
-                        "role": "assistant",
-                        "content": assistant_response_content,
-                        "audio": audio_data
-                    })
-                else:
-                    # TTS 실패 시에도 텍스트 메시지는 저장
-                    st.session_state.messages.append({
-                        "role": "assistant",
-                        "content": assistant_response_content,
-                    })
+            # 텍스트 메시지는 바로 저장 (TTS 실패 시에도 남음)
+            st.session_state.messages.append({
+                "role": "assistant",
+                "content": assistant_response_content,
+            })
+            # TTS 실행 (백그라운드, 완료되면 오디오가 붙음)
+            audio_jobs.start(st.session_state.messages[-1], tts(assistant_response_content))
 
 
      # 음성 인식 결과 표시 (JavaScript -> Streamlit)
@@ -290,5 +291,8 @@ document.addEventListener('audioData', (e) => {
         height=0, # 표시안함
     )
 
+    # 백그라운드 TTS 완료 시 자리표시자에 오디오 첨부 (LLM 재호출 없음)
+    await audio_jobs.finish()
+
 if __name__ == "__main__":
     asyncio.run(main())
@@ -5,7 +5,9 @@ import json
 import re
 import io
 import asyncio
-from edge_tts import Communicate
+from tts_backends import create_tts_backend
+from phrase_bank import get_phrase_bank
+from streamlit_audio import AudioJobs, get_session_audio, render_history
 import logging
 from PIL import Image
 import streamlit.components.v1 as components
@@ -17,6 +19,14 @@ logging.basicConfig(level=logging.INFO)
 OLLAMA_HOST = 'http://localhost:11434'
 # 음성 설정
 VOICE = "ko-KR-HyunsuNeural"
+# TTS 엔진 (TTS_BACKEND=edge|espeak|piper|stub, 오프라인 환경은 로컬 엔진 사용)
+TTS_BACKEND = create_tts_backend(VOICE)
+# 고정 발화 (명령 응답/오류 안내): phrase bank에 미리 합성해 두고 mmap에서 바로 재생
+FIXED_PHRASES = [
+    "죄송해요, 무슨 말씀인지 잘 모르겠어요.",
+]
+PHRASE_BANK = get_phrase_bank(TTS_BACKEND, VOICE)
+TTS_BACKEND = PHRASE_BANK.wrap(TTS_BACKEND)
 
 # 프롬프트 템플릿 (한국어, 이미지 설명 중심)
 PROMPT_TEMPLATE = """
@@ -31,14 +41,9 @@ PROMPT_TEMPLATE = """
 """
 
 async def tts(text, voice=VOICE):
-    """Edge TTS를 사용하여 텍스트를 음성으로 변환"""
+    """설정된 TTS 백엔드로 텍스트를 음성으로 변환"""
     try:
-        communicate = Communicate(text, voice)
-        audio_data = io.BytesIO()
-        async for chunk in communicate.stream():
-            if chunk["type"] == "audio":
-                audio_data.write(chunk["data"])
-        audio_data.seek(0)
+        audio_data = io.BytesIO(await TTS_BACKEND.synthesize(text, voice))
         return audio_data
 
     except Exception as e:
@@ -71,6 +76,11 @@ def query_ollama(prompt, context=None, image_data=None):
 # def parse_ollama_response(response_text): ...
 
 
+@st.cache_resource(show_spinner=False)
+def start_phrase_bank():
+    """고정 발화 bank 합성은 프로세스당 한 번, 별도 스레드에서 (실패한 문구는 bank가 기록해 재시도 간격을 둠)"""
+    return PHRASE_BANK.ensure_in_background(TTS_BACKEND, FIXED_PHRASES)
+
 async def main():
     st.title("AI 대화 챗봇 (이미지 + 음성 인식)")
 
@@ -82,12 +92,13 @@ async def main():
     if "speech_active" not in st.session_state:
         st.session_state.speech_active = False
 
-    # 대화 기록 표시
-    for message in st.session_state.messages:
-        with st.chat_message(message["role"]):
-            st.markdown(message["content"])
-            if "audio" in message:
-                st.audio(message["audio"])
+    # 오디오 보관함 (최근 클립만 메모리, 나머지는 디스크 캐시)
+    session_audio = get_session_audio()
+    start_phrase_bank() # 프로세스당 1회, 백그라운드 합성 (재실행마다 페이지를 막지 않음)
+    audio_jobs = AudioJobs(session_audio, TTS_BACKEND.suffix) # 텍스트 먼저 표시, TTS는 백그라운드 합성 후 첨부
+
+    # 대화 기록 표시 (최근 메시지만 오디오 위젯 렌더링)
+    render_history(st.session_state.messages, session_audio)
 
     # 이미지 업로드
     uploaded_file = st.file_uploader("이미지를 업로드하세요", type=["jpg", "jpeg", "png"])
@@ -100,7 +111,7 @@ async def main():
 
         # 이미지 설명
         with st.spinner("이미지 설명 생성 중..."):
-            ollama_response = query_ollama(PROMPT_TEMPLATE.format(user_input="이 이미지를 설명해 주세요."), image_data=img_base64) # user_input 변경
+            ollama_response = await asyncio.to_thread(query_ollama, PROMPT_TEMPLATE.format(user_input="이 이미지를 설명해 주세요."), image_data=img_base64) # user_input 변경
             if "error" in ollama_response:
                 st.error(f"이미지 설명 오류: {ollama_response['error']}")
             else:
@@ -109,10 +120,7 @@ async def main():
                 st.session_state.context = ollama_response.get('context', [])  # 컨텍스트는 계속 업데이트
                 with st.chat_message("assistant"):
                     st.markdown(image_description)
-                audio_data = await tts(image_description)
-                if audio_data:
-                    st.audio(audio_data)
-                    st.session_state.messages[-1]["audio"] = audio_data
+                    audio_jobs.start(st.session_state.messages[-1], tts(image_description))
 
     # 음성 인식 활성화/비활성화 버튼
     if st.button("음성 인식 " + ("켜기" if not st.session_state.speech_active else "끄기")):
@@ -131,7 +139,8 @@ async def main():
 
         # Ollama에 쿼리 (이미지/텍스트)
         with st.spinner("답변 생성 중..."):
-            ollama_response = query_ollama(
+            ollama_response = await asyncio.to_thread(
+                query_ollama,
                 PROMPT_TEMPLATE.format(user_input=user_input),
                 st.session_state.context,  # 컨텍스트는 항상 전달
                 image_data=img_base64 if uploaded_file else None,
@@ -146,20 +155,12 @@ async def main():
 
         with st.chat_message("assistant"):
             st.markdown(assistant_response_content)
-            with st.spinner("음성 생성 중..."):
-                audio_data = await tts(assistant_response_content)
-                if audio_data:
-                    st.audio(audio_data)
-                    st.session_state.messages.append({
-                        "role": "assistant",
-                        "content": assistant_response_content,
-                        "audio": audio_data
-                    })
-                else: # tts 실패시에도 텍스트는 저장
-                    st.session_state.messages.append({
-                        "role": "assistant",
-                        "content": assistant_response_content
-                    })
+            # 텍스트는 바로 저장, 음성은 합성이 끝나면 audio_key가 붙음 (tts 실패시에도 텍스트는 남음)
+            st.session_state.messages.append({
+                "role": "assistant",
+                "content": assistant_response_content
+            })
+            audio_jobs.start(st.session_state.messages[-1], tts(assistant_response_content))
 
 
     # 음성 인식 (Web Speech API, JavaScript -> Streamlit)
@@ -212,5 +213,8 @@ if ({'true' if st.session_state.speech_active else 'false'}) {{
         height=0,
     )
 
+    # 백그라운드 TTS 완료 시 자리표시자에 오디오 첨부 (LLM 재호출 없음)
+    await audio_jobs.finish()
+
 if __name__ == "__main__":
     asyncio.run(main())
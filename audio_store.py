@@ -0,0 +1,233 @@
+# -*- coding: utf-8 -*-
+# Shared TTS audio store for the Aura servers (3.py, 4.py, 5.py, 6, cam, cam2).
+# AudioStore keeps an in-memory index of generated clips so cleanup never rescans AUDIO_DIR.
+# MemoryAudioStore keeps clips in RAM (byte-capped LRU, optional disk spill) and serves them
+# with ETag / Range / Cache-Control, bypassing the filesystem on SD-card devices.
+
+import asyncio
+import logging
+import mimetypes
+import os
+import re
+import time
+import uuid
+from collections import OrderedDict
+from pathlib import Path
+from typing import Dict, List, Mapping, Optional, Tuple
+
+try:
+    from starlette.responses import Response
+except ImportError: # Streamlit 앱은 디스크 인덱스(AudioStore)만 사용
+    Response = None
+
+
+class AudioStore:
+    """Index of generated audio files (name -> size, created) with a single periodic janitor.
+
+    Files are indexed in creation order, so eviction by age or total-bytes cap only
+    touches the oldest entries: cleanup cost tracks evictions, not request rate.
+    """
+
+    def __init__(self, directory: Path, url_prefix: str = "/static/audio", max_age_seconds: int = 600,
+                 max_total_bytes: int = 200 * 1024 * 1024, janitor_interval: float = 30.0):
+        self.directory = Path(directory)
+        self.url_prefix = url_prefix.rstrip("/")
+        self.max_age_seconds = max_age_seconds
+        self.max_total_bytes = max_total_bytes
+        self.janitor_interval = janitor_interval
+        self._index: "OrderedDict[str, Tuple[int, float]]" = OrderedDict()
+        self._total_bytes = 0
+        self._evicted_files = 0
+        self._evicted_bytes = 0
+        self._janitor_task: Optional[asyncio.Task] = None
+        self.directory.mkdir(parents=True, exist_ok=True)
+
+    # --- Index ---
+    def new_path(self, prefix: str = "aura_tts", suffix: str = ".mp3") -> Path:
+        return self.directory / f"{prefix}_{uuid.uuid4()}{suffix}"
+
+    def add(self, path: Path, size: Optional[int] = None, created: Optional[float] = None) -> str:
+        """Registers a freshly written file and returns its public URL."""
+        path = Path(path)
+        if size is None: size = path.stat().st_size
+        self._drop(path.name)
+        self._index[path.name] = (size, created if created is not None else time.time())
+        self._total_bytes += size
+        return f"{self.url_prefix}/{path.name}"
+
+    def __contains__(self, name: str) -> bool:
+        return name in self._index
+
+    def _drop(self, name: str) -> Optional[Tuple[int, float]]:
+        entry = self._index.pop(name, None)
+        if entry: self._total_bytes -= entry[0]
+        return entry
+
+    def scan_existing(self, pattern: str = "aura_tts_*"):
+        """One-time startup scan so clips left by a previous run are still evicted."""
+        found = []
+        for path in self.directory.glob(pattern):
+            try: st = path.stat()
+            except OSError: continue
+            found.append((st.st_mtime, path.name, st.st_size))
+        for mtime, name, size in sorted(found):
+            self._drop(name); self._index[name] = (size, mtime); self._total_bytes += size
+        if found: logging.info(f"Audio store indexed {len(found)} existing files ({self._total_bytes} bytes).")
+
+    # --- Eviction ---
+    def _select_expired(self, now: float) -> List[str]:
+        expired = []; remaining = self._total_bytes
+        for name, (size, created) in self._index.items():
+            if now - created <= self.max_age_seconds and remaining <= self.max_total_bytes: break
+            expired.append(name); remaining -= size
+        return expired
+
+    async def evict(self, now: Optional[float] = None) -> int:
+        names = self._select_expired(now if now is not None else time.time())
+        if not names: return 0
+        freed = 0
+        for name in names:
+            entry = self._drop(name)
+            if entry: freed += entry[0]
+        await asyncio.to_thread(self._unlink_many, [self.directory / name for name in names])
+        self._evicted_files += len(names); self._evicted_bytes += freed
+        logging.debug(f"Audio janitor evicted {len(names)} files ({freed} bytes).")
+        return len(names)
+
+    @staticmethod
+    def _unlink_many(paths: List[Path]):
+        for path in paths:
+            try: os.remove(path)
+            except FileNotFoundError: pass
+            except OSError as e: logging.warning(f"Error removing audio {path}: {e}")
+
+    # --- Janitor ---
+    async def _janitor_loop(self):
+        while True:
+            await asyncio.sleep(self.janitor_interval)
+            try: await self.evict()
+            except Exception as e: logging.error(f"Audio janitor error: {e}", exc_info=True)
+
+    def start_janitor(self):
+        if self._janitor_task is None or self._janitor_task.done():
+            self.scan_existing()
+            self._janitor_task = asyncio.create_task(self._janitor_loop())
+
+    async def stop_janitor(self):
+        if self._janitor_task:
+            self._janitor_task.cancel()
+            try: await self._janitor_task
+            except asyncio.CancelledError: pass
+            self._janitor_task = None
+
+    # --- Metrics ---
+    def metrics(self) -> Dict[str, int]:
+        return {
+            "files": len(self._index), "bytes": self._total_bytes,
+            "evicted_files": self._evicted_files, "evicted_bytes": self._evicted_bytes,
+        }
+
+
+# --- RAM-backed store ---
+_RANGE_RE = re.compile(r"^bytes=(\d*)-(\d*)$")
+
+def parse_range(range_header: Optional[str], size: int) -> Optional[Tuple[int, int]]:
+    """Parses a single 'bytes=start-end' range. Returns (start, end) inclusive, None to serve
+    the whole body (no/multi-range header), or raises ValueError if unsatisfiable."""
+    if not range_header: return None
+    match = _RANGE_RE.match(range_header.strip())
+    if not match: return None # Multi-range or unknown unit: full response is allowed
+    start_s, end_s = match.groups()
+    if not start_s and not end_s: return None
+    if not start_s: # Suffix range: last N bytes
+        length = int(end_s)
+        if length == 0: raise ValueError("empty suffix range")
+        return max(size - length, 0), size - 1
+    start = int(start_s); end = int(end_s) if end_s else size - 1
+    if start >= size or end < start: raise ValueError("range not satisfiable")
+    return start, min(end, size - 1)
+
+
+class MemoryAudioStore:
+    """Byte-capped LRU of audio clips held in RAM, served from a dedicated endpoint.
+
+    Clips pushed out of RAM are written to an optional disk spill tier (an AudioStore,
+    which applies its own age/bytes janitor) and are still served from the same URL.
+    Clips are immutable and named by a random id, so the name doubles as a strong ETag.
+    """
+
+    def __init__(self, max_bytes: int = 64 * 1024 * 1024, url_prefix: str = "/audio",
+                 spill: Optional[AudioStore] = None, cache_max_age: int = 600):
+        self.max_bytes = max_bytes
+        self.url_prefix = url_prefix.rstrip("/")
+        self.spill = spill
+        self.cache_max_age = cache_max_age
+        self._clips: "OrderedDict[str, bytes]" = OrderedDict()
+        self._total_bytes = 0
+        self._hits = 0; self._spill_hits = 0; self._misses = 0
+        self._spilled = 0; self._dropped = 0
+
+    async def put(self, data: bytes, suffix: str = ".mp3") -> str:
+        name = f"aura_tts_{uuid.uuid4().hex}{suffix}"
+        self._clips[name] = bytes(data); self._total_bytes += len(data)
+        await self._enforce_cap(keep=name)
+        return f"{self.url_prefix}/{name}"
+
+    async def _enforce_cap(self, keep: str):
+        while self._total_bytes > self.max_bytes and len(self._clips) > 1:
+            name, data = next(iter(self._clips.items()))
+            if name == keep: break
+            del self._clips[name]; self._total_bytes -= len(data)
+            if self.spill is None: self._dropped += 1; continue
+            try:
+                path = self.spill.directory / name
+                await asyncio.to_thread(path.write_bytes, data)
+                self.spill.add(path, size=len(data)); self._spilled += 1
+            except OSError as e: logging.warning(f"Audio spill failed for {name}: {e}"); self._dropped += 1
+
+    async def get(self, name: str) -> Optional[bytes]:
+        data = self._clips.get(name)
+        if data is not None:
+            self._clips.move_to_end(name); self._hits += 1
+            return data
+        if self.spill is not None and "/" not in name and name in self.spill:
+            try:
+                data = await asyncio.to_thread((self.spill.directory / name).read_bytes)
+                self._spill_hits += 1
+                return data
+            except OSError: pass
+        self._misses += 1
+        return None
+
+    async def response(self, name: str, headers: Mapping[str, str]) -> Response:
+        """Builds a 200 / 206 / 304 / 404 / 416 response for a clip, honouring If-None-Match,
+        If-Range and a single byte Range."""
+        data = await self.get(name)
+        if data is None: return Response(status_code=404)
+        etag = f'"{name}"'; size = len(data)
+        media_type = mimetypes.guess_type(name)[0] or "application/octet-stream"
+        base_headers = {"ETag": etag, "Accept-Ranges": "bytes",
+                        "Cache-Control": f"public, max-age={self.cache_max_age}, immutable"}
+        if_none_match = headers.get("if-none-match")
+        if if_none_match and (if_none_match.strip() == "*" or etag in [t.strip() for t in if_none_match.split(",")]):
+            return Response(status_code=304, headers=base_headers)
+        range_header = headers.get("range")
+        if_range = headers.get("if-range")
+        if if_range and if_range.strip() != etag: range_header = None # Stale validator: send the whole clip
+        try: byte_range = parse_range(range_header, size)
+        except ValueError:
+            return Response(status_code=416, headers={**base_headers, "Content-Range": f"bytes */{size}"})
+        if byte_range is None:
+            return Response(content=data, media_type=media_type, headers=base_headers)
+        start, end = byte_range
+        return Response(content=data[start:end + 1], status_code=206, media_type=media_type,
+                        headers={**base_headers, "Content-Range": f"bytes {start}-{end}/{size}"})
+
+    def metrics(self) -> Dict[str, int]:
+        metrics = {
+            "memory_files": len(self._clips), "memory_bytes": self._total_bytes,
+            "hits": self._hits, "spill_hits": self._spill_hits, "misses": self._misses,
+            "spilled": self._spilled, "dropped": self._dropped,
+        }
+        if self.spill is not None: metrics.update({f"spill_{k}": v for k, v in self.spill.metrics().items()})
+        return metrics
@@ -0,0 +1,329 @@
+# -*- coding: utf-8 -*-
+# Relevance-ranked memory retrieval for 5.py / 6: each turn gets the top-k memories for the user text
+# instead of simply the most recent ones. Two interchangeable indexes (MEMORY_INDEX):
+#   vector - memories embedded on insert (a hashing embedder by default, or Ollama /api/embed) and
+#            appended to one contiguous float32 matrix per client; cosine top-k with one matmul. Needs numpy.
+#            start() probes the embedder once; if it fails the index stays off (recency) with one warning.
+#   bm25   - incremental per-client inverted index with Korean-aware tokenization; a query only
+#            touches the postings of its own terms, so cost does not grow with the memory count.
+# search() gets the client's memory list as read with the rest of the turn's context (one snapshot) and
+# returns None when it has nothing to offer (no memory scores at least min_score, MEMORY_MIN_SCORE);
+# callers then fall back to recency, so unrelated memories are not pushed into the prompt.
+
+import asyncio
+import heapq
+import logging
+import math
+import os
+import re
+import zlib
+from collections import Counter, OrderedDict
+from typing import Dict, List, Optional, Tuple
+
+try:
+    import numpy as np
+except ImportError: # numpy 없으면 bm25 (또는 기존 최근순)으로 동작
+    np = None
+
+import httpx
+
+MemoryKey = Tuple[str, str]
+
+
+def memory_key(entry: dict) -> MemoryKey:
+    return (str(entry.get("timestamp", "")), str(entry.get("content", "")))
+
+
+# --- Tokenizer ---
+# 자주 붙는 조사: 긴 것부터 떼어서 '커피를' / '커피는' / '커피' 가 같은 term 이 되게 함
+KOREAN_SUFFIXES = sorted(["은", "는", "이", "가", "을", "를", "의", "에", "에서", "에게", "께", "와", "과", "도", "만", "로", "으로",
+                          "랑", "이랑", "하고", "까지", "부터", "보다", "처럼", "이다", "입니다", "예요", "이에요", "야", "이야"], key=len, reverse=True)
+STOPWORDS = {"a", "an", "the", "is", "are", "was", "were", "be", "to", "of", "in", "on", "at", "for", "and", "or",
+             "it", "my", "me", "i", "you", "your", "do", "does", "what", "who", "that", "this", "with"}
+_HANGUL = re.compile(r"[가-힣]")
+
+
+def _strip_suffix(token: str) -> str:
+    for suffix in KOREAN_SUFFIXES:
+        if len(token) > len(suffix) + 1 and token.endswith(suffix): return token[:-len(suffix)]
+    return token
+
+
+def tokenize(text: str) -> List[str]:
+    """Lowercased word tokens; Hangul words lose a trailing particle and also emit character bigrams
+    (compounds like '강아지사료' still match '강아지')."""
+    terms = []
+    for token in re.findall(r"\w+", text.lower()):
+        if _HANGUL.search(token):
+            stem = _strip_suffix(token); terms.append(stem)
+            if len(stem) > 2: terms.extend(stem[i:i + 2] for i in range(len(stem) - 1))
+        elif token not in STOPWORDS and (len(token) > 1 or token.isdigit()): terms.append(token)
+    return terms
+
+
+# --- Embedders ---
+class HashingEmbedder:
+    """Feature-hashing bag of words + character bigrams (bigrams keep Korean stems like '커피를' ~ '커피' close)."""
+    name = "hashing"
+    min_score = 0.2 # Unrelated short texts share a few bigrams and land around 0.0-0.17
+
+    def __init__(self, dim: int = 512):
+        self.dim = dim
+
+    def _features(self, text: str) -> List[str]:
+        features = []
+        for token in re.findall(r"\w+", text.lower()):
+            features.append(token)
+            features.extend(token[i:i + 2] for i in range(len(token) - 1))
+        return features
+
+    def _embed_one(self, text: str) -> "np.ndarray":
+        vec = np.zeros(self.dim, dtype=np.float32)
+        for feature in self._features(text):
+            h = zlib.crc32(feature.encode("utf-8"))
+            vec[h % self.dim] += 1.0 if (h >> 31) & 1 else -1.0
+        return vec
+
+    async def embed(self, texts: List[str]) -> List["np.ndarray"]:
+        return [self._embed_one(t) for t in texts]
+
+
+class OllamaEmbedder:
+    """Batch embeddings from Ollama's /api/embed endpoint."""
+    name = "ollama"
+    min_score = 0.5 # Dense sentence embeddings rarely drop below ~0.3 even for unrelated text
+
+    def __init__(self, host: str, model: str, timeout: float = 30.0):
+        self.url = f"{host.rstrip('/')}/api/embed"
+        self.model = model
+        self._client = httpx.AsyncClient(timeout=timeout)
+
+    async def embed(self, texts: List[str]) -> List["np.ndarray"]:
+        response = await self._client.post(self.url, json={"model": self.model, "input": texts})
+        response.raise_for_status()
+        return [np.asarray(v, dtype=np.float32) for v in response.json()["embeddings"]]
+
+    async def aclose(self):
+        await self._client.aclose()
+
+
+# --- Vector index ---
+class _ClientVectors:
+    __slots__ = ("rows", "keys", "entries", "buffer", "n", "vectors")
+
+    def __init__(self):
+        self.rows: Dict[MemoryKey, int] = {} # Memory key -> matrix row
+        self.keys: List[MemoryKey] = [] # Row -> memory key
+        self.entries: List[dict] = []
+        self.buffer = None # (capacity, dim) float32, rows L2-normalized; the first n rows are live
+        self.n = 0
+        self.vectors: Dict[MemoryKey, "np.ndarray"] = {}
+
+    @property
+    def matrix(self) -> Optional["np.ndarray"]:
+        return self.buffer[:self.n] if self.buffer is not None and self.n else None
+
+    def load(self, keys: List[MemoryKey], entries: List[dict]):
+        self.rows = {k: i for i, k in enumerate(keys)}; self.keys = list(keys); self.entries = list(entries); self.n = len(keys)
+        self.buffer = np.stack([self.vectors[k] for k in keys]) if keys else None
+
+    def append(self, key: MemoryKey, entry: dict, vector: "np.ndarray") -> bool:
+        """Adds one row in place (amortized O(dim)); False if the matrix is not built yet."""
+        if self.buffer is None or self.buffer.shape[1] != vector.shape[0]: return False
+        if self.n == len(self.buffer):
+            grown = np.empty((max(2 * self.n, 16), self.buffer.shape[1]), dtype=np.float32); grown[:self.n] = self.buffer[:self.n]
+            self.buffer = grown
+        self.buffer[self.n] = vector; self.rows[key] = self.n; self.keys.append(key); self.entries.append(entry); self.n += 1
+        return True
+
+    def remove(self, key: MemoryKey):
+        """Drops one row in O(dim) by moving the last row into its slot (row order is irrelevant)."""
+        i = self.rows.pop(key); last = self.n - 1
+        if i != last:
+            self.buffer[i] = self.buffer[last]; self.keys[i] = self.keys[last]; self.entries[i] = self.entries[last]
+            self.rows[self.keys[i]] = i
+        self.keys.pop(); self.entries.pop(); self.vectors.pop(key, None); self.n = last
+
+
+class MemoryVectorIndex:
+    """Per-client cosine top-k over memory embeddings. Rows follow the loaded memory list, so
+    trimming (MAX_MEMORY_ENTRIES) and either state backend stay the source of truth."""
+    name = "vector"
+
+    def __init__(self, embedder, min_score: Optional[float] = None):
+        self.embedder = embedder
+        self.min_score = embedder.min_score if min_score is None else min_score # Cosine below this is "unrelated"
+        self._clients: Dict[str, _ClientVectors] = {}
+        self.enabled = True # Cleared by start() if the embedder does not answer
+        self.searches = 0; self.fallbacks = 0; self.embedded = 0; self.appended = 0; self.evicted = 0
+
+    @property
+    def available(self) -> bool:
+        return np is not None and self.enabled
+
+    async def start(self, timeout: float = 10.0):
+        """Embeds one probe text; on failure the vector path is disabled (one warning instead of one per turn)."""
+        if np is None: return
+        try: await asyncio.wait_for(self.embedder.embed(["probe"]), timeout)
+        except Exception as e:
+            self.enabled = False
+            logging.warning(f"Memory embedder {self.embedder.name} unavailable ({e!r}); memory retrieval falls back to recency. "
+                            "Pull the embedding model or set MEMORY_EMBEDDER=hashing / MEMORY_INDEX=bm25.")
+
+    async def _embed(self, texts: List[str]) -> Optional[List["np.ndarray"]]:
+        try: vectors = await self.embedder.embed(texts)
+        except Exception as e: logging.warning(f"Memory embedding failed ({self.embedder.name}): {e}"); return None
+        self.embedded += len(texts)
+        out = []
+        for v in vectors:
+            norm = float(np.linalg.norm(v)); out.append(v / norm if norm > 0 else v)
+        return out
+
+    async def add(self, client_id: str, entry: dict):
+        """Embeds a new memory at insert time so the next search only pays for the query embedding."""
+        if not self.available: return
+        vectors = await self._embed([entry.get("content", "")])
+        if not vectors: return
+        index = self._clients.setdefault(client_id, _ClientVectors()); key = memory_key(entry)
+        index.vectors[key] = vectors[0]
+        if key not in index.rows and entry.get("content") and index.append(key, entry, vectors[0]): self.appended += 1
+
+    async def _sync(self, client_id: str, memories: List[dict]) -> Optional[_ClientVectors]:
+        """Brings the client's rows in line with `memories`. The matrix is built once; afterwards trimmed
+        memories are removed and foreign inserts appended row by row, so a full index never rebuilds per insert."""
+        index = self._clients.setdefault(client_id, _ClientVectors())
+        current = {memory_key(m): m for m in memories if isinstance(m, dict) and m.get("content")}
+        missing = [(k, m) for k, m in current.items() if k not in index.vectors]
+        if missing:
+            vectors = await self._embed([m["content"] for _, m in missing])
+            if vectors is None: return None
+            for (k, _), v in zip(missing, vectors): index.vectors[k] = v
+        if index.matrix is not None:
+            for key in [k for k in index.rows if k not in current]: index.remove(key); self.evicted += 1 # Trimmed past MAX_MEMORY_ENTRIES
+            if all(index.append(k, m, index.vectors[k]) for k, m in current.items() if k not in index.rows): return index
+        index.vectors = {k: index.vectors[k] for k in current} # First search (or embedding size changed): build
+        index.load(list(current), list(current.values()))
+        return index
+
+    async def search(self, client_id: str, query: str, k: int, memories: List[dict]) -> Optional[List[dict]]:
+        """Top-k of `memories` (the client's full list) scoring at least min_score, most similar first;
+        None (recency fallback) when none does."""
+        if not self.available or not query.strip(): return None
+        self.searches += 1
+        index = await self._sync(client_id, memories)
+        query_vec = await self._embed([query]) if index is not None and index.matrix is not None else None
+        if not query_vec or query_vec[0].shape[0] != index.matrix.shape[1]: self.fallbacks += 1; return None
+        scores = index.matrix @ query_vec[0]
+        k = min(k, len(scores))
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = [i for i in top[np.argsort(-scores[top])] if scores[i] >= self.min_score]
+        if not top: self.fallbacks += 1; return None
+        return [index.entries[i] for i in top]
+
+    def forget(self, client_id: str):
+        self._clients.pop(client_id, None)
+
+    async def aclose(self):
+        if hasattr(self.embedder, "aclose"): await self.embedder.aclose()
+
+    def metrics(self) -> Dict[str, int]:
+        return {"index": self.name, "embedder": self.embedder.name, "enabled": self.available, "clients": len(self._clients), "searches": self.searches,
+                "fallbacks": self.fallbacks, "embedded": self.embedded, "appended": self.appended, "evicted": self.evicted, "min_score": self.min_score}
+
+
+# --- BM25 index ---
+class _ClientPostings:
+    __slots__ = ("docs", "keys", "postings", "total_len", "next_id")
+
+    def __init__(self):
+        self.docs: "OrderedDict[int, Tuple[dict, Counter, int]]" = OrderedDict() # doc id -> (entry, tf, length), insertion order
+        self.keys: Dict[MemoryKey, int] = {}
+        self.postings: Dict[str, Dict[int, int]] = {} # term -> {doc id: tf}
+        self.total_len = 0
+        self.next_id = 0
+
+
+class BM25MemoryIndex:
+    """Incremental inverted index per client (Okapi BM25). Built from the store on a client's first
+    search, then kept current by add(); the oldest documents are evicted past max_docs, matching
+    the servers' MAX_MEMORY_ENTRIES trimming."""
+    name = "bm25"
+
+    def __init__(self, max_docs: int = 2000, k1: float = 1.2, b: float = 0.75, min_score: float = 0.5):
+        self.max_docs = max_docs
+        self.min_score = min_score # A lone match on a term most memories contain (idf < ~0.5) is noise
+        self.k1 = k1
+        self.b = b
+        self._clients: Dict[str, _ClientPostings] = {}
+        self.searches = 0; self.fallbacks = 0; self.postings_scanned = 0
+
+    def _insert(self, index: _ClientPostings, entry: dict):
+        key = memory_key(entry)
+        if key in index.keys or not entry.get("content"): return
+        tf = Counter(tokenize(str(entry["content"]))); length = sum(tf.values())
+        doc_id = index.next_id; index.next_id += 1
+        index.docs[doc_id] = (entry, tf, length); index.keys[key] = doc_id; index.total_len += length
+        for term, count in tf.items(): index.postings.setdefault(term, {})[doc_id] = count
+        while len(index.docs) > self.max_docs:
+            old_id, (old_entry, old_tf, old_len) = index.docs.popitem(last=False)
+            index.keys.pop(memory_key(old_entry), None); index.total_len -= old_len
+            for term in old_tf:
+                posting = index.postings[term]; del posting[old_id]
+                if not posting: del index.postings[term]
+
+    async def add(self, client_id: str, entry: dict):
+        index = self._clients.get(client_id)
+        if index is not None: self._insert(index, entry) # Unbuilt clients pick the entry up on their first search
+
+    def _build(self, client_id: str, memories: List[dict]) -> _ClientPostings:
+        index = self._clients[client_id] = _ClientPostings()
+        for entry in sorted((m for m in memories if isinstance(m, dict)), key=lambda m: str(m.get("timestamp", ""))): self._insert(index, entry)
+        return index
+
+    async def search(self, client_id: str, query: str, k: int, memories: List[dict]) -> Optional[List[dict]]:
+        """Top-k memories scoring at least min_score (best first), or None if none does. `memories` (the client's
+        full list) builds the index on its first search; afterwards add() keeps it current."""
+        terms = set(tokenize(query))
+        if not terms: return None
+        self.searches += 1
+        index = self._clients.get(client_id) or self._build(client_id, memories)
+        n = len(index.docs)
+        if n == 0: self.fallbacks += 1; return None
+        avg_len = index.total_len / n or 1.0
+        scores: Dict[int, float] = {}
+        for term in terms:
+            posting = index.postings.get(term)
+            if not posting: continue
+            idf = math.log(1 + (n - len(posting) + 0.5) / (len(posting) + 0.5))
+            self.postings_scanned += len(posting)
+            for doc_id, tf in posting.items():
+                norm = self.k1 * (1 - self.b + self.b * index.docs[doc_id][2] / avg_len)
+                scores[doc_id] = scores.get(doc_id, 0.0) + idf * tf * (self.k1 + 1) / (tf + norm)
+        top = [doc_id for doc_id in heapq.nlargest(k, scores, key=scores.get) if scores[doc_id] >= self.min_score]
+        if not top: self.fallbacks += 1; return None
+        return [index.docs[doc_id][0] for doc_id in top]
+
+    def forget(self, client_id: str):
+        self._clients.pop(client_id, None)
+
+    async def start(self):
+        pass
+
+    async def aclose(self):
+        pass
+
+    def metrics(self) -> Dict[str, int]:
+        return {"index": self.name, "clients": len(self._clients), "documents": sum(len(i.docs) for i in self._clients.values()),
+                "terms": sum(len(i.postings) for i in self._clients.values()), "searches": self.searches,
+                "fallbacks": self.fallbacks, "postings_scanned": self.postings_scanned, "min_score": self.min_score}
+
+
+def create_memory_index(ollama_host: str, max_memory: int = 2000):
+    """MEMORY_INDEX=vector (default with numpy) | bm25 (default without).
+    vector: MEMORY_EMBEDDER=hashing (default, no extra model) | ollama (OLLAMA_EMBED_MODEL, default nomic-embed-text; must be pulled).
+    MEMORY_MIN_SCORE overrides the relevance floor (cosine for vector, BM25 score for bm25)."""
+    min_score = float(os.environ["MEMORY_MIN_SCORE"]) if os.getenv("MEMORY_MIN_SCORE") else None
+    if os.getenv("MEMORY_INDEX", "vector" if np is not None else "bm25").lower() == "bm25":
+        return BM25MemoryIndex(max_docs=max_memory) if min_score is None else BM25MemoryIndex(max_docs=max_memory, min_score=min_score)
+    if os.getenv("MEMORY_EMBEDDER", "hashing").lower() == "hashing": return MemoryVectorIndex(HashingEmbedder(), min_score)
+    return MemoryVectorIndex(OllamaEmbedder(ollama_host, os.getenv("OLLAMA_EMBED_MODEL", "nomic-embed-text")), min_score)
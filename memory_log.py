@@ -0,0 +1,319 @@
+# -*- coding: utf-8 -*-
+# Append-only write-ahead log + per-client shard files for client history/memory (5.py, 6).
+# Each mutation is one JSONL record; a writer task batches records and fsyncs once per batch.
+# Client state lives in one shard per client (aura_memory.shards/<hash>.json) and is loaded on first
+# use, so startup only scans the log tail (bounded by compact_bytes), not every client ever seen.
+# Compaction rewrites the shards of clients touched since the last compaction and drops the log
+# segments they cover; unload() persists a single client's shard so its state can leave the heap.
+# Writes are debounced: at most one flush runs at a time, once per flush_interval or as soon as
+# flush_batch records are queued, so disk I/O follows write volume rather than mutation count.
+
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import time
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from tts_backends import LatencyHistogram
+
+StateDict = Dict[str, Dict[str, Any]]
+
+
+def apply_record(states: StateDict, record: dict, max_history: int, max_memory: int):
+    """Applies one logged mutation with the same trimming the servers use."""
+    state = states.setdefault(record["client"], {"history": [], "memory": []})
+    if record["op"] == "memory":
+        memory = state.setdefault("memory", []); memory.append(record["entry"])
+        if len(memory) > max_memory: state["memory"] = memory[-max_memory:]
+    elif record["op"] == "history":
+        history = state.setdefault("history", []); history.extend(record["turns"])
+        if len(history) > max_history: state["history"] = history[-max_history:]
+
+
+def copy_state(state: Dict[str, Any]) -> Dict[str, Any]:
+    return {"history": list(state.get("history", [])), "memory": list(state.get("memory", []))}
+
+
+class MemoryLog:
+    """Segmented JSONL WAL (aura_memory.wal.<n>.jsonl) in front of per-client shards (aura_memory.shards/)."""
+
+    def __init__(self, snapshot_path: Path, max_history: int = 20, max_memory: int = 50,
+                 flush_interval: float = 0.05, flush_batch: int = 256, compact_bytes: int = 8 * 1024 * 1024):
+        self.snapshot_path = Path(snapshot_path) # Legacy whole-file snapshot, migrated into shards once
+        self.shard_dir = self.snapshot_path.with_name(f"{self.snapshot_path.stem}.shards")
+        self.manifest_path = self.shard_dir / "manifest.json"
+        self.max_history = max_history
+        self.max_memory = max_memory
+        self.flush_interval = flush_interval # Group-commit window: one fsync per batch
+        self.flush_batch = flush_batch
+        self.compact_bytes = compact_bytes
+        self._seq = 0
+        self._segment = 0
+        self._segment_bytes = 0
+        self._fh = None
+        self._pending: List[str] = []
+        self._waiters: List[asyncio.Future] = []
+        self._tails: Dict[str, List[dict]] = {} # client -> log records newer than its shard
+        self._compacting: Dict[str, List[dict]] = {} # Tails handed to compact() whose shard is not written yet
+        self._shard_seq: Dict[str, int] = {} # Seq of the newest shard written this run
+        self._wake: Optional[asyncio.Event] = None
+        self._due: Optional[asyncio.Event] = None # Batch full / flush() requested: skip the rest of the interval
+        self._ready: Optional[asyncio.Event] = None
+        self._io_lock: Optional[asyncio.Lock] = None
+        self._shard_lock: Optional[asyncio.Lock] = None
+        self._open_task: Optional[asyncio.Task] = None
+        self._writer_task: Optional[asyncio.Task] = None
+        self._compact_task: Optional[asyncio.Task] = None
+        self._source: Optional[Callable[[], StateDict]] = None
+        self._flush_latency = LatencyHistogram(buckets=(0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0))
+        self._snapshot_latency = LatencyHistogram(buckets=(0.01, 0.05, 0.1, 0.5, 1.0, 5.0))
+        self.flushes = 0; self.records_written = 0; self.bytes_written = 0
+        self.snapshots = 0; self.snapshot_bytes = 0
+        self.shards_loaded = 0; self.shards_written = 0
+
+    # --- Files ---
+    def _segment_path(self, n: int) -> Path:
+        return self.snapshot_path.with_name(f"{self.snapshot_path.stem}.wal.{n}.jsonl")
+
+    def _segments(self) -> List[Tuple[int, Path]]:
+        found = []
+        for path in self.snapshot_path.parent.glob(f"{self.snapshot_path.stem}.wal.*.jsonl"):
+            try: found.append((int(path.name.split(".")[-2]), path))
+            except ValueError: continue
+        return sorted(found)
+
+    def _shard_path(self, client_id: str) -> Path:
+        return self.shard_dir / f"{hashlib.sha1(client_id.encode('utf-8')).hexdigest()[:24]}.json"
+
+    @staticmethod
+    def _write_json_sync(path: Path, data: Any) -> int:
+        tmp_path = path.with_suffix(".tmp")
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(data, f, ensure_ascii=False)
+            f.flush(); os.fsync(f.fileno()); size = f.tell()
+        os.replace(tmp_path, path)
+        return size
+
+    def _read_shard_sync(self, client_id: str) -> Tuple[Dict[str, Any], int]:
+        try: data = json.loads(self._shard_path(client_id).read_text(encoding="utf-8"))
+        except FileNotFoundError: return {"history": [], "memory": []}, 0
+        except (json.JSONDecodeError, OSError) as e:
+            logging.error(f"Shard for {client_id} unreadable: {e}. Using log records only."); return {"history": [], "memory": []}, 0
+        return copy_state(data.get("state") or {}), int(data.get("seq", 0))
+
+    def _materialize_sync(self, client_id: str, tail: List[dict]) -> Dict[str, Any]:
+        """Shard + newer log records of one client (blocking)."""
+        state, shard_seq = self._read_shard_sync(client_id)
+        states = {client_id: state}
+        for record in tail:
+            if record["seq"] > shard_seq: apply_record(states, record, self.max_history, self.max_memory)
+        return states[client_id]
+
+    # --- Open / recovery ---
+    def _migrate_snapshot_sync(self) -> int:
+        """One-time split of the old whole-file snapshot into shards. Returns the seq it covered."""
+        states: StateDict = {}; seq = 0
+        if self.snapshot_path.exists():
+            try:
+                data = json.loads(self.snapshot_path.read_text(encoding="utf-8") or "{}")
+                if isinstance(data.get("clients"), dict) and "seq" in data: states, seq = data["clients"], int(data["seq"])
+                else: states = data # Legacy whole-file format
+            except (json.JSONDecodeError, OSError) as e: logging.error(f"Snapshot {self.snapshot_path} unreadable: {e}. Replaying log only.")
+        for client_id, state in states.items():
+            if isinstance(state, dict): self._write_json_sync(self._shard_path(client_id), {"client": client_id, "seq": seq, "state": copy_state(state)})
+        self._write_json_sync(self.manifest_path, {"seq": seq})
+        if self.snapshot_path.exists():
+            os.replace(self.snapshot_path, self.snapshot_path.with_name(self.snapshot_path.name + ".migrated"))
+            logging.info(f"Migrated {len(states)} clients from {self.snapshot_path.name} into {self.shard_dir.name}/")
+        return seq
+
+    def _open_sync(self) -> int:
+        """Reads the manifest and the log tail into per-client record lists (blocking). Shards are not read."""
+        self.shard_dir.mkdir(parents=True, exist_ok=True)
+        try: base_seq = int(json.loads(self.manifest_path.read_text(encoding="utf-8")).get("seq", 0))
+        except FileNotFoundError: base_seq = self._migrate_snapshot_sync()
+        except (json.JSONDecodeError, OSError, ValueError) as e: logging.error(f"Manifest unreadable: {e}. Replaying the whole log."); base_seq = 0
+        self._seq = base_seq; tails: Dict[str, List[dict]] = {}; replayed = 0
+        for n, path in self._segments():
+            self._segment = max(self._segment, n)
+            with open(path, "r", encoding="utf-8") as f:
+                for line_no, line in enumerate(f, 1):
+                    try: record = json.loads(line)
+                    except json.JSONDecodeError: logging.warning(f"Torn record in {path.name}:{line_no}, stopping segment replay."); break
+                    if record.get("seq", 0) <= base_seq: continue # Already in the shards
+                    tails.setdefault(record["client"], []).append(record)
+                    self._seq = max(self._seq, record["seq"]); replayed += 1
+        self._tails = tails
+        return replayed
+
+    def has_data(self) -> bool:
+        """True if a legacy snapshot, shards or log segments exist (something to import)."""
+        return self.snapshot_path.exists() or self.manifest_path.exists() or bool(self._segments())
+
+    def recover(self) -> StateDict:
+        """Materializes every client (blocking); only for the one-time SQLite import."""
+        self._open_sync()
+        client_ids = set(self._tails)
+        for path in self.shard_dir.glob("*.json"):
+            if path == self.manifest_path: continue
+            try: client_ids.add(json.loads(path.read_text(encoding="utf-8"))["client"])
+            except (json.JSONDecodeError, OSError, KeyError) as e: logging.warning(f"Skipping shard {path.name}: {e}")
+        return {cid: self._materialize_sync(cid, self._tails.get(cid, [])) for cid in client_ids}
+
+    # --- Writer ---
+    def start(self, source: Callable[[], StateDict]):
+        """Opens the log in the background and starts the batching writer; the server listens immediately.
+        `source` returns the loaded (live) client states for compaction."""
+        self._source = source
+        self._wake = asyncio.Event(); self._due = asyncio.Event(); self._ready = asyncio.Event()
+        self._io_lock = asyncio.Lock(); self._shard_lock = asyncio.Lock()
+        self._open_task = asyncio.create_task(self._open())
+
+    async def _open(self):
+        start = time.perf_counter(); replayed = 0
+        try: replayed = await asyncio.to_thread(self._open_sync)
+        except Exception as e: logging.error(f"Memory log open failed: {e}. Starting with an empty log tail.", exc_info=True)
+        self._segment += 1; self._segment_bytes = 0
+        self._fh = await asyncio.to_thread(open, self._segment_path(self._segment), "a", encoding="utf-8")
+        self._writer_task = asyncio.create_task(self._writer_loop())
+        self._ready.set()
+        logging.info(f"Memory log open in {time.perf_counter() - start:.3f}s: {replayed} log records for {len(self._tails)} clients, seq {self._seq}.")
+
+    def append(self, op: str, client_id: str, **fields):
+        """Queues one mutation record; it is durable after the next batch fsync (see flush())."""
+        self._seq += 1
+        record = {"seq": self._seq, "op": op, "client": client_id, **fields}
+        self._tails.setdefault(client_id, []).append(record)
+        self._pending.append(json.dumps(record, ensure_ascii=False) + "\n")
+        if self._wake is not None:
+            self._wake.set()
+            if len(self._pending) >= self.flush_batch: self._due.set()
+
+    async def flush(self):
+        """Waits until every record appended so far is written and fsynced."""
+        if not self._pending or self._wake is None: return
+        waiter = asyncio.get_running_loop().create_future(); self._waiters.append(waiter)
+        self._wake.set(); self._due.set(); await waiter
+
+    async def _writer_loop(self):
+        while True:
+            await self._wake.wait()
+            # Coalesce: everything appended during the window goes out in one write + fsync
+            if not self._due.is_set():
+                try: await asyncio.wait_for(self._due.wait(), self.flush_interval)
+                except asyncio.TimeoutError: pass
+            self._wake.clear(); self._due.clear()
+            try: await self._write_pending()
+            except Exception as e: logging.error(f"Memory log write failed: {e}", exc_info=True)
+            if self._segment_bytes >= self.compact_bytes and (self._compact_task is None or self._compact_task.done()):
+                self._compact_task = asyncio.create_task(self.compact())
+
+    async def _write_pending(self, rotate: bool = False) -> Optional[Tuple[int, Dict[str, List[dict]], StateDict]]:
+        """Writes queued records to the current segment. With rotate=True also hands over the log tails
+        and copies of the affected live states (consistent with the last written record) and switches
+        to a new segment."""
+        async with self._io_lock:
+            lines, self._pending = self._pending, []
+            waiters, self._waiters = self._waiters, []
+            captured = None
+            if rotate:
+                live = self._source() if self._source else {}
+                tails, self._tails = self._tails, {}
+                for cid, tail in tails.items(): self._compacting[cid] = self._compacting.get(cid, []) + tail
+                captured = (self._seq, tails, {cid: copy_state(live[cid]) for cid in tails if isinstance(live.get(cid), dict)})
+            try:
+                if lines:
+                    data = "".join(lines); size = len(data.encode("utf-8"))
+                    start = time.perf_counter()
+                    await asyncio.to_thread(self._write_sync, self._fh, data)
+                    self._flush_latency.observe(time.perf_counter() - start)
+                    self._segment_bytes += size
+                    self.flushes += 1; self.records_written += len(lines); self.bytes_written += size
+                if rotate:
+                    old_fh = self._fh; self._segment += 1; self._segment_bytes = 0
+                    self._fh = await asyncio.to_thread(open, self._segment_path(self._segment), "a", encoding="utf-8")
+                    old_fh.close()
+            finally:
+                for waiter in waiters:
+                    if not waiter.done(): waiter.set_result(None)
+            return captured
+
+    @staticmethod
+    def _write_sync(fh, data: str):
+        fh.write(data); fh.flush(); os.fsync(fh.fileno())
+
+    # --- Per-client load / unload ---
+    async def load_client(self, client_id: str) -> Dict[str, Any]:
+        """One client's state from its shard plus newer log records. Caller holds the client's lock.
+        Records a running compaction has taken but not yet written to the shard are included too."""
+        await self._ready.wait()
+        self.shards_loaded += 1
+        tail = self._compacting.get(client_id, []) + self._tails.get(client_id, [])
+        return await asyncio.to_thread(self._materialize_sync, client_id, tail)
+
+    async def _write_shard(self, client_id: str, state: Dict[str, Any], seq: int) -> int:
+        async with self._shard_lock:
+            if self._shard_seq.get(client_id, -1) > seq: return 0 # A newer shard (unload) is already on disk
+            size = await asyncio.to_thread(self._write_json_sync, self._shard_path(client_id), {"client": client_id, "seq": seq, "state": state})
+            self._shard_seq[client_id] = seq; self.shards_written += 1
+            return size
+
+    async def unload(self, client_id: str, state: Dict[str, Any]) -> bool:
+        """Persists one client's shard and drops its log tail, so the caller can evict the state. Caller holds the client's lock."""
+        if self._ready is None: return False
+        await self._ready.wait()
+        seq = self._seq; state = copy_state(state)
+        try: await self._write_shard(client_id, state, seq)
+        except Exception as e: logging.error(f"Could not persist shard for {client_id}, keeping it loaded: {e}"); return False
+        tail = [r for r in self._tails.pop(client_id, []) if r["seq"] > seq]
+        if tail: self._tails[client_id] = tail
+        return True
+
+    # --- Compaction ---
+    async def compact(self):
+        """Rewrites the shards of every client touched since the last compaction, then deletes the segments they cover."""
+        if self._io_lock is None or not self._ready.is_set(): return
+        seq, tails, live = await self._write_pending(rotate=True)
+        start = time.perf_counter(); written = 0; failed = 0
+        for client_id, tail in tails.items():
+            try:
+                state = live.get(client_id)
+                if state is None: state = await asyncio.to_thread(self._materialize_sync, client_id, tail) # Not loaded: shard + tail
+                written += await self._write_shard(client_id, state, seq)
+            except Exception as e: # Put the tail back; it is retried by the next compaction
+                logging.error(f"Shard write for {client_id} failed: {e}", exc_info=True); failed += 1
+                self._tails[client_id] = tail + self._tails.get(client_id, [])
+            finally: self._compacting.pop(client_id, None)
+        if failed: return # Keep the segments the failed tails live in
+        try: written += await asyncio.to_thread(self._write_json_sync, self.manifest_path, {"seq": seq})
+        except Exception as e: logging.error(f"Manifest write failed (log kept): {e}", exc_info=True); return
+        self._snapshot_latency.observe(time.perf_counter() - start)
+        self.snapshots += 1; self.snapshot_bytes += written
+        for n, path in self._segments():
+            if n < self._segment:
+                try: path.unlink()
+                except OSError as e: logging.warning(f"Could not remove log segment {path.name}: {e}")
+        logging.info(f"Memory compacted: {len(tails)} client shards at seq {seq}.")
+
+    async def close(self):
+        """Flushes, compacts so the next start has an empty log tail, and stops the writer."""
+        if self._open_task is None: return
+        await self._open_task
+        if self._compact_task and not self._compact_task.done(): await self._compact_task
+        await self.compact()
+        self._writer_task.cancel()
+        try: await self._writer_task
+        except asyncio.CancelledError: pass
+        self._writer_task = None; self._open_task = None
+        if self._fh: self._fh.close(); self._fh = None
+
+    def metrics(self) -> Dict[str, Any]:
+        return {"seq": self._seq, "segment": self._segment, "segment_bytes": self._segment_bytes, "pending": len(self._pending),
+                "ready": bool(self._ready and self._ready.is_set()), "tail_clients": len(self._tails),
+                "tail_records": sum(len(t) for t in self._tails.values()), "shards_loaded": self.shards_loaded, "shards_written": self.shards_written,
+                "flushes": self.flushes, "records_written": self.records_written, "bytes_written": self.bytes_written,
+                "flush_seconds": self._flush_latency.snapshot(), "snapshots": self.snapshots, "snapshot_bytes": self.snapshot_bytes,
+                "snapshot_seconds": self._snapshot_latency.snapshot()}
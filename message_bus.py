@@ -0,0 +1,200 @@
+# -*- coding: utf-8 -*-
+# Pub/sub message bus for 5.py / 6: SSE pushes and cache invalidations across uvicorn workers.
+# LocalBus delivers in-process (single worker, the default). UnixSocketBus lets N workers on one
+# host share channels: the worker holding an flock on <socket>.lock hosts a hub on the Unix
+# socket and the others connect to it; the hub forwards each publish only to the workers that
+# subscribed to its channel. If the hub's worker exits, the survivors re-elect and resubscribe
+# (messages published during the failover are lost, like a dropped SSE connection).
+
+import asyncio
+import fcntl
+import json
+import logging
+import os
+from pathlib import Path
+from typing import Awaitable, Callable, Dict, Optional, Set
+
+Handler = Callable[[str, dict], Awaitable[None]]
+LINE_LIMIT = 16 * 1024 * 1024 # audio_chunk events carry base64 audio
+PEER_BUFFER_LIMIT = 8 * 1024 * 1024 # Hub drops a peer whose socket backs up past this (it reconnects)
+
+
+class LocalBus:
+    """In-process bus: publish() calls the channel's handler directly."""
+    shared = False
+
+    def __init__(self):
+        self._handlers: Dict[str, Handler] = {}
+        self.published = 0; self.delivered = 0; self.handler_errors = 0
+
+    async def start(self):
+        pass
+
+    async def close(self):
+        pass
+
+    @property
+    def is_hub(self) -> bool:
+        return True
+
+    def subscribe(self, channel: str, handler: Handler):
+        self._handlers[channel] = handler
+
+    def unsubscribe(self, channel: str, handler: Optional[Handler] = None) -> bool:
+        """Removes the channel's handler; with `handler`, only if that handler still owns the channel."""
+        current = self._handlers.get(channel)
+        if current is None or (handler is not None and current != handler): return False
+        del self._handlers[channel]; return True
+
+    async def _deliver(self, channel: str, message: dict) -> bool:
+        handler = self._handlers.get(channel)
+        if handler is None: return False
+        self.delivered += 1
+        try: await handler(channel, message)
+        except Exception as e: self.handler_errors += 1; logging.error(f"Bus handler for {channel} failed: {e}", exc_info=True)
+        return True
+
+    async def publish(self, channel: str, message: dict) -> bool:
+        """Returns False if nobody (that this worker knows of) is subscribed."""
+        self.published += 1
+        return await self._deliver(channel, message)
+
+    def metrics(self) -> Dict:
+        return {"bus": "local", "channels": len(self._handlers), "published": self.published, "delivered": self.delivered,
+                "handler_errors": self.handler_errors}
+
+
+class UnixSocketBus(LocalBus):
+    """Host-local bus over a Unix socket hub elected by flock; frames are JSON lines."""
+    shared = True
+
+    def __init__(self, path: Path):
+        super().__init__()
+        self.path = Path(path)
+        self._lock_fd: Optional[int] = None
+        self._server: Optional[asyncio.AbstractServer] = None
+        self._routes: Dict[str, Set[asyncio.StreamWriter]] = {} # Hub: channel -> subscribed peers
+        self._hub: Optional[asyncio.StreamWriter] = None # Peer: connection to the hub
+        self._supervisor: Optional[asyncio.Task] = None
+        self._connected = asyncio.Event()
+        self._closing = False
+        self.elections = 0; self.reconnects = 0; self.forwarded = 0; self.peers_dropped = 0
+
+    @property
+    def is_hub(self) -> bool:
+        return self._server is not None
+
+    # --- Lifecycle ---
+    async def start(self):
+        self._supervisor = asyncio.create_task(self._supervise())
+        await asyncio.wait_for(self._connected.wait(), timeout=10.0)
+
+    async def close(self):
+        self._closing = True
+        if self._supervisor: self._supervisor.cancel(); await asyncio.gather(self._supervisor, return_exceptions=True)
+        if self._hub: self._hub.close()
+        if self._server:
+            self._server.close()
+            for writers in self._routes.values():
+                for w in writers: w.close()
+            try: self.path.unlink()
+            except OSError: pass
+        if self._lock_fd is not None: os.close(self._lock_fd); self._lock_fd = None
+
+    def _try_lock(self) -> bool:
+        fd = os.open(f"{self.path}.lock", os.O_RDWR | os.O_CREAT, 0o600)
+        try: fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError: os.close(fd); return False
+        self._lock_fd = fd; return True
+
+    async def _supervise(self):
+        """Hosts the hub if the lock is free, otherwise stays connected to whoever hosts it."""
+        delay = 0.05
+        while not self._closing:
+            if self._try_lock():
+                try: self.path.unlink() # Stale socket of a dead hub
+                except FileNotFoundError: pass
+                self._server = await asyncio.start_unix_server(self._serve_peer, path=str(self.path), limit=LINE_LIMIT)
+                self.elections += 1; logging.info(f"Message bus hub on {self.path} (pid {os.getpid()})")
+                self._connected.set()
+                await asyncio.Event().wait() # Hub for the life of the process
+            try: reader, writer = await asyncio.open_unix_connection(str(self.path), limit=LINE_LIMIT)
+            except (FileNotFoundError, ConnectionRefusedError): await asyncio.sleep(delay); delay = min(delay * 2, 1.0); continue
+            self._hub = writer; delay = 0.05
+            for channel in self._handlers: self._send(writer, {"op": "sub", "ch": channel})
+            self._connected.set(); logging.info(f"Message bus connected to hub {self.path} (pid {os.getpid()})")
+            try:
+                while line := await reader.readline():
+                    frame = json.loads(line)
+                    await self._deliver(frame["ch"], frame["msg"])
+            except (ConnectionError, ValueError) as e: logging.warning(f"Message bus link error: {e}")
+            finally: self._hub = None; writer.close()
+            if not self._closing: self.reconnects += 1; logging.warning("Message bus hub went away; re-electing.")
+
+    # --- Hub side ---
+    async def _serve_peer(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while line := await reader.readline():
+                frame = json.loads(line); op = frame.get("op"); channel = frame.get("ch")
+                if op == "sub": self._routes.setdefault(channel, set()).add(writer)
+                elif op == "unsub": self._unroute(channel, writer)
+                elif op == "pub": await self._fan_out(channel, frame.get("msg"), origin=writer, line=line) # Forwarded as received
+        except (ConnectionError, ValueError) as e: logging.warning(f"Message bus peer error: {e}")
+        finally:
+            for channel in list(self._routes): self._unroute(channel, writer)
+            writer.close()
+
+    def _unroute(self, channel: str, writer: asyncio.StreamWriter):
+        writers = self._routes.get(channel)
+        if writers is None: return
+        writers.discard(writer)
+        if not writers: del self._routes[channel]
+
+    async def _fan_out(self, channel: str, message: dict, origin: Optional[asyncio.StreamWriter] = None, line: Optional[bytes] = None) -> bool:
+        delivered = False
+        if origin is not None: delivered = await self._deliver(channel, message) # The hub worker's own subscribers
+        for writer in list(self._routes.get(channel, ())):
+            if writer is origin: continue # Already delivered locally by the publishing worker
+            if writer.transport.get_write_buffer_size() > PEER_BUFFER_LIMIT:
+                self.peers_dropped += 1; logging.warning("Message bus peer stalled; dropping it"); writer.close(); continue
+            if line is None: line = (json.dumps({"ch": channel, "msg": message}, ensure_ascii=False) + "\n").encode("utf-8")
+            writer.write(line); self.forwarded += 1; delivered = True
+        return delivered
+
+    # --- Peer side ---
+    def _send(self, writer: asyncio.StreamWriter, frame: dict):
+        writer.write((json.dumps(frame, ensure_ascii=False) + "\n").encode("utf-8"))
+
+    def subscribe(self, channel: str, handler: Handler):
+        new = channel not in self._handlers
+        super().subscribe(channel, handler)
+        if new and self._hub is not None: self._send(self._hub, {"op": "sub", "ch": channel})
+
+    def unsubscribe(self, channel: str, handler: Optional[Handler] = None) -> bool:
+        if not super().unsubscribe(channel, handler): return False
+        if self._hub is not None: self._send(self._hub, {"op": "unsub", "ch": channel})
+        return True
+
+    async def publish(self, channel: str, message: dict) -> bool:
+        """Delivers to this worker's subscriber (if any) and, via the hub, to every other subscribed worker."""
+        self.published += 1
+        if self.is_hub: return await self._deliver(channel, message) | await self._fan_out(channel, message)
+        local = await self._deliver(channel, message)
+        hub = self._hub
+        if hub is None: return local # Failover in progress
+        self._send(hub, {"op": "pub", "ch": channel, "msg": message})
+        await hub.drain()
+        return True # Routed; whether another worker subscribes is only known to the hub
+
+    def metrics(self) -> Dict:
+        return {**super().metrics(), "bus": "unix", "path": str(self.path), "role": "hub" if self.is_hub else "peer",
+                "peers": len({w for ws in self._routes.values() for w in ws}), "routed_channels": len(self._routes),
+                "forwarded": self.forwarded, "elections": self.elections, "reconnects": self.reconnects, "peers_dropped": self.peers_dropped}
+
+
+def create_message_bus(base_dir: Path, default: str = "local") -> LocalBus:
+    """Builds the bus named by env MESSAGE_BUS (local | unix); the unix socket is BUS_SOCKET or <base_dir>/aura_bus.sock."""
+    name = os.getenv("MESSAGE_BUS", default).lower()
+    if name == "local": return LocalBus()
+    if name == "unix": return UnixSocketBus(Path(os.getenv("BUS_SOCKET", str(Path(base_dir) / "aura_bus.sock"))))
+    raise ValueError(f"Unknown MESSAGE_BUS: {name}")
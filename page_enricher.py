@@ -0,0 +1,140 @@
+# -*- coding: utf-8 -*-
+# Optional search result enrichment for 5.py / 6 (SEARCH_ENRICH=1).
+# Search snippets are often too thin to ground an answer, so the result pages are fetched
+# concurrently (bounded pool + per-host limit, size-capped streaming reads) under one hard
+# deadline, their main text is extracted in a process pool, and the passages that best match
+# the query are attached as result["content"], trimmed to a token budget. Pages that miss the
+# deadline keep only their snippet: enrichment never costs more wall time than `deadline`.
+# The deadline bounds the wait, not the worker: an extraction already handed to the pool runs to
+# completion after its page is abandoned, so its input is capped (max_parse_chars) before submit.
+
+import asyncio
+import html
+import logging
+import math
+import re
+import time
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, List, Optional
+from urllib.parse import urlsplit
+
+import httpx
+
+from tts_backends import LatencyHistogram
+
+DROP_BLOCKS = re.compile(r"<(script|style|noscript|svg|nav|header|footer|aside|form|template)\b[^>]*>.*?</\1\s*>", re.IGNORECASE | re.DOTALL)
+BLOCK_TAGS = re.compile(r"</?(p|div|br|li|ul|ol|h[1-6]|tr|td|section|article|blockquote|pre|main)\b[^>]*>", re.IGNORECASE)
+WORD = re.compile(r"\w+")
+
+
+def _approx_tokens(text: str) -> int:
+    return len(re.findall(r"\w+|[^\w\s]", text))
+
+
+def extract_main_text(page: str) -> List[str]:
+    """Text blocks of an HTML page with boilerplate containers and link-heavy / tiny blocks removed."""
+    page = re.sub(r"<!--.*?-->", " ", page, flags=re.DOTALL)
+    page = DROP_BLOCKS.sub(" ", page)
+    blocks = []
+    for raw in BLOCK_TAGS.split(page)[::2]: # split() interleaves the captured tag names
+        links = sum(len(m) for m in re.findall(r"<a\b[^>]*>(.*?)</a>", raw, re.IGNORECASE | re.DOTALL))
+        text = " ".join(html.unescape(re.sub(r"<[^>]+>", " ", raw)).split())
+        if len(text) < 40 or links > 0.5 * len(text): continue # Menus, buttons, link lists
+        blocks.append(text)
+    return blocks
+
+
+def select_passages(page: str, query: str, token_budget: int) -> str:
+    """Runs in the worker pool: the query-relevant blocks of a page, in page order, within token_budget."""
+    blocks = extract_main_text(page)
+    terms = set(WORD.findall(query.lower()))
+    if not blocks or not terms: return ""
+    df = Counter(t for block in blocks for t in set(WORD.findall(block.lower())) if t in terms)
+    scored = []
+    for i, block in enumerate(blocks):
+        words = WORD.findall(block.lower()); tf = Counter(w for w in words if w in terms)
+        if not tf: continue
+        # Distinct query terms dominate, rarer-on-page terms count more, long blocks are damped
+        score = sum(math.log(1 + len(blocks) / df[t]) * (1 + math.log(n)) for t, n in tf.items()) / math.sqrt(1 + len(words) / 50)
+        scored.append((score, i, block))
+    picked = []; used = 0
+    for _, i, block in sorted(scored, reverse=True):
+        cost = _approx_tokens(block)
+        if used + cost > token_budget:
+            if picked: continue
+            block = " ".join(block.split()[:token_budget]); cost = token_budget # Trim a lone oversized block
+        picked.append((i, block)); used += cost
+        if used >= token_budget: break
+    return " ... ".join(block for _, block in sorted(picked))
+
+
+class PageEnricher:
+    """Concurrent, deadline-bounded fetch + extraction of search result pages."""
+
+    def __init__(self, deadline: float = 3.0, max_connections: int = 8, per_host: int = 2, max_bytes: int = 512 * 1024,
+                 token_budget: int = 600, workers: int = 2, max_parse_chars: int = 256 * 1024):
+        self.deadline = deadline
+        self.per_host = per_host
+        self.max_bytes = max_bytes
+        self.max_parse_chars = max_parse_chars # Bounds the pool work a timed-out page can leave behind
+        self.token_budget = token_budget
+        self.workers = workers
+        self._client = httpx.AsyncClient(timeout=deadline, follow_redirects=True, headers={"User-Agent": "Mozilla/5.0 (compatible; AuraBot/1.0)"},
+                                         limits=httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections))
+        self._hosts: Dict[str, asyncio.Semaphore] = {}
+        self._pool: Optional[ProcessPoolExecutor] = None # Created on first use
+        self._latency = LatencyHistogram(buckets=(0.1, 0.25, 0.5, 1.0, 2.0, 3.0, 5.0))
+        self.stats = {"pages": 0, "enriched": 0, "timeouts": 0, "errors": 0, "skipped": 0, "bytes": 0}
+
+    def _host_slot(self, url: str) -> asyncio.Semaphore:
+        host = urlsplit(url).hostname or ""
+        slot = self._hosts.get(host)
+        if slot is None:
+            if len(self._hosts) > 256: self._hosts = {h: s for h, s in self._hosts.items() if s.locked()} # Forget idle hosts
+            slot = self._hosts[host] = asyncio.Semaphore(self.per_host)
+        return slot
+
+    async def _fetch(self, url: str) -> Optional[str]:
+        async with self._host_slot(url):
+            async with self._client.stream("GET", url) as response:
+                if response.status_code != 200 or "html" not in response.headers.get("content-type", "html"): self.stats["skipped"] += 1; return None
+                body = bytearray()
+                async for chunk in response.aiter_bytes():
+                    body.extend(chunk)
+                    if len(body) >= self.max_bytes: break # Main text is near the top; do not download the rest
+        self.stats["bytes"] += len(body)
+        return body[:self.max_bytes].decode(response.encoding or "utf-8", errors="replace")
+
+    async def _enrich_one(self, result: Dict, query: str, budget: int):
+        page = await self._fetch(result["url"])
+        if not page: return
+        if len(page) > self.max_parse_chars: # Cut at a tag boundary so the last block is not half a tag
+            page = page[:self.max_parse_chars]; page = page[:page.rfind(">") + 1] or page
+        if self._pool is None: self._pool = ProcessPoolExecutor(max_workers=self.workers)
+        content = await asyncio.get_running_loop().run_in_executor(self._pool, select_passages, page, query, budget)
+        if content: result["content"] = content; self.stats["enriched"] += 1
+
+    async def enrich(self, query: str, results: List[Dict]) -> List[Dict]:
+        """Returns copies of results; those whose page was fetched and extracted in time gain a "content" field."""
+        results = [dict(r) for r in results]
+        targets = [r for r in results if str(r.get("url", "")).startswith(("http://", "https://"))]
+        if not targets: return results
+        start = time.perf_counter(); budget = max(50, self.token_budget // len(targets))
+        tasks = {asyncio.create_task(self._enrich_one(r, query, budget)): r for r in targets}
+        done, pending = await asyncio.wait(tasks, timeout=self.deadline)
+        for task in pending: task.cancel() # Deadline: keep the snippet only
+        for task in done:
+            error = task.exception()
+            if error: self.stats["errors"] += 1; logging.debug(f"Enrich failed for {tasks[task].get('url')}: {error!r}")
+        if pending: await asyncio.gather(*pending, return_exceptions=True)
+        self.stats["pages"] += len(targets); self.stats["timeouts"] += len(pending)
+        self._latency.observe(time.perf_counter() - start)
+        return results
+
+    async def aclose(self):
+        await self._client.aclose()
+        if self._pool is not None: self._pool.shutdown(wait=False, cancel_futures=True)
+
+    def metrics(self) -> Dict:
+        return {**self.stats, "deadline": self.deadline, "token_budget": self.token_budget, "latency": self._latency.snapshot()}
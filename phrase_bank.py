@@ -0,0 +1,193 @@
+# -*- coding: utf-8 -*-
+# Pre-synthesized phrase bank for fixed utterances (command acks, timeout / error fallbacks).
+# One file per backend+voice: header, JSON index (text -> offset, length), then the audio blobs.
+# The file is memory-mapped, so a hit is a slice of the page cache instead of a TTS round trip.
+#
+# Offline build:
+#   python phrase_bank.py --voice ko-KR-HyunsuNeural "얼굴 분석 완료." "앞으로 이동합니다."
+#   python phrase_bank.py --backend espeak --voice ko-KR-JiMinNeural --file phrases.txt
+
+import argparse
+import asyncio
+import json
+import logging
+import mmap
+import os
+import re
+import struct
+import threading
+import time
+from pathlib import Path
+from typing import AsyncIterator, Dict, Iterable, Optional, Tuple
+
+from tts_backends import TTSBackend, create_tts_backend, observe_latency
+
+MAGIC = b"AURAPB1\n"
+PHRASE_BANK_DIR = Path(os.getenv("PHRASE_BANK_DIR", "phrase_bank"))
+
+
+def normalize(text: str) -> str:
+    return re.sub(r"\s+", " ", text).strip()
+
+def bank_path(backend: TTSBackend, voice: str, directory: Optional[Path] = None) -> Path:
+    return Path(directory or PHRASE_BANK_DIR) / f"{backend.name}_{re.sub(r'[^A-Za-z0-9_-]', '_', voice)}.bank"
+
+
+class PhraseBank:
+    """Memory-mapped phrase -> audio lookup for one voice. get() never synthesizes; ensure() fills gaps."""
+
+    def __init__(self, path: Path, voice: Optional[str] = None, retry_after: float = 600.0):
+        self.path = Path(path)
+        self.voice = voice # Voice the audio was rendered with (None: the backend default)
+        self.retry_after = retry_after
+        self._failed: Dict[str, float] = {} # Phrase -> time.monotonic() of its failed synthesis; not retried before retry_after
+        # (index, mmap, data offset), swapped as one reference by load(). A replaced mapping is not closed
+        # explicitly: readers on other threads (ensure_in_background) may still hold it, and the mmap is
+        # unmapped when the last reference goes away.
+        self._map: Optional[Tuple[Dict[str, Tuple[int, int]], mmap.mmap, int]] = None
+        self.hits = 0
+        self.misses = 0
+        self.synthesized = 0 # Phrases rendered by build() because they were not banked yet
+
+    # --- Load / lookup ---
+    def load(self) -> bool:
+        try:
+            with open(self.path, "rb") as f:
+                if f.read(len(MAGIC)) != MAGIC: logging.warning(f"Phrase bank {self.path} has a bad header, ignoring."); return False
+                (index_len,) = struct.unpack("<I", f.read(4))
+                index = {text: tuple(span) for text, span in json.loads(f.read(index_len).decode("utf-8")).items()}
+                mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (FileNotFoundError, ValueError, struct.error): return False
+        if hasattr(mm, "madvise"): mm.madvise(mmap.MADV_WILLNEED) # Fault pages in now, not on the first ack
+        self._map = (index, mm, len(MAGIC) + 4 + index_len)
+        logging.info(f"Phrase bank loaded: {self.path} ({len(index)} phrases)")
+        return True
+
+    @property
+    def _index(self) -> Dict[str, Tuple[int, int]]:
+        return self._map[0] if self._map is not None else {}
+
+    def _slice(self, text: str) -> Optional[bytes]:
+        mapping = self._map # One reference: index and mmap always belong together
+        if mapping is None: return None
+        index, mm, data_start = mapping
+        span = index.get(text)
+        if span is None: return None
+        offset, length = span
+        return mm[data_start + offset:data_start + offset + length] # Copy; no view outlives the mapping
+
+    def get(self, text: str) -> Optional[bytes]:
+        audio = self._slice(normalize(text))
+        if audio is None: self.misses += 1; return None
+        self.hits += 1
+        return audio
+
+    def __contains__(self, text: str) -> bool:
+        return normalize(text) in self._index
+
+    # --- Build ---
+    async def build(self, backend: TTSBackend, phrases: Iterable[str], voice: Optional[str] = None):
+        """Synthesizes the phrases not banked yet (failures are recorded, not raised) and atomically
+        replaces the bank file, then remaps it."""
+        voice = voice or self.voice
+        while isinstance(backend, PhraseBankBackend): backend = backend.backend # Render with the engine, not through the bank's get()
+        index: Dict[str, Tuple[int, int]] = {}; blobs = []; offset = 0
+        for text in dict.fromkeys(normalize(p) for p in phrases if p.strip()):
+            audio = bytes(self._slice(text) or b"") # Already banked: reuse instead of re-synthesizing
+            if not audio:
+                self.synthesized += 1
+                try: audio = await backend.synthesize(text, voice)
+                except Exception as e: logging.warning(f"Phrase bank: synthesis failed for {text!r}: {e}")
+            if not audio: self._failed[text] = time.monotonic(); logging.warning(f"Phrase bank: no audio for {text!r}"); continue
+            self._failed.pop(text, None)
+            index[text] = (offset, len(audio)); blobs.append(audio); offset += len(audio)
+        if index.keys() == self._index.keys(): return # Nothing new to write
+        header = json.dumps(index, ensure_ascii=False).encode("utf-8")
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.path.with_suffix(".tmp")
+        def _write():
+            with open(tmp_path, "wb") as f:
+                f.write(MAGIC); f.write(struct.pack("<I", len(header))); f.write(header)
+                for blob in blobs: f.write(blob)
+                f.flush(); os.fsync(f.fileno())
+            os.replace(tmp_path, self.path)
+        await asyncio.to_thread(_write)
+        self.load()
+
+    async def ensure(self, backend: TTSBackend, phrases: Iterable[str], voice: Optional[str] = None):
+        """Loads the bank and rebuilds it only if some configured phrase is missing (and did not just fail)."""
+        phrases = [normalize(p) for p in phrases if p.strip()]
+        if self._map is None: self.load()
+        now = time.monotonic()
+        missing = [p for p in phrases if p not in self._index and (p not in self._failed or now - self._failed[p] >= self.retry_after)]
+        if not missing: return
+        logging.info(f"Phrase bank: synthesizing {len(missing)} missing phrases for {self.path.name}")
+        try: await self.build(backend, list(self._index) + missing, voice)
+        except Exception as e:
+            for p in missing: self._failed.setdefault(p, now)
+            logging.error(f"Phrase bank build failed: {e}", exc_info=True)
+
+    def ensure_in_background(self, backend: TTSBackend, phrases: Iterable[str], voice: Optional[str] = None) -> threading.Thread:
+        """ensure() on its own thread and event loop, for callers without a long-lived loop (Streamlit reruns)."""
+        thread = threading.Thread(target=lambda: asyncio.run(self.ensure(backend, list(phrases), voice)), name="phrase-bank", daemon=True)
+        thread.start()
+        return thread
+
+    def wrap(self, backend: TTSBackend) -> "PhraseBankBackend":
+        return PhraseBankBackend(backend, self)
+
+    def metrics(self) -> Dict[str, int]:
+        mapping = self._map
+        return {"phrases": len(self._index), "hits": self.hits, "misses": self.misses, "synthesized": self.synthesized,
+                "failed": len(self._failed), "bytes": len(mapping[1]) - mapping[2] if mapping is not None else 0}
+
+
+class PhraseBankBackend(TTSBackend):
+    """Serves banked phrases instantly and delegates everything else to the wrapped backend."""
+
+    def __init__(self, backend: TTSBackend, bank: PhraseBank):
+        self.backend = backend
+        self.bank = bank
+        self.name = backend.name
+        self.media_type = backend.media_type
+        self.suffix = backend.suffix
+
+    async def stream(self, text: str, voice: Optional[str] = None) -> AsyncIterator[bytes]:
+        start = time.perf_counter()
+        audio = self.bank.get(text) if voice is None or voice == self.bank.voice else None # Banked audio is one voice only
+        if audio is None:
+            async for data in self.backend.stream(text, voice): yield data
+            return
+        observe_latency("phrase_bank", "total", time.perf_counter() - start)
+        yield audio
+
+
+_banks: Dict[Path, PhraseBank] = {}
+
+def get_phrase_bank(backend: TTSBackend, voice: str, directory: Optional[Path] = None) -> PhraseBank:
+    """Process-wide bank per backend+voice (Streamlit reruns and server reloads share one mapping)."""
+    path = bank_path(backend, voice, directory)
+    if path not in _banks: _banks[path] = PhraseBank(path, voice)
+    return _banks[path]
+
+
+# --- CLI ---
+def main():
+    parser = argparse.ArgumentParser(description="Pre-render fixed utterances into a memory-mapped phrase bank.")
+    parser.add_argument("phrases", nargs="*", help="Phrases to synthesize")
+    parser.add_argument("--file", type=Path, help="Text file with one phrase per line")
+    parser.add_argument("--voice", required=True, help="Voice name, e.g. ko-KR-HyunsuNeural")
+    parser.add_argument("--backend", default=None, help="edge | espeak | piper | stub (default: TTS_BACKEND)")
+    parser.add_argument("--dir", type=Path, default=PHRASE_BANK_DIR, help="Output directory")
+    args = parser.parse_args()
+    phrases = list(args.phrases)
+    if args.file: phrases += args.file.read_text(encoding="utf-8").splitlines()
+    if not phrases: parser.error("no phrases given")
+    logging.basicConfig(level=logging.INFO)
+    backend = create_tts_backend(args.voice, args.backend)
+    bank = PhraseBank(bank_path(backend, args.voice, args.dir), args.voice)
+    asyncio.run(bank.ensure(backend, phrases))
+    print(f"{bank.path}: {bank.metrics()}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,243 @@
+# -*- coding: utf-8 -*-
+# Pluggable web search backends for 5.py / 6 ([SEARCH: ...] intents).
+# DuckDuckGo (internet) and a local SQLite FTS5 corpus (on-prem / air-gapped sites, deterministic
+# benchmarks) expose the same async search() API; SEARCH_BACKEND selects one per deployment.
+# The local backend bulk-indexes a document folder into passage-sized rows and answers with
+# bm25-ranked snippets straight from the FTS index.
+
+import asyncio
+import html
+import logging
+import os
+import re
+import sqlite3
+import threading
+import time
+import unicodedata
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from tts_backends import LatencyHistogram
+
+try:
+    from duckduckgo_search import AsyncDDGS
+except ImportError: # 오프라인 배포에서는 duckduckgo_search 없이도 로컬 코퍼스 검색 사용 가능
+    AsyncDDGS = None
+
+
+# --- Backends ---
+class SearchBackend:
+    """Base class: subclasses implement _search(); search() adds latency accounting."""
+    name = "base"
+
+    def __init__(self):
+        self._latency = LatencyHistogram(buckets=(0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0))
+        self.queries = 0
+
+    async def start(self):
+        pass
+
+    async def aclose(self):
+        pass
+
+    async def _search(self, query: str, num_results: int, region: str, http_client) -> List[Dict]:
+        raise NotImplementedError
+
+    async def search(self, query: str, num_results: int = 3, region: str = "us-en", http_client=None) -> List[Dict]:
+        """[{"title", "snippet", "url"}, ...], best first."""
+        start = time.perf_counter()
+        try: return await self._search(query, num_results, region, http_client)
+        finally: self._latency.observe(time.perf_counter() - start); self.queries += 1
+
+    def metrics(self) -> Dict:
+        return {"backend": self.name, "queries": self.queries, "latency": self._latency.snapshot()}
+
+
+class DuckDuckGoBackend(SearchBackend):
+    name = "ddg"
+
+    def __init__(self):
+        if AsyncDDGS is None: raise RuntimeError("duckduckgo_search is not installed; set SEARCH_BACKEND=local")
+        super().__init__()
+
+    async def _search(self, query: str, num_results: int, region: str, http_client) -> List[Dict]:
+        results = []
+        async with AsyncDDGS(client=http_client) as ddgs: search_results = await ddgs.text(query, region=region, max_results=num_results)
+        for r in search_results or []:
+            if r.get('body'): results.append({ "title": r.get('title','NT'), "snippet": r.get('body','NS'), "url": r.get('href','#') })
+            if len(results) >= num_results: break
+        return results
+
+
+# --- Local FTS5 corpus ---
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    id INTEGER PRIMARY KEY,
+    path TEXT NOT NULL UNIQUE,
+    mtime REAL NOT NULL,
+    size INTEGER NOT NULL,
+    passages INTEGER NOT NULL
+);
+CREATE VIRTUAL TABLE IF NOT EXISTS passages USING fts5(title, body, path UNINDEXED, tokenize='unicode61 remove_diacritics 2');
+CREATE VIRTUAL TABLE IF NOT EXISTS passages_vocab USING fts5vocab(passages, row);
+"""
+# Passage rowid = file id * PASSAGE_STRIDE + passage number, so a file's rows are one rowid range (cheap to replace).
+PASSAGE_STRIDE = 1 << 16
+SQL_SEARCH = ("SELECT title, snippet(passages, 1, '', '', '…', ?), path FROM passages WHERE passages MATCH ? "
+              "ORDER BY bm25(passages, 4.0, 1.0) LIMIT ?")
+TEXT_SUFFIXES = {".txt", ".md", ".markdown", ".rst", ".html", ".htm"}
+
+
+def _read_document(path: Path) -> Tuple[str, str]:
+    """(title, plain text) of a corpus file."""
+    text = path.read_text(encoding="utf-8", errors="replace")
+    title = path.stem.replace("_", " ").replace("-", " ")
+    if path.suffix.lower() in (".html", ".htm"):
+        m = re.search(r"<title[^>]*>(.*?)</title>", text, re.IGNORECASE | re.DOTALL)
+        if m and m.group(1).strip(): title = html.unescape(m.group(1).strip())
+        text = re.sub(r"<(script|style)[^>]*>.*?</\1>", " ", text, flags=re.IGNORECASE | re.DOTALL)
+        text = re.sub(r"<(br|p|div|li|h[1-6]|tr)\b[^>]*>", "\n\n", text, flags=re.IGNORECASE)
+        text = html.unescape(re.sub(r"<[^>]+>", " ", text))
+    else:
+        m = re.search(r"^\s*#+\s*(.+)$", text, re.MULTILINE)
+        if m: title = m.group(1).strip()
+    return title, text
+
+
+def _passages(text: str, chunk_chars: int) -> Iterator[str]:
+    """Paragraph-aligned chunks of about chunk_chars, so snippets come from a focused window."""
+    chunk: List[str] = []; size = 0
+    for para in re.split(r"\n\s*\n", text):
+        para = " ".join(para.split())
+        if not para: continue
+        if chunk and size + len(para) > chunk_chars: yield " ".join(chunk); chunk = []; size = 0
+        while len(para) > chunk_chars: yield para[:chunk_chars]; para = para[chunk_chars:]
+        chunk.append(para); size += len(para) + 1
+    if chunk: yield " ".join(chunk)
+
+
+def match_expression(query: str, common: frozenset = frozenset()) -> str:
+    """FTS5 MATCH string: every word quoted (no operator injection), any word may match, bm25 ranks.
+    Words in `common` are dropped unless nothing else is left: FTS5's bm25 clamps their idf to ~0,
+    so they do not change the ranking, but scoring their long doclists dominates query time."""
+    words = list(dict.fromkeys(re.findall(r"\w+", unicodedata.normalize("NFKC", query).lower())))
+    words = [w for w in words if w not in common] or words
+    return " OR ".join(f'"{w}"' for w in words)
+
+
+class LocalFTSBackend(SearchBackend):
+    """SQLite FTS5 index over a document folder (txt / md / rst / html)."""
+    name = "local"
+
+    def __init__(self, db_path: Path, corpus_dir: Optional[Path] = None, chunk_chars: int = 1200, snippet_tokens: int = 32):
+        super().__init__()
+        self.db_path = Path(db_path)
+        self.corpus_dir = Path(corpus_dir) if corpus_dir else None
+        self.chunk_chars = chunk_chars
+        self.snippet_tokens = snippet_tokens
+        self._local = threading.local()
+        self._common: frozenset = frozenset() # Terms in at least half of all passages
+        self.index_stats: Dict = {}
+
+    def _connect(self, readonly: bool = False) -> sqlite3.Connection:
+        if readonly:
+            conn = sqlite3.connect(f"file:{self.db_path}?mode=ro", uri=True, check_same_thread=False)
+            conn.execute("PRAGMA busy_timeout=5000")
+            return conn
+        conn = sqlite3.connect(self.db_path, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("PRAGMA busy_timeout=5000")
+        return conn
+
+    # --- Indexing ---
+    def index_folder(self, folder: Optional[Path] = None) -> Dict:
+        """Incremental bulk index: new/changed files are (re)chunked, vanished files dropped, all in one transaction."""
+        folder = Path(folder or self.corpus_dir).resolve(); start = time.perf_counter()
+        conn = self._connect(); conn.executescript(SCHEMA)
+        known = {path: (file_id, mtime, size) for file_id, path, mtime, size in conn.execute("SELECT id, path, mtime, size FROM files")}
+        added = updated = removed = passages = 0; seen = set()
+        try:
+            with conn:
+                for path in sorted(p for p in folder.rglob("*") if p.is_file() and p.suffix.lower() in TEXT_SUFFIXES):
+                    key = str(path); stat = path.stat(); seen.add(key)
+                    old = known.get(key)
+                    if old and old[1] == stat.st_mtime and old[2] == stat.st_size: continue
+                    try: title, text = _read_document(path)
+                    except OSError as e: logging.warning(f"Search corpus: cannot read {path}: {e}"); continue
+                    if old:
+                        file_id = old[0]; updated += 1
+                        conn.execute("DELETE FROM passages WHERE rowid BETWEEN ? AND ?", (file_id * PASSAGE_STRIDE, (file_id + 1) * PASSAGE_STRIDE - 1))
+                    else:
+                        file_id = conn.execute("INSERT INTO files (path, mtime, size, passages) VALUES (?, ?, ?, 0)", (key, stat.st_mtime, stat.st_size)).lastrowid; added += 1
+                    rows = [(file_id * PASSAGE_STRIDE + i, title, body, key) for i, body in enumerate(_passages(text, self.chunk_chars)) if i < PASSAGE_STRIDE]
+                    conn.executemany("INSERT INTO passages (rowid, title, body, path) VALUES (?, ?, ?, ?)", rows)
+                    conn.execute("UPDATE files SET mtime = ?, size = ?, passages = ? WHERE id = ?", (stat.st_mtime, stat.st_size, len(rows), file_id))
+                    passages += len(rows)
+                for key, (file_id, _, _) in known.items():
+                    if key in seen: continue
+                    conn.execute("DELETE FROM passages WHERE rowid BETWEEN ? AND ?", (file_id * PASSAGE_STRIDE, (file_id + 1) * PASSAGE_STRIDE - 1))
+                    conn.execute("DELETE FROM files WHERE id = ?", (file_id,)); removed += 1
+            if added or updated or removed: conn.execute("INSERT INTO passages (passages) VALUES ('optimize')") # Merge segments for query speed
+            files, total = conn.execute("SELECT COUNT(*), COALESCE(SUM(passages), 0) FROM files").fetchone()
+        finally: conn.close()
+        self.index_stats = {"corpus": str(folder), "files": files, "passages": total, "added": added, "updated": updated,
+                            "removed": removed, "passages_written": passages, "seconds": round(time.perf_counter() - start, 3)}
+        logging.info(f"Search corpus indexed: {self.index_stats}")
+        return self.index_stats
+
+    def _load_common_terms(self):
+        conn = self._connect()
+        try:
+            conn.executescript(SCHEMA) # Empty index: searches return [] instead of failing on a missing table
+            total = conn.execute("SELECT COALESCE(SUM(passages), 0) FROM files").fetchone()[0]
+            self._common = frozenset(t for (t,) in conn.execute("SELECT term FROM passages_vocab WHERE doc * 2 >= ?", (total,))) if total else frozenset()
+        finally: conn.close()
+
+    async def start(self):
+        if self.corpus_dir is not None:
+            if self.corpus_dir.is_dir(): await asyncio.to_thread(self.index_folder)
+            else: logging.error(f"SEARCH_CORPUS_DIR does not exist: {self.corpus_dir}")
+        await asyncio.to_thread(self._load_common_terms)
+
+    # --- Queries (per-thread read-only connections) ---
+    def _reader(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None: conn = self._local.conn = self._connect(readonly=True)
+        return conn
+
+    def _query(self, match: str, num_results: int) -> List[tuple]:
+        return self._reader().execute(SQL_SEARCH, (self.snippet_tokens, match, num_results)).fetchall()
+
+    async def _search(self, query: str, num_results: int, region: str, http_client) -> List[Dict]:
+        match = match_expression(query, self._common)
+        if not match: return []
+        rows = await asyncio.to_thread(self._query, match, num_results)
+        return [{"title": title, "snippet": snippet, "url": Path(path).as_uri()} for title, snippet, path in rows]
+
+    def metrics(self) -> Dict:
+        return {**super().metrics(), "index": self.index_stats, "common_terms": len(self._common)}
+
+
+def create_search_backend(base_dir: Path, name: Optional[str] = None) -> SearchBackend:
+    """Builds the backend named by `name` or env SEARCH_BACKEND (ddg | local).
+
+    The local backend keeps its index in SEARCH_INDEX_DB (default <base_dir>/search_index.db) and,
+    if SEARCH_CORPUS_DIR is set, re-indexes that folder incrementally on start().
+    """
+    name = (name or os.getenv("SEARCH_BACKEND", "ddg")).lower()
+    if name == "ddg": return DuckDuckGoBackend()
+    if name == "local":
+        corpus = os.getenv("SEARCH_CORPUS_DIR")
+        return LocalFTSBackend(Path(os.getenv("SEARCH_INDEX_DB", str(Path(base_dir) / "search_index.db"))), Path(corpus) if corpus else None,
+                               chunk_chars=int(os.getenv("SEARCH_CHUNK_CHARS", "1200")))
+    raise ValueError(f"Unknown SEARCH_BACKEND: {name}")
+
+
+if __name__ == "__main__":
+    # 오프라인 코퍼스 일괄 색인: python search_backends.py <corpus_dir> [index.db]
+    import sys
+    logging.basicConfig(level=logging.INFO)
+    if len(sys.argv) < 2: sys.exit("usage: python search_backends.py <corpus_dir> [index.db]")
+    backend = LocalFTSBackend(Path(sys.argv[2] if len(sys.argv) > 2 else "search_index.db"), Path(sys.argv[1]))
+    print(backend.index_folder())
@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+# Web search result cache for 5.py / 6 ([SEARCH: ...] intents).
+# Key = (normalized query, region, result count). Hits are a dict lookup instead of a DuckDuckGo round trip;
+# empty results and provider errors are cached for a shorter negative TTL so a rate-limited provider is
+# not hammered; concurrent misses for the same key share one in-flight request. Bounded LRU with stats.
+
+import asyncio
+import re
+import time
+import unicodedata
+from collections import OrderedDict
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+
+CacheKey = Tuple[str, str, int]
+STOPWORDS = {"a", "an", "the", "of", "for", "in", "on", "at", "to", "and", "or", "is", "are", "what", "whats",
+             "how", "who", "when", "where", "which", "about", "please", "me", "tell", "search", "find"}
+
+
+def normalize_query(query: str) -> str:
+    """Case-, width-, punctuation- and whitespace-insensitive form; drops filler words unless nothing else is left."""
+    text = unicodedata.normalize("NFKC", query).lower()
+    words = re.findall(r"\w+", text)
+    kept = [w for w in words if w not in STOPWORDS]
+    return " ".join(kept or words)
+
+
+class SearchCache:
+    """TTL + LRU cache of search results with negative caching and single-flight misses."""
+
+    def __init__(self, max_entries: int = 512, ttl: float = 900.0, negative_ttl: float = 120.0):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self._entries: "OrderedDict[CacheKey, Tuple[float, List[Dict]]]" = OrderedDict() # key -> (expires, results)
+        self._inflight: Dict[CacheKey, asyncio.Future] = {}
+        self.hits = 0; self.negative_hits = 0; self.misses = 0; self.expired = 0; self.evictions = 0; self.joined = 0; self.errors = 0
+
+    @staticmethod
+    def key(query: str, region: str, num_results: int) -> CacheKey:
+        return (normalize_query(query), region, num_results)
+
+    def get(self, key: CacheKey) -> Optional[List[Dict]]:
+        """Cached results (copies), or None on a miss / expiry."""
+        entry = self._entries.get(key)
+        if entry is None: return None
+        expires, results = entry
+        if expires <= time.monotonic(): del self._entries[key]; self.expired += 1; return None
+        self._entries.move_to_end(key)
+        if results: self.hits += 1
+        else: self.negative_hits += 1
+        return [dict(r) for r in results]
+
+    def put(self, key: CacheKey, results: List[Dict]):
+        ttl = self.ttl if results else self.negative_ttl
+        self._entries[key] = (time.monotonic() + ttl, [dict(r) for r in results]); self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries: self._entries.popitem(last=False); self.evictions += 1
+
+    async def get_or_fetch(self, query: str, region: str, num_results: int, fetch: Callable[[], Awaitable[List[Dict]]]) -> List[Dict]:
+        """Serves from cache, joins an identical in-flight search, or runs fetch() once and caches its result.
+        A failing fetch is negatively cached and re-raised to the caller that ran it."""
+        key = self.key(query, region, num_results)
+        cached = self.get(key)
+        if cached is not None: return cached
+        inflight = self._inflight.get(key)
+        if inflight is not None: self.joined += 1; return [dict(r) for r in await asyncio.shield(inflight)]
+        self.misses += 1
+        future = asyncio.get_running_loop().create_future(); self._inflight[key] = future
+        try:
+            results = await fetch()
+            self.put(key, results); future.set_result(results)
+            return [dict(r) for r in results]
+        except BaseException as e:
+            if isinstance(e, Exception): self.errors += 1; self.put(key, []) # Back off the provider for negative_ttl
+            future.set_result([]) # Joined callers see "no results" rather than the error
+            raise
+        finally: self._inflight.pop(key, None)
+
+    def stats(self) -> Dict:
+        lookups = self.hits + self.negative_hits + self.misses + self.joined
+        return {"entries": len(self._entries), "max_entries": self.max_entries, "hits": self.hits, "negative_hits": self.negative_hits,
+                "misses": self.misses, "joined_inflight": self.joined, "expired": self.expired, "evictions": self.evictions,
+                "errors": self.errors, "hit_ratio": round((self.hits + self.negative_hits + self.joined) / lookups, 3) if lookups else 0.0}
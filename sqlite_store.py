@@ -0,0 +1,192 @@
+# -*- coding: utf-8 -*-
+# SQLite (WAL mode) client state store for 5.py / 6: clients, turns and memories tables with
+# (client_id, timestamp) indexes, so history/memory reads are indexed range scans and state
+# does not have to live in the heap. All writes go through one writer thread that batches
+# queued operations into a single transaction; reads use per-thread read-only connections.
+
+import asyncio
+import logging
+import queue
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS clients (
+    client_id TEXT PRIMARY KEY,
+    created REAL NOT NULL,
+    last_seen REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS turns (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    client_id TEXT NOT NULL,
+    role TEXT NOT NULL,
+    content TEXT NOT NULL,
+    timestamp REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS memories (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    client_id TEXT NOT NULL,
+    type TEXT NOT NULL,
+    content TEXT NOT NULL,
+    key TEXT,
+    timestamp TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_turns_client_ts ON turns (client_id, timestamp);
+CREATE INDEX IF NOT EXISTS idx_memories_client_ts ON memories (client_id, timestamp);
+"""
+
+# Parameterized statements are compiled once per connection and reused from sqlite3's statement cache.
+SQL_TOUCH_CLIENT = "INSERT INTO clients (client_id, created, last_seen) VALUES (?, ?, ?) ON CONFLICT(client_id) DO UPDATE SET last_seen = excluded.last_seen"
+SQL_INSERT_TURN = "INSERT INTO turns (client_id, role, content, timestamp) VALUES (?, ?, ?, ?)"
+SQL_TRIM_TURNS = "DELETE FROM turns WHERE client_id = ? AND id NOT IN (SELECT id FROM turns WHERE client_id = ? ORDER BY timestamp DESC, id DESC LIMIT ?)"
+SQL_INSERT_MEMORY = "INSERT INTO memories (client_id, type, content, key, timestamp) VALUES (?, ?, ?, ?, ?)"
+SQL_TRIM_MEMORIES = "DELETE FROM memories WHERE client_id = ? AND id NOT IN (SELECT id FROM memories WHERE client_id = ? ORDER BY timestamp DESC, id DESC LIMIT ?)"
+SQL_SELECT_TURNS = "SELECT role, content FROM (SELECT id, role, content, timestamp FROM turns WHERE client_id = ? ORDER BY timestamp DESC, id DESC LIMIT ?) ORDER BY timestamp, id"
+SQL_SELECT_MEMORIES = "SELECT type, content, key, timestamp FROM memories WHERE client_id = ? ORDER BY timestamp DESC, id DESC LIMIT ?"
+
+_STOP = object()
+
+
+class SQLiteStateStore:
+    """Async facade over a WAL-mode SQLite file with a single batching writer thread."""
+
+    def __init__(self, path: Path, max_history: int = 20, max_memory: int = 50, batch_size: int = 256):
+        self.path = Path(path)
+        self.max_history = max_history
+        self.max_memory = max_memory
+        self.batch_size = batch_size
+        self._queue: "queue.Queue" = queue.Queue()
+        self._writer: Optional[threading.Thread] = None
+        self._local = threading.local()
+        self._batches = 0; self._ops = 0
+
+    # --- Lifecycle ---
+    def start(self) -> bool:
+        """Creates the schema and starts the writer thread. Returns True if the database was empty."""
+        conn = self._connect()
+        conn.executescript(SCHEMA)
+        empty = conn.execute("SELECT NOT EXISTS (SELECT 1 FROM clients)").fetchone()[0] == 1
+        conn.close()
+        self._writer = threading.Thread(target=self._writer_loop, name="sqlite-state-writer", daemon=True)
+        self._writer.start()
+        logging.info(f"SQLite state store ready: {self.path}")
+        return bool(empty)
+
+    async def close(self):
+        if self._writer is None: return
+        self._queue.put(_STOP)
+        await asyncio.to_thread(self._writer.join)
+        self._writer = None
+
+    def _connect(self, readonly: bool = False) -> sqlite3.Connection:
+        if readonly:
+            conn = sqlite3.connect(f"file:{self.path}?mode=ro", uri=True, check_same_thread=False)
+            conn.execute("PRAGMA busy_timeout=5000")
+            return conn
+        conn = sqlite3.connect(self.path, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL") # WAL + NORMAL: no fsync per commit, still crash-consistent
+        conn.execute("PRAGMA busy_timeout=5000")
+        return conn
+
+    # --- Writer thread ---
+    def _writer_loop(self):
+        conn = self._connect()
+        while True:
+            ops = [self._queue.get()]
+            while len(ops) < self.batch_size:
+                try: ops.append(self._queue.get_nowait())
+                except queue.Empty: break
+            stop = any(op is _STOP for op in ops)
+            ops = [op for op in ops if op is not _STOP]
+            if ops: self._run_batch(conn, ops)
+            if stop: break
+        conn.close()
+
+    def _run_batch(self, conn: sqlite3.Connection, ops: List[Tuple[Callable, tuple, Any]]):
+        error = None
+        try:
+            with conn: # One transaction per batch
+                for fn, args, _ in ops: fn(conn, *args)
+        except Exception as e: logging.error(f"SQLite batch of {len(ops)} ops failed: {e}", exc_info=True); error = e
+        self._batches += 1; self._ops += len(ops)
+        for _, _, done in ops:
+            if done is not None: done(error)
+
+    async def _submit(self, fn: Callable, *args):
+        """Queues a write and waits for the batch containing it to commit."""
+        loop = asyncio.get_running_loop(); future = loop.create_future()
+        def done(error):
+            def resolve():
+                if future.done(): return
+                if error: future.set_exception(error)
+                else: future.set_result(None)
+            loop.call_soon_threadsafe(resolve)
+        self._queue.put((fn, args, done))
+        await future
+
+    # --- Write operations (run on the writer thread) ---
+    def _op_add_turns(self, conn: sqlite3.Connection, client_id: str, turns: List[Dict], now: float):
+        conn.execute(SQL_TOUCH_CLIENT, (client_id, now, now))
+        conn.executemany(SQL_INSERT_TURN, [(client_id, t["role"], t["content"], now) for t in turns])
+        conn.execute(SQL_TRIM_TURNS, (client_id, client_id, self.max_history))
+
+    def _op_add_memory(self, conn: sqlite3.Connection, client_id: str, entry: Dict, now: float):
+        conn.execute(SQL_TOUCH_CLIENT, (client_id, now, now))
+        conn.execute(SQL_INSERT_MEMORY, (client_id, entry["type"], entry["content"], entry.get("key"), entry["timestamp"]))
+        conn.execute(SQL_TRIM_MEMORIES, (client_id, client_id, self.max_memory))
+
+    def _op_import(self, conn: sqlite3.Connection, states: Dict[str, Dict[str, Any]], now: float):
+        for client_id, state in states.items():
+            if not isinstance(state, dict): continue
+            conn.execute(SQL_TOUCH_CLIENT, (client_id, now, now))
+            history = [t for t in state.get("history", []) if isinstance(t, dict) and "role" in t and "content" in t][-self.max_history:]
+            # Keep import order stable: same timestamp, increasing id
+            conn.executemany(SQL_INSERT_TURN, [(client_id, t["role"], t["content"], now) for t in history])
+            memory = [m for m in state.get("memory", []) if isinstance(m, dict) and "content" in m][-self.max_memory:]
+            conn.executemany(SQL_INSERT_MEMORY, [(client_id, m.get("type", "fact"), m["content"], m.get("key"), m.get("timestamp", "")) for m in memory])
+
+    async def add_turns(self, client_id: str, turns: List[Dict]):
+        if turns: await self._submit(self._op_add_turns, client_id, turns, time.time())
+
+    async def add_memory(self, client_id: str, entry: Dict):
+        await self._submit(self._op_add_memory, client_id, entry, time.time())
+
+    async def import_states(self, states: Dict[str, Dict[str, Any]]):
+        """One-time migration from the JSON snapshot format."""
+        await self._submit(self._op_import, states, time.time())
+        logging.info(f"Imported {len(states)} clients into {self.path}")
+
+    # --- Reads (per-thread read connections, concurrent with the writer under WAL) ---
+    def _reader(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None: conn = self._local.conn = self._connect(readonly=True)
+        return conn
+
+    def _read(self, sql: str, params: tuple) -> List[tuple]:
+        return self._reader().execute(sql, params).fetchall()
+
+    async def get_history(self, client_id: str, limit: Optional[int] = None) -> List[Dict]:
+        rows = await asyncio.to_thread(self._read, SQL_SELECT_TURNS, (client_id, limit or self.max_history))
+        return [{"role": role, "content": content} for role, content in rows]
+
+    async def get_recent_memories(self, client_id: str, limit: int = 7) -> List[Dict]:
+        rows = await asyncio.to_thread(self._read, SQL_SELECT_MEMORIES, (client_id, limit))
+        return [{"type": t, "content": c, "key": k, "timestamp": ts} for t, c, k, ts in rows]
+
+    def _read_snapshot(self, client_id: str) -> Tuple[List[tuple], List[tuple]]:
+        conn = self._reader()
+        conn.execute("BEGIN") # Both SELECTs see the same WAL snapshot
+        try: return conn.execute(SQL_SELECT_TURNS, (client_id, self.max_history)).fetchall(), conn.execute(SQL_SELECT_MEMORIES, (client_id, self.max_memory)).fetchall()
+        finally: conn.execute("COMMIT")
+
+    async def get_turn_context(self, client_id: str) -> Tuple[List[Dict], List[Dict]]:
+        """History and the full memory list (newest first) of one client, read in a single transaction."""
+        turns, memories = await asyncio.to_thread(self._read_snapshot, client_id)
+        return [{"role": role, "content": content} for role, content in turns], [{"type": t, "content": c, "key": k, "timestamp": ts} for t, c, k, ts in memories]
+
+    def metrics(self) -> Dict[str, int]:
+        return {"queued": self._queue.qsize(), "batches": self._batches, "ops": self._ops}
@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+# Bounded per-client SSE queue for 5.py / 6 (replaces unbounded asyncio.Queue()).
+# Per-event policies keep one slow or stalled browser from ballooning server memory:
+#   system              - coalesced: a run of consecutive pending progress messages keeps only the latest
+#                         (never merged across other events, so ordering relative to response / audio holds)
+#   audio_chunk         - shed first: over budget, the oldest queued audio stream is dropped whole
+#                         (its later chunks are discarded too; audio_end still goes out)
+#   response / error    - never dropped, but capped; past the cap the client is hopelessly behind
+# A client that is still over budget after shedding is disconnected: the queue closes, its memory is
+# released and the SSE generator ends, so the browser's EventSource reconnects with a fresh queue.
+
+import asyncio
+from collections import deque
+from typing import Deque, Dict, Optional, Set, Tuple
+
+COALESCE_EVENTS = {"system"}
+KEEP_EVENTS = {"response", "error"}
+SHED_EVENTS = {"audio_chunk"}
+
+
+def _stream_id(message: dict) -> Optional[str]:
+    return message.get("stream_id") # Set by the audio_* producers next to "event" / "data"
+
+
+class SSEQueue:
+    """Byte- and count-bounded FIFO of SSE messages ({"event": ..., "data": json string})."""
+
+    def __init__(self, max_events: int = 256, max_bytes: int = 4 * 1024 * 1024, max_kept: int = 32):
+        self.max_events = max_events
+        self.max_bytes = max_bytes
+        self.max_kept = max_kept # Pending response/error events before the client counts as hopelessly behind
+        self._items: Deque[Tuple[dict, int]] = deque()
+        self._bytes = 0
+        self._kept = 0
+        self._dropped_streams: Set[str] = set()
+        self._ready = asyncio.Event()
+        self.closed = False
+        self.close_reason: Optional[str] = None
+        self.coalesced = 0; self.dropped = 0; self.peak = 0
+
+    @staticmethod
+    def _size(message: dict) -> int:
+        return len(message.get("data", "")) + len(message.get("event", "")) + 16
+
+    # --- Producer ---
+    def put(self, message: dict) -> bool:
+        """Queues a message under the event policies. Returns False if the queue is (now) closed."""
+        if self.closed: return False
+        event = message.get("event", "message"); size = self._size(message)
+        if event in SHED_EVENTS and _stream_id(message) in self._dropped_streams: self.dropped += 1; return True
+        if event == "audio_end": self._dropped_streams.discard(_stream_id(message))
+        if event in COALESCE_EVENTS and self._items and self._items[-1][0].get("event") == event: # Only the tail of a run
+            old_size = self._items[-1][1]; self._items[-1] = (message, size); self._bytes += size - old_size
+            self.coalesced += 1; return True
+        self._items.append((message, size)); self._bytes += size
+        if event in KEEP_EVENTS: self._kept += 1
+        if len(self._items) > self.max_events or self._bytes > self.max_bytes: self._shed_audio()
+        if self._kept > self.max_kept or len(self._items) > self.max_events or self._bytes > self.max_bytes:
+            self.close(f"{len(self._items)} events / {self._bytes} bytes pending"); return False
+        self.peak = max(self.peak, len(self._items))
+        self._ready.set()
+        return True
+
+    def _shed_audio(self):
+        """Drops whole queued audio streams, oldest first, until the queue is back under budget."""
+        while len(self._items) > self.max_events or self._bytes > self.max_bytes:
+            victim = next((_stream_id(m) for m, _ in self._items if m.get("event") in SHED_EVENTS), None)
+            if victim is None: return
+            self._dropped_streams.add(victim); kept: Deque[Tuple[dict, int]] = deque()
+            for message, size in self._items:
+                if message.get("event") in SHED_EVENTS and _stream_id(message) == victim: self._bytes -= size; self.dropped += 1
+                else: kept.append((message, size))
+            self._items = kept
+
+    def close(self, reason: str = "closed"):
+        """Releases everything pending and wakes the consumer (get() returns None)."""
+        if self.closed: return
+        self.closed = True; self.close_reason = reason
+        self.dropped += len(self._items); self._items.clear(); self._bytes = 0; self._kept = 0
+        self._ready.set()
+
+    # --- Consumer ---
+    async def get(self) -> Optional[dict]:
+        """Next message, or None once the queue is closed."""
+        while not self._items:
+            if self.closed: return None
+            self._ready.clear(); await self._ready.wait()
+        message, size = self._items.popleft(); self._bytes -= size
+        if message.get("event") in KEEP_EVENTS: self._kept -= 1
+        return message
+
+    def qsize(self) -> int:
+        return len(self._items)
+
+    def empty(self) -> bool:
+        return not self._items
+
+    @property
+    def pending_bytes(self) -> int:
+        return self._bytes
+
+    def metrics(self) -> Dict:
+        return {"depth": len(self._items), "bytes": self._bytes, "peak": self.peak, "coalesced": self.coalesced,
+                "dropped": self.dropped, "closed": self.close_reason}
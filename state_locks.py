@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+# Striped per-client locks for the 5.py / 6 state accessors (replaces the single global client_state_lock).
+# A client always maps to the same stripe, so its read-modify-write sections stay serialized while
+# unrelated clients proceed in parallel. Lock wait time is recorded in a latency histogram.
+
+import asyncio
+import time
+import zlib
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Dict
+
+from tts_backends import LatencyHistogram
+
+
+class StripedLocks:
+    """Fixed pool of asyncio locks indexed by crc32(client_id) % stripes."""
+
+    def __init__(self, stripes: int = 64):
+        self._locks = [asyncio.Lock() for _ in range(stripes)]
+        self._wait = LatencyHistogram(buckets=(0.0001, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0))
+        self._acquisitions = 0
+        self._contended = 0
+
+    def lock_for(self, client_id: str) -> asyncio.Lock:
+        return self._locks[zlib.crc32(client_id.encode("utf-8")) % len(self._locks)]
+
+    @asynccontextmanager
+    async def hold(self, client_id: str) -> AsyncIterator[None]:
+        lock = self.lock_for(client_id)
+        if lock.locked(): self._contended += 1
+        start = time.perf_counter()
+        await lock.acquire()
+        self._wait.observe(time.perf_counter() - start); self._acquisitions += 1
+        try: yield
+        finally: lock.release()
+
+    def metrics(self) -> Dict:
+        return {"stripes": len(self._locks), "acquisitions": self._acquisitions, "contended": self._contended,
+                "held": sum(lock.locked() for lock in self._locks), "wait_seconds": self._wait.snapshot()}
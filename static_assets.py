@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+# Precompressed inline assets for the Aura servers (3.py, 4.py, 5.py, 6, cam, cam2).
+# HTML_CONTENT / CSS_CONTENT / JAVASCRIPT_CONTENT are hashed and gzip (+ brotli if installed)
+# compressed once at startup. CSS / JS are linked from the page under fingerprinted URLs
+# (/static/assets/style.<hash>.css) served as immutable; the page itself and the legacy
+# /static/css/style.css, /static/js/main.js URLs revalidate with a strong ETag (304, no body).
+
+import gzip
+import hashlib
+from typing import Dict, Mapping, Optional
+
+try:
+    import brotli
+except ImportError: # brotli 없으면 gzip / identity만 제공
+    brotli = None
+
+try:
+    from starlette.responses import Response
+except ImportError:
+    Response = None
+
+ASSET_PREFIX = "/static/assets/"
+IMMUTABLE = "public, max-age=31536000, immutable"
+REVALIDATE = "no-cache" # Cacheable, but always revalidated (cheap 304)
+ENCODING_SUFFIX = {"br": "-br", "gzip": "-gz", "identity": ""}
+
+
+def accepted_encodings(header: Optional[str]) -> Dict[str, float]:
+    """Accept-Encoding -> {coding: q}. Codings not listed take the q of "*"; without "*", identity stays
+    acceptable unless explicitly refused (RFC 9110 12.5.3), so "*;q=0" refuses identity too."""
+    accepted: Dict[str, float] = {}; wildcard = None
+    for part in (header or "").split(","):
+        coding, _, params = part.strip().partition(";")
+        coding = coding.strip().lower()
+        if not coding: continue
+        q = 1.0
+        for param in params.split(";"):
+            name, _, value = param.strip().partition("=")
+            if name.strip() == "q":
+                try: q = float(value)
+                except ValueError: q = 0.0
+        if coding == "*": wildcard = q
+        else: accepted[coding] = q
+    if wildcard is not None:
+        for c in ENCODING_SUFFIX: accepted.setdefault(c, wildcard)
+    accepted.setdefault("identity", 1.0)
+    return accepted
+
+
+class StaticAsset:
+    __slots__ = ("name", "url", "media_type", "digest", "bodies")
+
+    def __init__(self, name: str, content: bytes, media_type: str):
+        self.name = name
+        self.media_type = media_type
+        self.digest = hashlib.sha256(content).hexdigest()[:16]
+        stem, dot, suffix = name.rpartition(".")
+        self.url = f"{ASSET_PREFIX}{stem}.{self.digest}.{suffix}" if dot else f"{ASSET_PREFIX}{name}.{self.digest}"
+        self.bodies: Dict[str, bytes] = {"identity": content}
+        compressed = {"gzip": gzip.compress(content, compresslevel=9, mtime=0)}
+        if brotli is not None: compressed["br"] = brotli.compress(content, quality=11)
+        for coding, body in compressed.items():
+            if len(body) < len(content): self.bodies[coding] = body # Tiny assets may not shrink
+
+    def etag(self, coding: str) -> str:
+        return f'"{self.digest}{ENCODING_SUFFIX[coding]}"'
+
+    def negotiate(self, accept_encoding: Optional[str]) -> Optional[str]:
+        accepted = accepted_encodings(accept_encoding)
+        for coding in ("br", "gzip", "identity"): # Smallest first
+            if coding in self.bodies and accepted.get(coding, 0.0) > 0: return coding
+        return None
+
+
+class StaticAssets:
+    """Name -> precompressed asset registry that builds 200 / 304 / 404 / 406 responses."""
+
+    def __init__(self):
+        self._assets: Dict[str, StaticAsset] = {}
+        self._by_url: Dict[str, StaticAsset] = {}
+        self.served = 0; self.not_modified = 0; self.bytes_sent = 0; self.bytes_saved = 0
+
+    def add(self, name: str, content: str, media_type: str) -> str:
+        """Registers (or replaces) an asset; returns its fingerprinted URL."""
+        asset = StaticAsset(name, content.encode("utf-8"), media_type)
+        old = self._assets.get(name)
+        if old is not None: self._by_url.pop(old.url.rsplit("/", 1)[-1], None)
+        self._assets[name] = asset; self._by_url[asset.url.rsplit("/", 1)[-1]] = asset
+        return asset.url
+
+    def add_page(self, name: str, html: str, links: Mapping[str, str]) -> str:
+        """Registers an HTML page after pointing each legacy URL in `links` at its asset's fingerprinted URL."""
+        for legacy_url, asset_name in links.items(): html = html.replace(legacy_url, self._assets[asset_name].url)
+        return self.add(name, html, "text/html; charset=utf-8")
+
+    def _respond(self, asset: Optional[StaticAsset], headers: Mapping[str, str], cache_control: str) -> Response:
+        if asset is None: return Response(status_code=404)
+        coding = asset.negotiate(headers.get("accept-encoding"))
+        if coding is None: return Response(status_code=406)
+        etag = asset.etag(coding)
+        base_headers = {"ETag": etag, "Cache-Control": cache_control, "Vary": "Accept-Encoding"}
+        if_none_match = headers.get("if-none-match")
+        if if_none_match:
+            tags = [t.strip().removeprefix("W/") for t in if_none_match.split(",")]
+            if "*" in tags or any(asset.etag(c) in tags for c in asset.bodies): # Any representation of this version
+                self.not_modified += 1; self.bytes_saved += len(asset.bodies[coding])
+                return Response(status_code=304, headers=base_headers)
+        body = asset.bodies[coding]
+        if coding != "identity": base_headers["Content-Encoding"] = coding
+        self.served += 1; self.bytes_sent += len(body); self.bytes_saved += len(asset.bodies["identity"]) - len(body)
+        return Response(content=body, media_type=asset.media_type, headers=base_headers)
+
+    def response(self, name: str, headers: Mapping[str, str]) -> Response:
+        """Asset by name at a stable (non-fingerprinted) URL: revalidated on every use."""
+        return self._respond(self._assets.get(name), headers, REVALIDATE)
+
+    def fingerprinted_response(self, filename: str, headers: Mapping[str, str]) -> Response:
+        """Asset at its fingerprinted URL: the content can never change, so it is cached as immutable."""
+        return self._respond(self._by_url.get(filename), headers, IMMUTABLE)
+
+    def metrics(self) -> Dict:
+        return {"assets": {name: {"url": a.url, **{c: len(b) for c, b in a.bodies.items()}} for name, a in self._assets.items()},
+                "served": self.served, "not_modified": self.not_modified, "bytes_sent": self.bytes_sent, "bytes_saved": self.bytes_saved}
@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+# Streamlit 앱(app.py, a4.py, bot)용 음성 클립 보관 정책.
+# session_state에는 최근 N개 클립만 메모리에 두고, 오래된 클립은 키로 디스크 캐시에 내보내거나 버린다.
+# 대화 기록을 다시 그릴 때도 최근 메시지만 st.audio 위젯을 만든다.
+# AudioJobs는 응답 텍스트를 먼저 보여주고 TTS는 백그라운드로 돌린 뒤, 끝나면 같은 실행 안에서 오디오를 붙인다.
+# 화면은 먼저 그려지지만 실행(rerun) 자체는 합성이 끝날 때까지 이어진다: 한 번의 실행 시간은 LLM 시간 + TTS 시간이다.
+
+import asyncio
+import io
+import os
+import uuid
+from collections import OrderedDict
+from pathlib import Path
+from typing import Awaitable, Dict, List, Optional, Tuple
+
+import streamlit as st
+
+from audio_store import AudioStore
+
+AUDIO_KEEP_CLIPS = int(os.getenv("AUDIO_KEEP_CLIPS", "5"))      # 세션당 메모리에 유지할 클립 수
+AUDIO_RENDER_LAST = int(os.getenv("AUDIO_RENDER_LAST", "10"))   # st.audio를 다시 그릴 최근 메시지 수
+AUDIO_SPILL = os.getenv("AUDIO_SPILL", "1") == "1"              # 0이면 오래된 클립은 버림
+AUDIO_CACHE_DIR = Path(os.getenv("AUDIO_CACHE_DIR", "streamlit_audio_cache"))
+
+
+@st.cache_resource
+def _spill_store() -> AudioStore:
+    """프로세스 전체가 공유하는 디스크 캐시 (나이/용량 제한은 AudioStore 규칙 그대로)."""
+    store = AudioStore(AUDIO_CACHE_DIR, url_prefix="", max_age_seconds=int(os.getenv("AUDIO_CACHE_MAX_AGE_SECONDS", "3600")),
+                       max_total_bytes=int(os.getenv("AUDIO_CACHE_MAX_BYTES", str(500 * 1024 * 1024))))
+    store.scan_existing()
+    return store
+
+
+class SessionAudio:
+    """세션별 클립 보관함: 최근 max_clips개는 메모리, 나머지는 디스크 캐시(spill) 또는 폐기."""
+
+    def __init__(self, max_clips: int = AUDIO_KEEP_CLIPS, spill: Optional[AudioStore] = None):
+        self.max_clips = max_clips
+        self.spill = spill
+        self._clips: "OrderedDict[str, bytes]" = OrderedDict()
+        self.spilled = 0
+        self.dropped = 0
+
+    async def add(self, audio: bytes, suffix: str = ".mp3") -> str:
+        key = f"aura_tts_{uuid.uuid4().hex}{suffix}"
+        self._clips[key] = audio
+        while len(self._clips) > self.max_clips:
+            old_key, old_audio = self._clips.popitem(last=False)
+            if self.spill is None: self.dropped += 1; continue
+            path = self.spill.directory / old_key
+            try:
+                await asyncio.to_thread(path.write_bytes, old_audio)
+                self.spill.add(path, size=len(old_audio)); self.spilled += 1
+            except OSError: self.dropped += 1
+        if self.spill is not None: await self.spill.evict()
+        return key
+
+    def load(self, key: str) -> Optional[bytes]:
+        audio = self._clips.get(key)
+        if audio is not None or self.spill is None or key not in self.spill: return audio
+        try: return (self.spill.directory / key).read_bytes()
+        except OSError: return None
+
+    def metrics(self) -> Dict[str, int]:
+        return {"memory_clips": len(self._clips), "memory_bytes": sum(len(a) for a in self._clips.values()),
+                "spilled": self.spilled, "dropped": self.dropped}
+
+
+def get_session_audio() -> SessionAudio:
+    if "audio_clips" not in st.session_state:
+        st.session_state.audio_clips = SessionAudio(spill=_spill_store() if AUDIO_SPILL else None)
+    return st.session_state.audio_clips
+
+
+def render_history(messages: List[dict], session_audio: SessionAudio, render_last: int = AUDIO_RENDER_LAST):
+    """대화 기록 표시. 최근 render_last개 메시지만 오디오 위젯을 그리고, 이전 것은 '다시 듣기' 버튼으로 필요할 때만 불러온다."""
+    recent_start = len(messages) - render_last
+    for i, message in enumerate(messages):
+        with st.chat_message(message["role"]):
+            st.markdown(message["content"])
+            key = message.get("audio_key")
+            if not key: continue
+            if i >= recent_start or st.button("🔊 다시 듣기", key=f"replay_{key}"):
+                audio = session_audio.load(key)
+                if audio: st.audio(audio)
+                else: st.caption("(오디오가 만료되었습니다)")
+
+
+class AudioJobs:
+    """이번 실행(rerun)에서 시작한 TTS 작업 목록.
+
+    start()는 현재 위치에 자리표시자만 만들고 바로 돌아가므로 나머지 화면이 먼저 그려진다.
+    main() 끝에서 finish()를 기다리면 합성이 끝나는 순서대로 오디오가 붙고 메시지에 audio_key가 기록된다.
+    작업은 이번 실행의 이벤트 루프에 묶여 있으므로 finish()가 끝나야 main()이 돌아간다. 합성이 겹치는 것은
+    화면 렌더링과 같은 실행 안의 이후 작업(예: 이미지 설명 음성 합성 중의 채팅 LLM 호출)뿐이고, 다음 실행의 LLM 호출과는 겹치지 않는다.
+    """
+
+    def __init__(self, session_audio: SessionAudio, suffix: str = ".mp3"):
+        self.session_audio = session_audio
+        self.suffix = suffix
+        self._jobs: Dict[asyncio.Task, Tuple[dict, object]] = {}
+
+    def start(self, message: dict, synth: Awaitable[Optional[io.BytesIO]]):
+        placeholder = st.empty()
+        placeholder.caption("🔊 음성 생성 중...")
+        self._jobs[asyncio.create_task(synth)] = (message, placeholder)
+
+    async def finish(self):
+        pending = set(self._jobs)
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                message, placeholder = self._jobs.pop(task)
+                audio_data = task.result()
+                if audio_data:
+                    placeholder.audio(audio_data)
+                    message["audio_key"] = await self.session_audio.add(audio_data.getvalue(), self.suffix)
+                else: placeholder.empty()
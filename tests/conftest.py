@@ -0,0 +1,7 @@
+# -*- coding: utf-8 -*-
+# The shared modules live flat in the repository root; make them importable from tests/.
+
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import time
+
+from memory_log import MemoryLog
+
+
+def test_load_client_during_compaction_sees_compacted_records(tmp_path, monkeypatch):
+    """A client loaded while compact() is still writing its shard must not lose the records compaction took."""
+    log = MemoryLog(tmp_path / "aura_memory.json", flush_interval=0.001)
+    write_json = MemoryLog._write_json_sync
+
+    def slow_write(path, data):
+        if isinstance(data, dict) and data.get("client") == "c1": time.sleep(0.2) # Hold the shard write open
+        return write_json(path, data)
+
+    monkeypatch.setattr(MemoryLog, "_write_json_sync", staticmethod(slow_write))
+
+    async def scenario():
+        log.start(lambda: {}) # Nothing loaded: compaction materializes shard + tail
+        await log._ready.wait()
+        for i in range(3): log.append("memory", "c1", entry={"text": f"m{i}"})
+        await log.flush()
+        compaction = asyncio.create_task(log.compact())
+        await asyncio.sleep(0.05) # compact() is now awaiting c1's shard write
+        assert "c1" not in log._tails
+        during = await log.load_client("c1")
+        await compaction
+        after = await log.load_client("c1")
+        await log.close()
+        return during, after
+
+    during, after = asyncio.run(scenario())
+    assert [m["text"] for m in during["memory"]] == ["m0", "m1", "m2"]
+    assert [m["text"] for m in after["memory"]] == ["m0", "m1", "m2"]
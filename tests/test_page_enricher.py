@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from page_enricher import PageEnricher
+
+ARTICLE = "<html><body><nav><a href='/'>Home</a></nav>" + "".join(
+    f"<p>Block {i}: the aurora borealis is caused by charged solar particles hitting the upper atmosphere.</p>" for i in range(5)
+) + "</body></html>"
+PAGES = {
+    "/a": ("text/html; charset=utf-8", ARTICLE, 0.0),
+    "/b": ("text/html; charset=utf-8", ARTICLE, 0.0),
+    "/slow": ("text/html; charset=utf-8", ARTICLE, 2.0),
+    "/json": ("application/json", '{"aurora": "borealis"}', 0.0),
+    "/big": ("text/html; charset=utf-8", ARTICLE.replace("</body>", "<p>" + "filler text " * 200_000 + "</p></body>"), 0.0),
+}
+for n in range(4): PAGES[f"/delay{n}"] = ("text/html; charset=utf-8", ARTICLE, 0.3)
+
+
+class _PageHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        content_type, body, delay = PAGES.get(self.path, ("text/plain", "not found", 0.0))
+        if delay: time.sleep(delay)
+        data = body.encode("utf-8")
+        try:
+            self.send_response(200 if self.path in PAGES else 404)
+            self.send_header("Content-Type", content_type); self.send_header("Content-Length", str(len(data)))
+            self.end_headers(); self.wfile.write(data)
+        except (BrokenPipeError, ConnectionResetError): pass # Client gave up (deadline / size cap)
+
+    def log_message(self, *args): pass
+
+
+@pytest.fixture(scope="module")
+def page_server():
+    """Serves PAGES from a threaded http.server on a background thread; yields the base URL."""
+    server = ThreadingHTTPServer(("127.0.0.1", 0), _PageHandler); server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever, daemon=True); thread.start()
+    yield f"http://127.0.0.1:{server.server_address[1]}"
+    server.shutdown(); server.server_close()
+
+
+def _enrich(enricher: PageEnricher, query: str, urls):
+    async def run():
+        try: return await enricher.enrich(query, [{"url": url, "snippet": "s"} for url in urls])
+        finally: await enricher.aclose()
+    return asyncio.run(run())
+
+
+def test_pages_are_fetched_concurrently(page_server):
+    enricher = PageEnricher(deadline=5.0, per_host=4)
+    start = time.perf_counter()
+    results = _enrich(enricher, "aurora borealis", [f"{page_server}/delay{n}" for n in range(4)])
+    elapsed = time.perf_counter() - start
+    assert all("aurora borealis" in r["content"] for r in results)
+    assert elapsed < 4 * 0.3 # Serial fetches would take at least 1.2s
+    assert enricher.stats["enriched"] == 4
+
+
+def test_slow_page_misses_the_deadline_and_keeps_its_snippet(page_server):
+    enricher = PageEnricher(deadline=0.8)
+    start = time.perf_counter()
+    fast, slow = _enrich(enricher, "aurora", [f"{page_server}/a", f"{page_server}/slow"])
+    assert time.perf_counter() - start < 1.8
+    assert "content" in fast
+    assert "content" not in slow and slow["snippet"] == "s"
+    assert enricher.stats["timeouts"] == 1
+
+
+def test_non_html_page_is_skipped(page_server):
+    enricher = PageEnricher(deadline=3.0)
+    (result,) = _enrich(enricher, "aurora", [f"{page_server}/json"])
+    assert "content" not in result
+    assert enricher.stats["skipped"] == 1 and enricher.stats["enriched"] == 0
+
+
+def test_oversized_body_is_truncated(page_server):
+    size = len(PAGES["/big"][1])
+    enricher = PageEnricher(deadline=3.0, max_bytes=64 * 1024, max_parse_chars=32 * 1024)
+    (result,) = _enrich(enricher, "aurora borealis", [f"{page_server}/big"])
+    assert "aurora borealis" in result["content"] # The article at the top survives the cut
+    assert enricher.stats["bytes"] < size // 4 # Stopped reading near max_bytes, not at the end of the body
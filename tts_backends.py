@@ -0,0 +1,177 @@
+# -*- coding: utf-8 -*-
+# Pluggable TTS backends shared by the Aura servers and Streamlit apps.
+# edge_tts (cloud), a local subprocess engine (espeak-ng / piper) and a deterministic stub
+# expose the same async stream/synthesize API; TTS_BACKEND selects one per deployment.
+
+import asyncio
+import io
+import logging
+import os
+import shlex
+import time
+import wave
+from typing import AsyncIterator, Dict, List, Optional, Sequence
+
+try:
+    import edge_tts
+except ImportError: # 오프라인 배포에서는 edge_tts 없이도 로컬 엔진 사용 가능
+    edge_tts = None
+
+
+# --- Latency histograms ---
+class LatencyHistogram:
+    """Fixed-bucket latency histogram (seconds), cumulative like Prometheus 'le' buckets."""
+
+    def __init__(self, buckets: Sequence[float] = (0.05, 0.1, 0.25, 0.5, 1.0, 2.0, 5.0, 10.0)):
+        self.buckets = tuple(sorted(buckets))
+        self._counts = [0] * (len(self.buckets) + 1) # Last slot is +Inf
+        self._count = 0
+        self._sum = 0.0
+
+    def observe(self, seconds: float):
+        for i, bound in enumerate(self.buckets):
+            if seconds <= bound: self._counts[i] += 1; break
+        else: self._counts[-1] += 1
+        self._count += 1; self._sum += seconds
+
+    def snapshot(self) -> Dict:
+        cumulative = {}; running = 0
+        for bound, n in zip(self.buckets, self._counts):
+            running += n; cumulative[f"le_{bound}"] = running
+        cumulative["le_inf"] = self._count
+        return {"count": self._count, "sum": round(self._sum, 4), "buckets": cumulative}
+
+
+_histograms: Dict[str, Dict[str, LatencyHistogram]] = {}
+
+def _histogram(backend: str, kind: str) -> LatencyHistogram:
+    return _histograms.setdefault(backend, {}).setdefault(kind, LatencyHistogram())
+
+def observe_latency(backend: str, kind: str, seconds: float):
+    _histogram(backend, kind).observe(seconds)
+
+def tts_metrics() -> Dict[str, Dict[str, Dict]]:
+    """Per-backend first-chunk and total synthesis latency histograms."""
+    return {backend: {kind: h.snapshot() for kind, h in kinds.items()} for backend, kinds in _histograms.items()}
+
+
+# --- Backends ---
+class TTSBackend:
+    """Base class: subclasses implement _stream(); stream()/synthesize() add latency accounting."""
+    name = "base"
+    media_type = "audio/mpeg"
+    suffix = ".mp3"
+
+    @property
+    def streamable(self) -> bool:
+        """Whether chunks can be appended to a browser MediaSource as they arrive."""
+        return self.media_type == "audio/mpeg"
+
+    async def _stream(self, text: str, voice: Optional[str]) -> AsyncIterator[bytes]:
+        raise NotImplementedError
+        yield b""
+
+    async def stream(self, text: str, voice: Optional[str] = None) -> AsyncIterator[bytes]:
+        start = time.perf_counter(); first = True
+        async for data in self._stream(text, voice):
+            if not data: continue
+            if first: _histogram(self.name, "first_chunk").observe(time.perf_counter() - start); first = False
+            yield data
+        _histogram(self.name, "total").observe(time.perf_counter() - start)
+
+    async def synthesize(self, text: str, voice: Optional[str] = None) -> bytes:
+        audio = bytearray()
+        async for data in self.stream(text, voice): audio.extend(data)
+        return bytes(audio)
+
+
+class EdgeTTSBackend(TTSBackend):
+    name = "edge"
+
+    def __init__(self, voice: str):
+        if edge_tts is None: raise RuntimeError("edge_tts is not installed; set TTS_BACKEND=espeak|piper|stub")
+        self.voice = voice
+
+    async def _stream(self, text: str, voice: Optional[str]) -> AsyncIterator[bytes]:
+        async for chunk in edge_tts.Communicate(text, voice or self.voice).stream():
+            if chunk["type"] == "audio": yield chunk["data"]
+
+
+class CommandTTSBackend(TTSBackend):
+    """Local engine run as a subprocess: text on stdin, WAV on stdout (espeak-ng --stdout, piper --output_file -)."""
+    media_type = "audio/wav"
+    suffix = ".wav"
+
+    def __init__(self, name: str, command: List[str], timeout: float = 30.0, chunk_size: int = 16 * 1024):
+        self.name = name
+        self.command = command
+        self.timeout = timeout
+        self.chunk_size = chunk_size
+
+    async def _stream(self, text: str, voice: Optional[str]) -> AsyncIterator[bytes]:
+        proc = await asyncio.create_subprocess_exec(
+            *self.command, stdin=asyncio.subprocess.PIPE, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.DEVNULL)
+        # stdin is fed by its own task: long text makes the engine block on a full stdout pipe before it has read all input
+        feeder = asyncio.create_task(self._feed(proc, text.encode("utf-8")))
+        try:
+            deadline = time.monotonic() + self.timeout
+            while True:
+                data = await asyncio.wait_for(proc.stdout.read(self.chunk_size), timeout=max(deadline - time.monotonic(), 0.01))
+                if not data: break
+                yield data
+            if await proc.wait() != 0: logging.warning(f"TTS command {self.command[0]} exited with {proc.returncode}")
+        finally:
+            feeder.cancel(); await asyncio.gather(feeder, return_exceptions=True)
+            if proc.returncode is None:
+                proc.kill(); await proc.wait()
+
+    @staticmethod
+    async def _feed(proc: asyncio.subprocess.Process, data: bytes):
+        try:
+            proc.stdin.write(data); await proc.stdin.drain()
+        except (BrokenPipeError, ConnectionResetError): pass # Engine exited early; its exit code is reported by _stream
+        finally: proc.stdin.close()
+
+
+class StubTTSBackend(TTSBackend):
+    """Deterministic offline backend for CI: silent 16 kHz mono WAV, length proportional to text, fixed delay."""
+    name = "stub"
+    media_type = "audio/wav"
+    suffix = ".wav"
+
+    def __init__(self, delay: float = 0.0, ms_per_char: int = 40, chunk_size: int = 8 * 1024):
+        self.delay = delay
+        self.ms_per_char = ms_per_char
+        self.chunk_size = chunk_size
+
+    def render(self, text: str) -> bytes:
+        frames = 16 * self.ms_per_char * max(len(text), 1) # 16 samples per ms at 16 kHz
+        buffer = io.BytesIO()
+        with wave.open(buffer, "wb") as wav:
+            wav.setnchannels(1); wav.setsampwidth(2); wav.setframerate(16000)
+            wav.writeframes(b"\x00\x00" * frames)
+        return buffer.getvalue()
+
+    async def _stream(self, text: str, voice: Optional[str]) -> AsyncIterator[bytes]:
+        if self.delay: await asyncio.sleep(self.delay)
+        data = self.render(text)
+        for i in range(0, len(data), self.chunk_size): yield data[i:i + self.chunk_size]
+
+
+def create_tts_backend(voice: str, name: Optional[str] = None) -> TTSBackend:
+    """Builds the backend named by `name` or env TTS_BACKEND (edge | espeak | piper | stub).
+
+    TTS_COMMAND overrides the local engine command line; espeak uses the language of the
+    edge voice (e.g. 'ko-KR-JiMinNeural' -> 'ko') unless ESPEAK_VOICE is set.
+    """
+    name = (name or os.getenv("TTS_BACKEND", "edge")).lower()
+    command = shlex.split(os.getenv("TTS_COMMAND", ""))
+    if name == "edge": return EdgeTTSBackend(voice)
+    if name == "espeak":
+        return CommandTTSBackend("espeak", command or ["espeak-ng", "--stdout", "-v", os.getenv("ESPEAK_VOICE", voice.split("-")[0])])
+    if name == "piper":
+        model = os.getenv("PIPER_MODEL")
+        if not command and not model: raise ValueError("TTS_BACKEND=piper needs PIPER_MODEL or TTS_COMMAND")
+        return CommandTTSBackend("piper", command or ["piper", "--model", model, "--output_file", "-"])
+    if name == "stub": return StubTTSBackend(delay=float(os.getenv("TTS_STUB_DELAY", "0")))
+    raise ValueError(f"Unknown TTS_BACKEND: {name}")
@@ -0,0 +1,265 @@
+# -*- coding: utf-8 -*-
+# Shared WebSocket ConnectionManager for the /ws servers (3.py, 4.py, cam, cam2) and /ws/{client_id} of 5.py / 6.
+# Connections live in a dict (O(1) connect / disconnect). Sends never await the socket: each
+# connection has a bounded outbound queue drained by its own writer task, so a slow client
+# cannot stall its processing loop (or inference). A client whose queue exceeds the message /
+# byte budget is closed as a slow consumer (1013 "try again later"); broadcast() fans out to all.
+# Liveness: uvicorn sends protocol pings (ws_ping_interval / ws_ping_timeout, answered by the browser
+# itself) and closes peers that stop answering; a per-connection reader task sees that close at once,
+# even mid-inference, and cancels the connection's in-flight work (run()). A reaper closes connections
+# with no traffic either way (inbound message or completed send) for idle_timeout and writers stuck on
+# one send for send_timeout (half-open). Client messages beyond max_inbox while the server is busy drop
+# the oldest one, and the client is told once per overflow (drop_notice) instead of losing it silently.
+# Binary frames (binary_frames=True) carry a JSON header and a raw payload (pack_frame / unpack_frame),
+# so images and audio cross the socket without base64.
+
+import asyncio
+import json
+import logging
+import struct
+import time
+from collections import deque
+from typing import Any, Deque, Dict, List, Optional, Tuple
+
+try:
+    from starlette.websockets import WebSocket, WebSocketDisconnect, WebSocketState
+except ImportError:
+    WebSocket = Any; WebSocketState = None
+
+    class WebSocketDisconnect(Exception):
+        def __init__(self, code: int = 1000): super().__init__(code); self.code = code
+
+SLOW_CONSUMER_CODE = 1013 # Try Again Later
+GOING_AWAY_CODE = 1001 # Idle / dead peer reaped by the server
+DROP_NOTICE = {"type": "error", "message": "Too many messages while busy; an earlier message was dropped."}
+FRAME_HEADER = struct.Struct(">I") # Binary frame: header length, JSON header, raw payload
+
+
+def pack_frame(header: dict, payload: bytes = b"") -> bytes:
+    head = json.dumps(header, separators=(",", ":")).encode("utf-8")
+    return FRAME_HEADER.pack(len(head)) + head + payload
+
+
+def unpack_frame(frame: bytes) -> Tuple[dict, bytes]:
+    """Inverse of pack_frame(); raises ValueError on a malformed frame."""
+    if len(frame) < FRAME_HEADER.size: raise ValueError("Binary frame too short")
+    (size,) = FRAME_HEADER.unpack_from(frame); end = FRAME_HEADER.size + size
+    if end > len(frame): raise ValueError("Binary frame header overruns the frame")
+    header = json.loads(frame[FRAME_HEADER.size:end])
+    if not isinstance(header, dict): raise ValueError("Binary frame header is not an object")
+    return header, frame[end:]
+
+
+class _Connection:
+    """Outbound queue + writer task of one WebSocket."""
+    __slots__ = ("websocket", "history", "outbox", "bytes", "ready", "writer", "closing", "connected_at",
+                 "sent", "sent_bytes", "peak", "peak_bytes", "inbox", "inbound", "reader", "dead", "inflight",
+                 "last_seen", "last_sent", "send_started", "overflowed")
+
+    def __init__(self, websocket: "WebSocket"):
+        self.websocket = websocket
+        self.history: list = []
+        self.outbox: Deque[Tuple[str, Any, int]] = deque() # (kind, payload, size)
+        self.bytes = 0
+        self.ready = asyncio.Event()
+        self.writer: Optional[asyncio.Task] = None
+        self.closing = False # No new sends; the writer drains what is queued, then exits
+        self.connected_at = time.monotonic()
+        self.sent = 0; self.sent_bytes = 0; self.peak = 0; self.peak_bytes = 0
+        self.inbox: Deque[Any] = deque() # Parsed client messages (or the exception that ended the reader)
+        self.inbound = asyncio.Event()
+        self.reader: Optional[asyncio.Task] = None
+        self.dead = asyncio.Event() # Peer gone / reaped: receive_json() raises, run() cancels its work
+        self.inflight: set = set()
+        self.last_seen = self.connected_at # Last inbound message
+        self.last_sent = self.connected_at # Last completed send: a silent listener (e.g. a long TTS stream) is not idle
+        self.send_started: Optional[float] = None # Set while the writer is inside one send
+        self.overflowed = False # drop_notice already sent for the current backlog
+
+
+class ConnectionManager:
+    """Dict-keyed WebSocket registry with per-connection bounded send queues and writer tasks."""
+
+    def __init__(self, max_messages: int = 512, max_bytes: int = 8 * 1024 * 1024, max_inbox: int = 16,
+                 idle_timeout: float = 900.0, send_timeout: float = 30.0, binary_frames: bool = False,
+                 drop_notice: Optional[dict] = DROP_NOTICE):
+        self.max_messages = max_messages
+        self.max_bytes = max_bytes
+        self.max_inbox = max_inbox # Unprocessed client messages kept while inference runs; oldest dropped first
+        self.idle_timeout = idle_timeout # 0 disables the idle reap
+        self.send_timeout = send_timeout
+        self.binary_frames = binary_frames # Keep binary client frames as bytes instead of parsing them as JSON
+        self.drop_notice = drop_notice # Sent (in the server's message format) when an unprocessed client message is dropped
+        self._reaper: Optional[asyncio.Task] = None
+        self.reaped_idle = 0; self.reaped_stalled = 0; self.peers_gone = 0; self.cancelled_work = 0; self.inbox_dropped = 0
+        self.connections: Dict["WebSocket", _Connection] = {}
+        self.history: Dict["WebSocket", list] = {} # Per-connection chat history (same list as _Connection.history)
+        self.total_connected = 0; self.slow_closed = 0; self.send_errors = 0; self.rejected = 0
+
+    @property
+    def active_connections(self) -> List["WebSocket"]:
+        return list(self.connections)
+
+    async def connect(self, websocket: "WebSocket"):
+        await websocket.accept()
+        conn = _Connection(websocket)
+        self.connections[websocket] = conn; self.history[websocket] = conn.history; self.total_connected += 1
+        conn.writer = asyncio.create_task(self._writer(conn)); conn.reader = asyncio.create_task(self._reader(conn))
+        if self._reaper is None or self._reaper.done(): self._reaper = asyncio.create_task(self._reap_loop())
+        logging.info(f"WebSocket connected: {websocket.client} ({len(self.connections)} live)")
+
+    def disconnect(self, websocket: "WebSocket"):
+        """Releases the connection's state; messages already queued are still flushed by its writer."""
+        conn = self.connections.pop(websocket, None)
+        self.history.pop(websocket, None)
+        if conn is None: return
+        conn.closing = True; conn.ready.set()
+        conn.dead.set(); conn.inbound.set(); conn.inbox.clear()
+        for task in list(conn.inflight): task.cancel(); self.cancelled_work += 1 # Nobody is left to read the result
+        if conn.reader is not None and conn.reader is not asyncio.current_task(): conn.reader.cancel()
+        logging.info(f"WebSocket disconnected: {websocket.client} ({len(self.connections)} live)")
+
+    async def aclose(self, websocket: "WebSocket", timeout: float = 2.0):
+        """disconnect(), then waits (bounded) for the writer to flush what was queued, e.g. a final error message."""
+        conn = self.connections.get(websocket)
+        self.disconnect(websocket)
+        if conn is not None and conn.writer is not None:
+            try: await asyncio.wait_for(asyncio.shield(conn.writer), timeout)
+            except (asyncio.TimeoutError, asyncio.CancelledError): conn.writer.cancel()
+
+    # --- Inbound side ---
+    async def _reader(self, conn: _Connection):
+        ws = conn.websocket
+        try:
+            while True:
+                message = await ws.receive()
+                if message["type"] == "websocket.disconnect": self.peers_gone += 1; break
+                raw = message.get("text")
+                if raw is None and self.binary_frames: conn.inbox.append(message.get("bytes") or b"")
+                else: conn.inbox.append(json.loads(raw if raw is not None else message.get("bytes") or b"null"))
+                conn.last_seen = time.monotonic()
+                if len(conn.inbox) > self.max_inbox:
+                    conn.inbox.popleft(); self.inbox_dropped += 1 # Oldest unprocessed frame; the reader keeps running to see a disconnect
+                    if not conn.overflowed and self.drop_notice is not None:
+                        conn.overflowed = True; self._enqueue(ws, "json", self.drop_notice, len(str(self.drop_notice)))
+                conn.inbound.set()
+        except asyncio.CancelledError: return
+        except Exception as e: conn.inbox.append(e); conn.inbound.set(); return # Surfaced by receive_json()
+        self.disconnect(ws)
+
+    async def receive_json(self, websocket: "WebSocket") -> Any:
+        """Next client message (bytes for binary frames with binary_frames=True); raises WebSocketDisconnect once the peer is gone or reaped."""
+        conn = self.connections.get(websocket)
+        if conn is None: raise WebSocketDisconnect(code=GOING_AWAY_CODE)
+        while not conn.inbox:
+            if conn.dead.is_set(): raise WebSocketDisconnect(code=GOING_AWAY_CODE)
+            conn.inbound.clear(); await conn.inbound.wait()
+        item = conn.inbox.popleft()
+        if not conn.inbox: conn.overflowed = False # Caught up: the next overflow is reported again
+        if isinstance(item, Exception): raise item
+        return item
+
+    async def run(self, websocket: "WebSocket", coro):
+        """Runs per-connection work (inference, TTS) as a task that is cancelled as soon as the peer is gone."""
+        conn = self.connections.get(websocket)
+        if conn is None: coro.close(); raise WebSocketDisconnect(code=GOING_AWAY_CODE)
+        task = asyncio.ensure_future(coro); conn.inflight.add(task)
+        try: return await task
+        except asyncio.CancelledError:
+            if conn.dead.is_set(): raise WebSocketDisconnect(code=GOING_AWAY_CODE) from None
+            raise
+        finally: conn.inflight.discard(task); task.cancel()
+
+    # --- Producer side (never blocks on the network) ---
+    def _enqueue(self, websocket: "WebSocket", kind: str, payload: Any, size: int) -> bool:
+        conn = self.connections.get(websocket)
+        if conn is None or conn.closing: self.rejected += 1; return False
+        conn.outbox.append((kind, payload, size)); conn.bytes += size
+        if len(conn.outbox) > self.max_messages or conn.bytes > self.max_bytes:
+            self._close_slow(conn); return False
+        conn.peak = max(conn.peak, len(conn.outbox)); conn.peak_bytes = max(conn.peak_bytes, conn.bytes)
+        conn.ready.set()
+        return True
+
+    async def send_json(self, message: dict, websocket: "WebSocket") -> bool:
+        return self._enqueue(websocket, "json", message, len(str(message)))
+
+    async def send_text(self, text: str, websocket: "WebSocket") -> bool:
+        """Already-serialized JSON (e.g. relayed bus events): skips a decode / encode round trip."""
+        return self._enqueue(websocket, "text", text, len(text))
+
+    async def send_bytes(self, data: bytes, websocket: "WebSocket") -> bool:
+        return self._enqueue(websocket, "bytes", data, len(data))
+
+    async def broadcast(self, message: dict) -> int:
+        """Queues `message` for every live connection (admin notices / multi-viewer). Returns how many accepted it."""
+        size = len(str(message))
+        return sum(self._enqueue(ws, "json", message, size) for ws in list(self.connections))
+
+    def _close_slow(self, conn: _Connection):
+        self.slow_closed += 1
+        logging.warning(f"WebSocket {conn.websocket.client} too slow ({len(conn.outbox)} msgs / {conn.bytes} bytes queued); closing.")
+        conn.outbox.clear(); conn.bytes = 0
+        self.disconnect(conn.websocket)
+        if conn.writer is not None: conn.writer.cancel()
+        asyncio.create_task(self._close_socket(conn.websocket, SLOW_CONSUMER_CODE))
+
+    @staticmethod
+    async def _close_socket(websocket: "WebSocket", code: int):
+        try:
+            if WebSocketState is None or websocket.application_state != WebSocketState.DISCONNECTED: await websocket.close(code=code)
+        except Exception: pass # Already gone
+
+    # --- Writer task ---
+    async def _writer(self, conn: _Connection):
+        ws = conn.websocket
+        try:
+            while True:
+                while not conn.outbox:
+                    if conn.closing: return
+                    conn.ready.clear(); await conn.ready.wait()
+                kind, payload, size = conn.outbox.popleft(); conn.bytes -= size
+                conn.send_started = time.monotonic()
+                if kind == "bytes": await ws.send_bytes(payload)
+                elif kind == "text": await ws.send_text(payload)
+                else: await ws.send_json(payload)
+                conn.send_started = None; conn.last_sent = time.monotonic(); conn.sent += 1; conn.sent_bytes += size
+        except asyncio.CancelledError: pass
+        except Exception as e:
+            self.send_errors += 1; logging.info(f"WebSocket send to {ws.client} failed: {e}")
+            conn.outbox.clear(); conn.bytes = 0
+            self.disconnect(ws) # The receive loop sees the disconnect and exits
+
+    # --- Reaper ---
+    def reap(self) -> Dict[str, int]:
+        """Closes connections with no traffic either way past idle_timeout, or stuck in one send past send_timeout."""
+        now = time.monotonic(); reaped = {"idle": 0, "stalled": 0}
+        for conn in list(self.connections.values()):
+            if conn.send_started is not None and now - conn.send_started > self.send_timeout: kind = "stalled"
+            elif self.idle_timeout and now - max(conn.last_seen, conn.last_sent) > self.idle_timeout and not conn.inflight and not conn.outbox: kind = "idle"
+            else: continue
+            reaped[kind] += 1
+            logging.info(f"Reaping {kind} WebSocket {conn.websocket.client} (last message {now - conn.last_seen:.0f}s / last send {now - conn.last_sent:.0f}s ago)")
+            if conn.writer is not None: conn.writer.cancel()
+            self.disconnect(conn.websocket)
+            asyncio.create_task(self._close_socket(conn.websocket, GOING_AWAY_CODE))
+        self.reaped_idle += reaped["idle"]; self.reaped_stalled += reaped["stalled"]
+        return reaped
+
+    async def _reap_loop(self):
+        interval = max(1.0, min(self.send_timeout, self.idle_timeout or self.send_timeout) / 4)
+        while self.connections:
+            await asyncio.sleep(interval)
+            try: self.reap()
+            except Exception as e: logging.error(f"WebSocket reaper failed: {e}", exc_info=True)
+
+    def metrics(self) -> Dict:
+        deepest = sorted(self.connections.values(), key=lambda c: c.bytes, reverse=True)[:10]
+        return {"live": len(self.connections), "total_connected": self.total_connected, "slow_closed": self.slow_closed,
+                "reaped_idle": self.reaped_idle, "reaped_stalled": self.reaped_stalled, "peers_gone": self.peers_gone,
+                "cancelled_work": self.cancelled_work, "inbox_dropped": self.inbox_dropped,
+                "send_errors": self.send_errors, "rejected_sends": self.rejected,
+                "queued_messages": sum(len(c.outbox) for c in self.connections.values()),
+                "queued_bytes": sum(c.bytes for c in self.connections.values()),
+                "deepest": [{"client": str(c.websocket.client), "depth": len(c.outbox), "bytes": c.bytes, "peak": c.peak,
+                             "peak_bytes": c.peak_bytes, "sent": c.sent} for c in deepest]}